@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Time the entity helpers and cli targets against a synthetic environment.
+
+The environment is generated by benchmarks/synth.py and loaded into an
+in-process snapshot, or a scratch database on a local mongod with
+--uri. Each case reports the number of queries made and the median
+wall time. Results can be saved and compared against a previous run to
+catch regressions in query count or latency:
+
+   $ python benchmarks/bench_entities.py --save baseline.json
+   $ python benchmarks/bench_entities.py --compare baseline.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from juju_dbinspect import cli, entities
+from juju_dbinspect.profile import ProfiledDatabase
+
+import synth
+
+
+def cases(env):
+    """Return (name, callable taking a db) pairs for each benchmark."""
+    unit_id = env.units[0]
+    svc = unit_id.split('/')[0]
+    rid, left, right, iface = env.relations[0]
+    rel_id = '%s:%s %s:%s' % (left, iface, right, iface)
+    related = right if svc == left else left
+    machine_id = env.placement[unit_id]
+    e = entities
+    funcs = [
+        ('units', lambda db: e.units(db)),
+        ('unit', lambda db: e.unit(db, unit_id)),
+        ('services', lambda db: e.services(db)),
+        ('service', lambda db: e.service(db, svc)),
+        ('machines', lambda db: e.machines(db)),
+        ('machine', lambda db: e.machine(db, machine_id)),
+        ('relations', lambda db: e.relations(db)),
+        ('relations(service)', lambda db: e.relations(db, left)),
+        ('relation', lambda db: e.relation(db, rel_id)),
+        ('charms', lambda db: e.charms(db)),
+        ('graph', lambda db: e.graph(db)),
+        ('grep', lambda db: e.grep(db, r'10\.0\.0\.1$')),
+        ('charm', lambda db: e.charm(db, env.charms[svc])),
+        ('history', lambda db: e.history(db, 100)),
+        ('txn_stats', lambda db: e.txn_stats(db)),
+        ('txn_queues', lambda db: e.txn_queues(db)),
+        ('status', lambda db: e.status(db)),
+        ('stats', lambda db: e.stats(db)),
+        ('unit.formatted', lambda db: e.unit(db, unit_id).formatted),
+        ('unit.related_services',
+         lambda db: e.unit(db, unit_id).related_services),
+        ('unit.history', lambda db: e.unit(db, unit_id).history()),
+        ('service.formatted', lambda db: e.service(db, svc).formatted),
+        ('service.units', lambda db: e.service(db, svc).units),
+        ('machine.formatted',
+         lambda db: e.machine(db, machine_id).formatted),
+        ('charm.services',
+         lambda db: e.charm(db, env.charms[svc]).services),
+        ('relation.unit_ids', lambda db: e.relation(db, rel_id).unit_ids),
+        ('relation.history', lambda db: e.relation(db, rel_id).history()),
+    ]
+    targets = [
+        ['units'], ['services'], ['machines'], ['relations'],
+        ['relations', svc], ['grep', 'password'], ['history'],
+        ['status'], ['txn-stats'], ['txn-queues'], ['graph'],
+        ['graph', 'dot'], [machine_id], [svc], [unit_id],
+        [unit_id, related]]
+    for t in targets:
+        funcs.append((
+            'juju db %s' % " ".join(t),
+            lambda db, t=t: cli.invoke_action(
+                None, db, list(t), argparse.Namespace(all=True))))
+    return funcs
+
+
+# Not benchmarked, interactive or unbounded.
+SKIPPED = ('watch',)
+
+
+def run_case(db, f, rounds):
+    times = []
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        for i in range(rounds):
+            profiled = ProfiledDatabase(db)
+            sys.stdout = devnull
+            try:
+                start = time.time()
+                f(profiled)
+                times.append(time.time() - start)
+            finally:
+                sys.stdout = stdout
+    return len(profiled.profile.queries), sorted(times)[len(times) / 2]
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, (queries, elapsed) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        b_queries, b_elapsed = baseline[name]
+        if queries > b_queries:
+            regressions.append("%s: queries %d -> %d" % (
+                name, b_queries, queries))
+        if elapsed > b_elapsed * tolerance + 0.001:
+            regressions.append("%s: time %.2fms -> %.2fms" % (
+                name, b_elapsed * 1000, elapsed * 1000))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", help="Scratch mongod to load the env into")
+    parser.add_argument("--machines", type=int, default=1000)
+    parser.add_argument("--services", type=int, default=100)
+    parser.add_argument("--units", type=int, default=2000)
+    parser.add_argument("--relations", type=int, default=200)
+    parser.add_argument("--txns", type=int, default=100000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--save", metavar="FILE", help="Save results")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="Compare with saved results")
+    parser.add_argument(
+        "--tolerance", type=float, default=1.5,
+        help="Slowdown factor reported as a regression")
+    options = parser.parse_args()
+
+    env = synth.generate(synth.Sizes(
+        options.machines, options.services, options.units,
+        options.relations, options.txns))
+    tmp = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        if options.uri:
+            db = synth.load_mongo(env, options.uri)
+        else:
+            db = synth.load_snapshot(env, os.path.join(tmp, 'env.snapshot'))
+        print("loaded environment in %.1fs" % (time.time() - start))
+
+        benchmarks = cases(env)
+        covered = set(n for n, f in benchmarks)
+        for f in entities.shell_commands:
+            if f.__name__ not in covered and f.__name__ not in SKIPPED:
+                print("warning: no benchmark for %s" % f.__name__)
+
+        results = {}
+        # Warm up lazily loaded snapshot collections.
+        for name, f in benchmarks:
+            run_case(db, f, 1)
+        for name, f in benchmarks:
+            queries, elapsed = run_case(db, f, options.rounds)
+            results[name] = (queries, elapsed)
+            print("%-36s %6d queries %10.2fms" % (
+                name, queries, elapsed * 1000))
+    finally:
+        shutil.rmtree(tmp)
+
+    if options.save:
+        with open(options.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    if options.compare:
+        with open(options.compare) as fh:
+            regressions = compare(results, json.load(fh), options.tolerance)
+        for r in regressions:
+            print("regression: %s" % r)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Compare the memory held by decoded and lazy (raw BSON) entities.
+
+Each mode runs in its own process, which reads the unit documents of a
+synthetic environment as raw BSON, builds a Unit entity from each, and
+reports the growth of its peak resident size (ru_maxrss):
+
+   $ python benchmarks/bench_memory.py --units 10000
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from bson import BSON
+
+import synth
+
+
+CHILD = """
+import json, resource, sys, time
+from bson import BSON
+from juju_dbinspect.entities import Unit
+from juju_dbinspect.rawbson import INT32, lazy_class
+
+mode, path = sys.argv[1:]
+with open(path, 'rb') as fh:
+    data = fh.read()
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.time()
+units = []
+pos = 0
+LazyUnit = lazy_class(Unit)
+while pos < len(data):
+    size = INT32.unpack_from(data, pos)[0]
+    raw = data[pos:pos + size]
+    if mode == 'lazy':
+        units.append(LazyUnit.from_raw(raw))
+    else:
+        units.append(BSON(raw).decode(as_class=Unit))
+    pos += size
+# Use the entities as the shell would.
+services = set(u.service_name for u in units)
+elapsed = time.time() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'kb': after - before, 'count': len(units),
+                  'elapsed': elapsed}))
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(mode, path):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = subprocess.check_output(
+        [sys.executable, '-c', CHILD, mode, path], env=env)
+    return json.loads(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--units", type=int, default=10000)
+    parser.add_argument("--services", type=int, default=100)
+    options = parser.parse_args()
+
+    env = synth.generate(synth.Sizes(
+        units=options.units, services=options.services))
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'units.bson')
+        with open(path, 'wb') as fh:
+            for doc in env.unit_docs():
+                fh.write(BSON.encode(doc))
+        size = os.path.getsize(path)
+        print("%d units, %d KB of BSON" % (options.units, size / 1024))
+        for mode in ('decoded', 'lazy'):
+            result = measure(mode, path)
+            print("%-8s %8d KB %8.2fms" % (
+                mode, result['kb'], result['elapsed'] * 1000))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Compare the regex scan and _id range forms of a relation settings lookup.
+
+By default the comparison runs against an in-process snapshot, pass
+--uri to run it against a scratch database on a local mongod instead.
+
+   $ python benchmarks/bench_prefix.py --settings 100000
+   $ python benchmarks/bench_prefix.py --uri mongodb://localhost:27017
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from juju_dbinspect.query import relation_settings_query
+from juju_dbinspect.snapshot import dump, open_snapshot
+
+
+class Docs(list):
+
+    def find(self):
+        return iter(self)
+
+
+def settings_docs(count, relations):
+    docs = []
+    for i in range(count):
+        rid = i % relations
+        docs.append({
+            '_id': 'r#%d#%s#svc%d/%d' % (
+                rid, random.choice(('provider', 'requirer')), rid, i),
+            'private-address': '10.0.%d.%d' % (i / 250 % 250, i % 250)})
+    return docs
+
+
+def setup_snapshot(docs):
+    d = tempfile.mkdtemp()
+    path = os.path.join(d, 'bench.snapshot')
+    dump({'settings': Docs(docs)}, path, ['settings'])
+    return open_snapshot(path).settings, lambda: shutil.rmtree(d)
+
+
+def setup_mongo(uri, docs):
+    from pymongo import MongoClient
+    client = MongoClient(uri)
+    db = client.dbinspect_bench
+    db.settings.drop()
+    for i in range(0, len(docs), 1000):
+        db.settings.insert(docs[i:i + 1000])
+    return db.settings, lambda: client.drop_database('dbinspect_bench')
+
+
+def timed(f, rounds):
+    start = time.time()
+    for i in range(rounds):
+        f()
+    return (time.time() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--uri", help="Scratch mongod to load docs into")
+    parser.add_argument("--settings", type=int, default=100000)
+    parser.add_argument("--relations", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=20)
+    options = parser.parse_args()
+
+    docs = settings_docs(options.settings, options.relations)
+    if options.uri:
+        coll, cleanup = setup_mongo(options.uri, docs)
+    else:
+        coll, cleanup = setup_snapshot(docs)
+
+    try:
+        rids = [random.randrange(options.relations)
+                for i in range(options.rounds)]
+        regex = iter(rids)
+        ranged = iter(rids)
+        # Warm up any lazily loaded state before timing.
+        list(coll.find(relation_settings_query(0), {'_id': 1}))
+        regex_t = timed(lambda: list(coll.find(
+            {'_id': {'$regex': '^r#%d#.*' % next(regex)}}, {'_id': 1})),
+            options.rounds)
+        range_t = timed(lambda: list(coll.find(
+            relation_settings_query(next(ranged)), {'_id': 1})),
+            options.rounds)
+    finally:
+        cleanup()
+
+    print("settings docs: %d relations: %d" % (
+        options.settings, options.relations))
+    print("regex scan:  %8.3fms" % (regex_t * 1000))
+    print("range query: %8.3fms" % (range_t * 1000))
+    print("speedup:     %8.1fx" % (regex_t / range_t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Measure juju db startup time for each subcommand.
+
+Each command is run as a fresh process against a small snapshot, so the
+timings cover interpreter start, imports, argument parsing and running
+the action offline. The time over a bare interpreter is shown alongside.
+
+   $ python benchmarks/bench_startup.py --rounds 10
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from juju_dbinspect.snapshot import dump
+from juju_dbinspect.tests import fixtures
+
+
+COMMANDS = [
+    ['--description'],
+    ['--help'],
+    ['units'],
+    ['services'],
+    ['machines'],
+    ['relations'],
+    ['history'],
+    ['status', '--all'],
+    ['0'],
+    ['mysql'],
+    ['mysql/0'],
+    ['mysql/0', 'wordpress'],
+]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Docs(list):
+
+    def find(self):
+        return iter(self)
+
+
+def run(args, rounds):
+    times = []
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    for i in range(rounds):
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(
+                [sys.executable] + args, stdout=devnull, stderr=devnull,
+                env=env)
+        times.append(time.time() - start)
+    return sorted(times)[len(times) / 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--rounds", type=int, default=5)
+    options = parser.parse_args()
+
+    d = tempfile.mkdtemp()
+    try:
+        path = os.path.join(d, 'env.snapshot')
+        env = fixtures.environment()
+        dump(dict((k, Docs(v)) for k, v in env.items()), path, sorted(env))
+
+        base = run(['-c', 'pass'], options.rounds)
+        print("%-24s %8.1fms" % ("interpreter", base * 1000))
+        cli = ['-m', 'juju_dbinspect.cli']
+        for args in COMMANDS:
+            if args[0].startswith('--'):
+                cmd = cli + args
+            else:
+                cmd = cli + ['--snapshot', path] + args
+            elapsed = run(cmd, options.rounds)
+            print("%-24s %8.1fms  (+%.1fms)" % (
+                " ".join(args), elapsed * 1000, (elapsed - base) * 1000))
+    finally:
+        shutil.rmtree(d)
+
+
+if __name__ == '__main__':
+    main()
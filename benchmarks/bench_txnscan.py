@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Compare scans of a snapshot's txn log, decoded on load or kept as raw
+BSON and decoded only where a query matches.
+
+   $ python benchmarks/bench_txnscan.py --txns 100000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from juju_dbinspect.entities import iter_history
+from juju_dbinspect.snapshot import open_snapshot
+from juju_dbinspect.txnindex import txn_history
+
+import synth
+
+
+def cases(env):
+    u = env.units[0]
+    return [
+        ('load', lambda db: db.txns.count()),
+        ('history', lambda db: list(iter_history(db, 100))),
+        ('unit history', lambda db: list(txn_history(
+            db, [('units', u), ('statuses', 'u#' + u)]))),
+        # Unselective, the first decodes the raw txns once.
+        ('unsettled', lambda db: list(db.txns.find({'s': {'$ne': 6}}))),
+        ('state', lambda db: list(db.txns.find({'s': 1}))),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--txns", type=int, default=100000)
+    options = parser.parse_args()
+
+    env = synth.generate(synth.Sizes(txns=options.txns))
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'bench.snapshot')
+        synth.load_snapshot(env, path)
+        print("%d txns, %d KB snapshot" % (
+            options.txns, os.path.getsize(path) / 1024))
+        print("%-14s %10s %10s" % ('', 'decoded', 'raw'))
+        dbs = {}
+        for raw in (False, True):
+            dbs[raw] = open_snapshot(path)
+            dbs[raw].txns._raw = raw
+        for name, f in cases(env):
+            timings = []
+            for raw in (False, True):
+                start = time.time()
+                f(dbs[raw])
+                timings.append(time.time() - start)
+            print("%-14s %8.2fms %8.2fms" % (
+                name, timings[0] * 1000, timings[1] * 1000))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
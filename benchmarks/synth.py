@@ -0,0 +1,212 @@
+"""
+Synthetic juju environments for benchmarks.
+
+Generates the collections the entity helpers query, with juju's _id
+conventions (u#<unit>, s#<service>#<charm url>, r#<id>#<role>#<unit>)
+and a txn log touching them, at any scale. The txn log is produced
+lazily so large logs can be streamed into a snapshot or mongod.
+"""
+import datetime
+import random
+import struct
+
+from bson.objectid import ObjectId
+
+
+INTERFACES = ('mysql', 'http', 'amqp', 'keystone', 'ceph', 'juju-info')
+
+
+def txn_id(when, seq):
+    """Return a unique ObjectId with the generation time when."""
+    return ObjectId(
+        ObjectId.from_datetime(when).binary[:4] + struct.pack('>Q', seq))
+
+
+class Sizes(object):
+
+    def __init__(self, machines=1000, services=100, units=2000,
+                 relations=200, txns=100000, seed=42):
+        self.machines = machines
+        self.services = services
+        self.units = units
+        self.relations = relations
+        self.txns = txns
+        self.seed = seed
+
+
+class Collection(object):
+    """Source for snapshot.dump, regenerating its documents per find."""
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def find(self):
+        return self.factory()
+
+
+class Environment(object):
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        rand = random.Random(sizes.seed)
+        self.services = ['svc%d' % i for i in range(sizes.services)]
+        self.charms = dict(
+            (s, 'cs:precise/%s-%d' % (s, rand.randint(1, 99)))
+            for s in self.services)
+        self.units = ['%s/%d' % (self.services[i % sizes.services], i)
+                      for i in range(sizes.units)]
+        self.placement = dict(
+            (u, str(rand.randrange(sizes.machines))) for u in self.units)
+        self.relations = []
+        for rid in range(sizes.relations):
+            left, right = rand.sample(self.services, 2)
+            self.relations.append((rid, left, right, rand.choice(INTERFACES)))
+
+    def units_of(self, service):
+        return self.units[self.services.index(service)::self.sizes.services]
+
+    def relation_settings_ids(self):
+        for rid, left, right, iface in self.relations:
+            for role, svc in (('requirer', left), ('provider', right)):
+                for u in self.units_of(svc):
+                    yield 'r#%d#%s#%s' % (rid, role, u)
+
+    def collections(self):
+        return {
+            'machines': Collection(self.machine_docs),
+            'services': Collection(self.service_docs),
+            'units': Collection(self.unit_docs),
+            'relations': Collection(self.relation_docs),
+            'settings': Collection(self.settings_docs),
+            'statuses': Collection(self.status_docs),
+            'constraints': Collection(self.constraint_docs),
+            'charms': Collection(self.charm_docs),
+            'txns': Collection(self.txn_docs)}
+
+    def machine_docs(self):
+        for i in range(self.sizes.machines):
+            yield {'_id': str(i), 'series': 'precise', 'life': 0,
+                   'nonce': 'n', 'passwordhash': 'p',
+                   'jobs': [1] if i else [1, 2],
+                   'tools': {'version': '1.18.1-precise-amd64',
+                             'url': 'https://example.com/tools/%d' % i,
+                             'sha256': '0' * 64, 'size': 5000000},
+                   'txn-queue': [], 'txn-revno': 1}
+
+    def service_docs(self):
+        for s in self.services:
+            yield {'_id': s, 'charmurl': self.charms[s], 'life': 0,
+                   'unitcount': len(self.units_of(s)), 'exposed': False,
+                   'txn-queue': [], 'txn-revno': 1}
+
+    def unit_docs(self):
+        for u in self.units:
+            svc = u.split('/')[0]
+            yield {'_id': u, 'service': svc, 'charmurl': self.charms[svc],
+                   'machineid': self.placement[u], 'life': 0,
+                   'principal': '', 'subordinates': [],
+                   'privateaddress': '10.0.0.1', 'publicaddress': '10.0.0.1',
+                   'ports': [{'protocol': 'tcp', 'number': 80}],
+                   'tools': {'version': '1.18.1-precise-amd64',
+                             'url': 'https://example.com/tools',
+                             'sha256': '0' * 64, 'size': 5000000},
+                   'nonce': 'n', 'passwordhash': 'p',
+                   'txn-queue': [], 'txn-revno': 1}
+
+    def relation_docs(self):
+        for rid, left, right, iface in self.relations:
+            yield {
+                '_id': '%s:%s %s:%s' % (left, iface, right, iface),
+                'id': rid, 'life': 0,
+                'unitcount': len(self.units_of(left)) + len(
+                    self.units_of(right)),
+                'endpoints': [
+                    {'servicename': left, 'relation': {
+                        'name': iface, 'role': 'requirer',
+                        'interface': iface, 'scope': 'global'}},
+                    {'servicename': right, 'relation': {
+                        'name': iface, 'role': 'provider',
+                        'interface': iface, 'scope': 'global'}}]}
+
+    def settings_docs(self):
+        for s in self.services:
+            yield {'_id': 's#%s#%s' % (s, self.charms[s]),
+                   'debug': 'false', 'ssl_cert': 'x' * 1500}
+        for key in self.relation_settings_ids():
+            yield {'_id': key, 'private-address': '10.0.0.1',
+                   'password': 'p' * 32}
+
+    def status_docs(self):
+        for prefix, ids in (('m', [str(i) for i in range(
+                self.sizes.machines)]), ('s', self.services),
+                ('u', self.units)):
+            for i in ids:
+                yield {'_id': '%s#%s' % (prefix, i), 'status': 'started',
+                       'statusinfo': '', 'statusdata': {}}
+
+    def constraint_docs(self):
+        for prefix, ids in (('m', [str(i) for i in range(
+                self.sizes.machines)]), ('s', self.services),
+                ('u', self.units)):
+            for i in ids:
+                yield {'_id': '%s#%s' % (prefix, i), 'mem': 2048,
+                       'cpucores': None, 'arch': None}
+
+    def charm_docs(self):
+        for s in self.services:
+            yield {'_id': self.charms[s], 'config': {'options': {}},
+                   'meta': {'name': s}}
+
+    def txn_docs(self):
+        rand = random.Random(self.sizes.seed)
+        settings = list(self.relation_settings_ids())
+        start = datetime.datetime(2014, 3, 1)
+        for i in range(self.sizes.txns):
+            when = start + datetime.timedelta(seconds=i)
+            kind = rand.random()
+            if kind < 0.5 and settings:
+                key = rand.choice(settings)
+                ops = [{'c': 'settings', 'd': key, 'u': {'$set': {
+                    'private-address': '10.0.%d.%d' % (i % 250, i % 7),
+                    'ssl_cert': 'x' * 1500}}}]
+            elif kind < 0.8:
+                u = rand.choice(self.units)
+                ops = [{'c': 'units', 'd': u, 'a': {'life': {'$ne': 2}}},
+                       {'c': 'statuses', 'd': 'u#%s' % u, 'u': {
+                           '$set': {'status': 'started', 'statusinfo': ''}}}]
+            else:
+                m = str(rand.randrange(self.sizes.machines))
+                ops = [{'c': 'machines', 'd': m, 'u': {
+                    '$set': {'instanceid': 'i-%08x' % i}}}]
+            yield {'_id': txn_id(when, i),
+                   's': 6 if rand.random() > 0.01 else rand.randint(1, 5),
+                   'o': ops, 'n': '%08x' % i}
+
+
+def generate(sizes=None):
+    return Environment(sizes or Sizes())
+
+
+def load_snapshot(env, path):
+    """Write env to a snapshot at path and open it."""
+    from juju_dbinspect.snapshot import dump, open_snapshot
+    collections = env.collections()
+    dump(collections, path, sorted(collections))
+    return open_snapshot(path)
+
+
+def load_mongo(env, uri, db_name='dbinspect_bench'):
+    """Load env into a scratch database on a mongod, returning it."""
+    from pymongo import MongoClient
+    db = MongoClient(uri)[db_name]
+    for name, coll in env.collections().items():
+        db[name].drop()
+        batch = []
+        for doc in coll.find():
+            batch.append(doc)
+            if len(batch) == 1000:
+                db[name].insert(batch)
+                batch = []
+        if batch:
+            db[name].insert(batch)
+    return db
@@ -0,0 +1,97 @@
+"""
+Run many targets over one connection.
+
+Targets are read one per line, in the syntax the command line accepts,
+ie. `mysql/0 wordpress` or `history 10`. Each distinct target is run
+once. The machines, services and units asked for on their own are
+fetched together up front, with their side documents in bulk, and the
+other targets share a document cache, so a unit or relation looked up
+by several targets is read once. One json record is written per input
+line, in input order.
+"""
+import shlex
+import sys
+from StringIO import StringIO
+
+from juju_dbinspect.identity import is_machine, is_service, is_unit
+from juju_dbinspect.output import dumps
+
+
+# Targets that don't return a result, or can't be nested in a batch.
+EXCLUDED = ('shell', 'watch', 'snapshot', 'batch', 'serve')
+
+
+def read_targets(fh):
+    """Return the target lists in fh, skipping blank lines and comments.
+    """
+    targets = []
+    for line in fh:
+        parts = shlex.split(line, comments=True)
+        if parts:
+            targets.append(parts)
+    return targets
+
+
+def is_entity(targets):
+    return len(targets) == 1 and (
+        is_machine(targets[0]) or is_unit(targets[0]) or
+        is_service(targets[0]))
+
+
+def prefetch(db, target_lists):
+    """Return the formatted entities asked for on their own, by id."""
+    from juju_dbinspect.entities import status
+    ids = set(t[0] for t in target_lists if is_entity(t))
+    if not ids:
+        return {}
+    found = {}
+    for entities in status(db, *ids).values():
+        found.update(entities)
+    return found
+
+
+def run_target(client, db, targets, options, prefetched):
+    """Run one target, returning its record."""
+    from juju_dbinspect.cli import invoke_action
+    record = {'targets': targets}
+    if targets[0] in EXCLUDED:
+        record['error'] = "%s can't run in a batch" % targets[0]
+        return record
+    if is_entity(targets) and targets[0] in prefetched:
+        record['result'] = prefetched[targets[0]]
+        return record
+    # Targets that print, like history, have their output captured.
+    original, sys.stdout = sys.stdout, StringIO()
+    try:
+        record['result'] = invoke_action(client, db, list(targets), options)
+    except Exception, e:
+        record['error'] = "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        output, sys.stdout = sys.stdout.getvalue(), original
+    if output:
+        record['output'] = output.splitlines()
+    return record
+
+
+def run_batch(client, db, target_lists, options=None, out=None):
+    """Run each target list, writing a json record per list to out.
+
+    Returns the number of targets that failed.
+    """
+    from juju_dbinspect.cache import CachedDatabase
+    out = out or sys.stdout
+    compact = getattr(options, 'compact', False)
+    if client is not None:
+        db = CachedDatabase(db)
+    prefetched = prefetch(db, target_lists)
+    records = {}
+    failed = 0
+    for targets in target_lists:
+        key = tuple(targets)
+        if key not in records:
+            records[key] = run_target(
+                client, db, targets, options, prefetched)
+            failed += 'error' in records[key]
+        out.write(dumps(records[key], compact))
+        out.write('\n')
+    return failed
@@ -0,0 +1,198 @@
+"""
+Identity map cache for interactive sessions.
+
+`CachedDatabase` wraps a db handle and keeps the documents fetched by
+_id, along with the results of other queries, in a size bounded LRU.
+Before answering from the cache it polls the transaction log (at most
+once per interval) and evicts the documents touched by any txn since
+the previous poll, along with cached queries over their collections.
+The cache can be shared by threads, ie. those of a settings search.
+"""
+import collections
+import threading
+import time
+
+from juju_dbinspect.txnlog import TxnTail
+
+
+DEFAULT_SIZE = 10000
+DEFAULT_INTERVAL = 1.0
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class CachedDatabase(object):
+
+    def __init__(self, db, size=DEFAULT_SIZE, interval=DEFAULT_INTERVAL):
+        self.db = db
+        self.size = size
+        self.interval = interval
+        self._entries = collections.OrderedDict()
+        self._by_doc = {}
+        self._by_collection = {}
+        self._collections = {}
+        self._tail = None
+        self._polled = 0
+        self._lock = threading.RLock()
+        self.hits = self.misses = 0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(self.db, name)
+        if hasattr(attr, 'find_one'):
+            return self[name]
+        return attr
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = CachedCollection(self, name)
+        return self._collections[name]
+
+    def rebind(self, db):
+        """Answer misses, and poll the txn log, from db rather than the
+        handle wrapped until now, ie. to profile the queries that reach
+        it. Returns that handle.
+        """
+        with self._lock:
+            previous, self.db = self.db, db
+            if self._tail is not None:
+                self._tail.db = db
+            return previous
+
+    def refresh(self, force=False):
+        """Evict documents modified since the last check of the txn log.
+        """
+        with self._lock:
+            now = time.time()
+            if not force and now - self._polled < self.interval:
+                return
+            self._polled = now
+            if self._tail is None:
+                self._tail = TxnTail(self.db, fields={'o.c': 1, 'o.d': 1})
+                return
+            for t in self._tail.poll():
+                for op in t['o']:
+                    self.invalidate(op['c'], op['d'])
+
+    def invalidate(self, collection, doc_id):
+        with self._lock:
+            keys = self._by_doc.pop((collection, doc_id), set())
+            keys |= self._by_collection.pop(collection, set())
+            for k in keys:
+                self._entries.pop(k, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_doc.clear()
+            self._by_collection.clear()
+
+    def get(self, key):
+        with self._lock:
+            self.refresh()
+            if key not in self._entries:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, collection, doc_id=None):
+        with self._lock:
+            if doc_id is None:
+                index, index_key = self._by_collection, collection
+            else:
+                index, index_key = self._by_doc, (collection, doc_id)
+            index.setdefault(index_key, set()).add(key)
+            # Entries keep their index, to be dropped from it on eviction.
+            self._entries[key] = (value, index, index_key)
+            while len(self._entries) > self.size:
+                evicted, (_, index, index_key) = self._entries.popitem(
+                    last=False)
+                keys = index.get(index_key)
+                if keys is not None:
+                    keys.discard(evicted)
+                    if not keys:
+                        del index[index_key]
+
+
+class CachedCollection(object):
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+
+    @property
+    def collection(self):
+        return self.cache.db[self.name]
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def find_one(self, spec_or_id=None, fields=None, as_class=None, **kw):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        doc_id = (spec_or_id or {}).get('_id')
+        if (self.name == 'txns' or kw or not spec_or_id or
+                list(spec_or_id) != ['_id'] or isinstance(doc_id, dict)):
+            return self.collection.find_one(
+                spec_or_id, fields, as_class=as_class or dict, **kw)
+        key = ('find_one', self.name, _freeze(doc_id), _freeze(fields))
+        try:
+            doc = self.cache.get(key)
+        except KeyError:
+            doc = self.collection.find_one(spec_or_id, fields)
+            self.cache.put(key, doc, self.name, doc_id)
+        if doc is None:
+            return None
+        return (as_class or dict)(doc)
+
+    def find(self, *args, **kw):
+        if self.name == 'txns':
+            return self.collection.find(*args, **kw)
+        return CachedCursor(self, args, kw)
+
+
+class CachedCursor(object):
+    """Cursor whose results are cached when iterated without modifiers.
+
+    Using any other cursor method falls back to an uncached cursor.
+    """
+
+    def __init__(self, collection, args, kw):
+        self._collection = collection
+        self._args = args
+        self._kw = kw
+
+    def _docs(self):
+        kw = dict(self._kw)
+        as_class = kw.pop('as_class', None) or dict
+        coll = self._collection
+        key = ('find', coll.name, _freeze(self._args), _freeze(kw))
+        try:
+            docs = coll.cache.get(key)
+        except KeyError:
+            docs = list(coll.collection.find(*self._args, **kw))
+            coll.cache.put(key, docs, coll.name)
+        return [as_class(d) for d in docs]
+
+    def __iter__(self):
+        return iter(self._docs())
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip or not (self._kw or self._args[2:]):
+            return len(self._docs())
+        return self._collection.collection.find(
+            *self._args, **self._kw).count()
+
+    def __getattr__(self, name):
+        cursor = self._collection.collection.find(*self._args, **self._kw)
+        return getattr(cursor, name)
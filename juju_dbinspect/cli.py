@@ -1,17 +1,14 @@
 import argparse
-import code
-import functools
 import logging
-import pprint
 import sys
 
-from juju_dbinspect.config import Config
 from juju_dbinspect.exceptions import ConfigError
-from juju_dbinspect.entities import (
-    machines, machine, units, unit, services, service, relations, history,
-    shell_commands)
 from juju_dbinspect.identity import is_unit, is_service, is_machine
 
+# Modules that pull in pymongo, yaml and friends are imported by the
+# code paths that need them, juju runs `juju db --description` whenever
+# it lists plugins, so startup should stay fast.
+
 log = logging.getLogger("juju-db")
 
 PLUGIN_DESCRIPTION = "Juju database introspection"
@@ -26,39 +23,176 @@ def setup_parser():
         description="%s\n%s" % (PLUGIN_DESCRIPTION, invoke_action.__doc__),
         formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument(
-        "-e", "--environment", help="Juju environment to operate on")
+        "-e", "--environment", action="append",
+        help="Juju environment to operate on, repeated or comma separated"
+        " to query several environments at once")
+    parser.add_argument(
+        "--all-environments", action="store_true",
+        help="Query every environment in environments.yaml and"
+        " environments/*.jenv at once")
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Verbose output")
+    parser.add_argument(
+        "--since", help="Only show transactions after this time (UTC)")
+    parser.add_argument(
+        "--until", help="Only show transactions before this time (UTC)")
+    parser.add_argument(
+        "--limit", type=int, default=100,
+        help="Maximum number of transactions, or documents for"
+        " txn-queues, to show, 0 for all")
+    parser.add_argument(
+        "--collection", help="Only watch transactions on this collection")
+    parser.add_argument(
+        "--entity", help="Only watch transactions on this document id")
+    parser.add_argument(
+        "--state", help="Only watch transactions in this state")
+    parser.add_argument(
+        "--interval", type=float, default=1.0,
+        help="Seconds between polls of the transaction log (watch)")
+    parser.add_argument(
+        "-o", "--output", choices=("text", "jsonl"), default="text",
+        help="Output format, jsonl streams one json record per"
+        " transaction, entity or match (history, watch, listings and"
+        " grep)")
+    parser.add_argument(
+        "--compact", action="store_true",
+        help="Write json without indentation or whitespace")
+    parser.add_argument(
+        "--interface", help="Only list relations on this interface")
+    parser.add_argument(
+        "--role", choices=("provider", "requirer", "peer"),
+        help="Only list relations where the service has this role")
+    parser.add_argument(
+        "--all", action="store_true",
+        help="Report on every entity in the environment (status)")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Disable the shell's document cache")
+    parser.add_argument(
+        "--lazy", action="store_true",
+        help="Keep the shell's entities as raw BSON, decoding fields on"
+        " access, to hold many entities in less memory")
+    parser.add_argument(
+        "--txn-index", metavar="FILE",
+        help="Local index of the transaction log used for entity history,"
+        " created or updated as needed")
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="Report the queries made, and their cost, on stderr")
+    parser.add_argument(
+        "--read-preference",
+        choices=("primary", "primaryPreferred", "secondary",
+                 "secondaryPreferred", "nearest"),
+        help="State servers to read from, defaults to secondaryPreferred,"
+        " or primary for the shell")
+    parser.add_argument(
+        "--no-daemon", action="store_true",
+        help="Query the state server directly, even if juju db serve is"
+        " running")
+    parser.add_argument(
+        "--snapshot", metavar="FILE",
+        help="Read from a snapshot file instead of the state server")
 
     parser.add_argument("targets", nargs="+")
 
     return parser
 
 
-def shell(client, db):
+def shell(client, db, cache=True, lazy=False):
+    import code
+    import functools
+    import pprint
+    from juju_dbinspect import txnindex
+    from juju_dbinspect.cache import CachedDatabase
+    from juju_dbinspect.entities import shell_commands
+
+    index = txnindex.for_db(db)
+    cached = None
+    if cache and client is not None:
+        db = cached = CachedDatabase(db)
+    if lazy:
+        from juju_dbinspect.rawbson import LazyDatabase
+        db = LazyDatabase(db)
+    if index is not None:
+        txnindex.attach(db, index)
     ctxt = {'client': client, 'db': db}
+    # The db used by shell commands, swapped out while profiling.
+    current = {'db': db}
 
     def bound_func(f):
         def wrapper(*args, **kw):
-            return f(db, *args, **kw)
+            return f(current['db'], *args, **kw)
         return wrapper
 
+    def profile(f, *args, **kw):
+        """Call f, printing the queries shell commands made during it."""
+        from juju_dbinspect.profile import ProfiledDatabase
+        if cached is not None:
+            # Profile beneath the cache, lookups it answers aren't queries.
+            profiled = ProfiledDatabase(cached.db)
+            cached.rebind(profiled)
+            hits = cached.hits
+        else:
+            profiled = ProfiledDatabase(db)
+            if index is not None:
+                txnindex.attach(profiled, index)
+            current['db'] = profiled
+        try:
+            return f(*args, **kw)
+        finally:
+            current['db'] = db
+            txnindex.detach(profiled)
+            profiled.profile.report(sys.stdout)
+            if cached is not None:
+                cached.rebind(profiled.db)
+                print("%d cache hits" % (cached.hits - hits))
+
     for f in shell_commands:
         bound = bound_func(f)
         functools.update_wrapper(bound, f)
         ctxt[f.__name__] = bound
     ctxt['pprint'] = pprint.pprint
+    ctxt['profile'] = profile
     code.interact(local=ctxt, banner="Juju DB Shell")
 
 
-def invoke_action(client, db, targets):
+def watch(db, collection, entity, state, since, interval, output,
+          compact=False):
+    from juju_dbinspect.entities import iter_watch, Txn
+    from juju_dbinspect.output import write_lines
+    txns = iter_watch(db, collection, entity, state, since, interval)
+    try:
+        if output == "jsonl":
+            write_lines(
+                (Txn.record(t) for t in txns), compact=compact, flush=True)
+        else:
+            for t in txns:
+                Txn.format(t)
+                # Piped output is block buffered, show each txn as it comes.
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+def invoke_action(client, db, targets, options=None):
     """
     Drop into an interactive python shell::
       $ juju db shell
 
     Get the last n transactions (default 100) that have modified the
-    environment.
+    environment, newest first, optionally within a time window::
       $ juju db history n
+      $ juju db history --since 2014/03/06-19:31:00 --until 2014-03-07
+
+    History and the machines, services, units and relations listings
+    can be streamed as one json record per line, in _id order::
+      $ juju db history 0 -o jsonl --compact
+      $ juju db units -o jsonl
+
+    Save the collections used for introspection to a local snapshot
+    file, which can then be queried offline with --snapshot FILE::
+      $ juju db snapshot FILE
+      $ juju db --snapshot FILE mysql/0
 
     Get the names of all the services in the system::
       $ juju db services
@@ -66,6 +200,42 @@ def invoke_action(client, db, targets):
     Get the names of all the units in the system::
       $ juju db units
 
+    Get the relations of a service, optionally by interface and the
+    service's role in them::
+      $ juju db relations mysql
+      $ juju db relations mysql --interface mysql --role provider
+
+    Export the relation graph between services, with roles, interfaces
+    and unit counts, as json (the default) or graphviz dot::
+      $ juju db graph
+      $ juju db graph dot | dot -Tsvg > relations.svg
+
+    Find the relation settings and service config with a value matching
+    a regular expression, with the relation, role and unit or the
+    service each belongs to::
+      $ juju db grep 10.0.3.1
+      $ juju db grep '(?i)password' -o jsonl
+
+    Count transactions by state, collection and time, server side, and
+    list the oldest ones that haven't been applied or aborted::
+      $ juju db txn-stats
+      $ juju db txn-stats --since 2014-03-06
+
+    List the documents with more than n (default 10) txns queued on
+    them, longest first, with the states of the queued txns::
+      $ juju db txn-queues
+      $ juju db txn-queues 50 --limit 20
+
+    Follow the transaction log, optionally filtered by collection,
+    document id or state, as text or one json record per line::
+      $ juju db watch
+      $ juju db watch --collection statuses --state applied -o jsonl
+
+    Get the details on every machine, service and unit, or on the given
+    entities, with side documents fetched in bulk::
+      $ juju db status --all
+      $ juju db status 0 mysql mysql/0
+
     Get the details on machine 0::
       $ juju db 0
 
@@ -77,19 +247,129 @@ def invoke_action(client, db, targets):
 
     Get the relation settings for the mysql/0 unit in the wordpress relation::
       $ juju db mysql/0 wordpress
+
+    Run many targets, one per line in the syntax above, from a file or
+    stdin over one connection, writing a json record per line::
+      $ printf 'mysql/0\\nmysql/0 wordpress\\n' | juju db batch
+      $ juju db batch targets.txt --compact
+
+    Keep connections to the state servers and a document cache warm in
+    a daemon, which later commands are forwarded to while it runs::
+      $ juju db serve
+
+    Query several environments concurrently, results are keyed by
+    environment and streamed output is tagged with it::
+      $ juju db -e prod,staging status --all
+      $ juju db --all-environments units -o jsonl
     """
+    from juju_dbinspect.entities import (
+        machines, machine, units, unit, services, service, graph, grep,
+        history, iter_history, iter_ids, iter_relations, status,
+        txn_queues, txn_stats, Txn)
+    from juju_dbinspect.output import write_lines
+    from juju_dbinspect.snapshot import dump
+
+    listings = {
+        'units': units, 'machines': machines, 'services': services}
+    stream = getattr(options, 'output', 'text') == 'jsonl'
+    compact = getattr(options, 'compact', False)
+
     if targets[0] == "shell":
-        return shell(client, db)
-    elif targets[0] == "units":
-        return sorted(units(db))
+        return shell(
+            client, db, not getattr(options, 'no_cache', False),
+            getattr(options, 'lazy', False))
+    elif targets[0] in listings:
+        if stream:
+            write_lines(
+                ({'id': i} for i in iter_ids(db, targets[0])),
+                compact=compact)
+            return None
+        return sorted(listings[targets[0]](db))
     elif targets[0] == "relations":
-        return sorted(relations(db))
-    elif targets[0] == "machines":
-        return sorted(machines(db))
-    elif targets[0] == "services":
-        return sorted(services(db))
+        if len(targets) > 2:
+            raise ValueError("Too many params %s" % targets)
+        service_name = len(targets) > 1 and targets[1] or None
+        if service_name and not is_service(service_name):
+            raise ValueError("Invalid service %s" % service_name)
+        found = iter_relations(
+            db, service_name, getattr(options, 'interface', None),
+            getattr(options, 'role', None))
+        if stream:
+            write_lines(({'id': i} for i in found), compact=compact)
+            return None
+        return list(found)
     elif targets[0] == "history":
-        return history(db)
+        limit = getattr(options, 'limit', 100)
+        if len(targets) > 1:
+            if not targets[1].isdigit():
+                raise ValueError("Invalid history count %s" % targets[1])
+            limit = int(targets[1])
+        since = getattr(options, 'since', None)
+        until = getattr(options, 'until', None)
+        if stream:
+            write_lines(
+                (Txn.record(t) for t in iter_history(
+                    db, limit, since, until)),
+                compact=compact)
+            return None
+        return history(db, limit, since, until)
+    elif targets[0] == "graph":
+        fmt = len(targets) > 1 and targets[1] or "json"
+        if fmt == "dot":
+            print(graph(db).to_dot())
+            return None
+        elif fmt != "json":
+            raise ValueError("Invalid graph format %s" % fmt)
+        return graph(db).to_json()
+    elif targets[0] == "grep":
+        if len(targets) != 2:
+            raise ValueError("Grep requires a pattern %s" % targets)
+        found = grep(db, targets[1])
+        if stream:
+            write_lines(found, compact=compact)
+            return None
+        return found
+    elif targets[0] == "txn-stats":
+        return txn_stats(
+            db, getattr(options, 'since', None),
+            getattr(options, 'until', None))
+    elif targets[0] == "txn-queues":
+        threshold = 10
+        if len(targets) > 1:
+            if not targets[1].isdigit():
+                raise ValueError("Invalid queue length %s" % targets[1])
+            threshold = int(targets[1])
+        return txn_queues(db, threshold, getattr(options, 'limit', 100))
+    elif targets[0] == "watch":
+        return watch(
+            db, getattr(options, 'collection', None),
+            getattr(options, 'entity', None),
+            getattr(options, 'state', None),
+            getattr(options, 'since', None),
+            getattr(options, 'interval', 1.0),
+            getattr(options, 'output', 'text'), compact)
+    elif targets[0] == "status":
+        if len(targets) == 1 and not getattr(options, 'all', False):
+            raise ValueError("Status requires entities or --all")
+        return status(db, *targets[1:])
+    elif targets[0] == "batch":
+        from juju_dbinspect.batch import read_targets, run_batch
+        if len(targets) > 2:
+            raise ValueError("Too many params %s" % targets)
+        if len(targets) == 1 or targets[1] == "-":
+            target_lists = read_targets(sys.stdin)
+        else:
+            with open(targets[1]) as fh:
+                target_lists = read_targets(fh)
+        if run_batch(client, db, target_lists, options):
+            # Each failure is reported in its record.
+            sys.exit(1)
+        return None
+    elif targets[0] == "snapshot":
+        if len(targets) != 2:
+            raise ValueError("Snapshot requires a file path %s" % targets)
+        dump(db, targets[1])
+        return None
 
     if len(targets) == 1:
         t = targets.pop()
@@ -118,9 +398,91 @@ def invoke_action(client, db, targets):
     return unit(db, unit_id).relation_data(service_name)
 
 
+# Targets that can only run against one environment at a time, batch
+# reads its targets from stdin once.
+SINGLE_ENV_TARGETS = ('shell', 'snapshot', 'serve', 'batch')
+
+
+def forwarded(config, options):
+    """Run the targets on the juju db serve daemon, if it's running.
+
+    Returns False if they need to run locally.
+    """
+    import os
+    import socket
+    from juju_dbinspect import server
+    from juju_dbinspect.output import dumps
+
+    # The daemon's connections use the default read preference.
+    if (options.no_daemon or options.snapshot or options.txn_index or
+            options.profile or options.read_preference or
+            options.targets[0] in server.LOCAL_TARGETS or
+            not os.path.exists(config.socket_path)):
+        return False
+    try:
+        response = server.forward(
+            config.socket_path, config.get_env_name(), options.targets,
+            options)
+    except (ConfigError, socket.error), e:
+        log.debug("Not forwarding to daemon: %s", e)
+        return False
+    sys.stdout.write(response.get('output') or '')
+    if 'error' not in response:
+        if response['result'] is not None:
+            print dumps(response['result'], options.compact, indent=2)
+        return True
+    if response['kind'] == 'ValueError':
+        print("Invalid paramaters: %s" % response['error'])
+    elif response['kind'] == 'ConfigError':
+        print("Configuration error: %s" % response['error'])
+    else:
+        print("Error: %s" % response['error'])
+    sys.exit(1)
+
+
+def run_environments(config, env_names, options):
+    """Run the targets against each environment concurrently.
+
+    Returns the results keyed by environment name, and whether all the
+    environments succeeded.
+    """
+    import collections
+    from StringIO import StringIO
+    from juju_dbinspect.fanout import fan_out
+
+    if options.targets[0] in SINGLE_ENV_TARGETS:
+        raise ValueError(
+            "%s takes a single environment" % options.targets[0])
+    if options.txn_index:
+        raise ValueError("--txn-index takes a single environment")
+
+    def run(env_name):
+        log.debug("Connecting to %s...", env_name)
+        client, db = config.for_env(env_name).connect_db()
+        if options.profile:
+            from juju_dbinspect.profile import ProfiledDatabase
+            db = ProfiledDatabase(db)
+        try:
+            return invoke_action(client, db, list(options.targets), options)
+        finally:
+            if options.profile:
+                report = StringIO()
+                db.profile.report(report)
+                sys.stderr.write("%s:\n%s" % (env_name, report.getvalue()))
+            client.close()
+
+    results = fan_out(env_names, run, options.compact)
+    merged = collections.OrderedDict(
+        (e, r) for e, ok, r in results if r is not None)
+    return merged, all(ok for e, ok, r in results)
+
+
 def main():
     parser = setup_parser()
     options = parser.parse_args()
+
+    from juju_dbinspect import txnindex
+    from juju_dbinspect.config import Config
     config = Config(options)
 
     if config.verbose:
@@ -134,6 +496,38 @@ def main():
 
     logging.getLogger('requests').setLevel(level=logging.WARNING)
 
+    if options.targets[0] == "serve":
+        from juju_dbinspect.server import serve
+        try:
+            serve(config.socket_path, config)
+        except ConfigError, e:
+            print("Configuration error: %s" % str(e))
+            sys.exit(1)
+        return
+
+    from juju_dbinspect.output import dumps
+    try:
+        env_names = not options.snapshot and config.get_env_names() or []
+    except ConfigError, e:
+        print("Configuration error: %s" % str(e))
+        sys.exit(1)
+    if env_names and config.is_multi_env():
+        try:
+            results, ok = run_environments(config, env_names, options)
+        except ValueError, e:
+            print("Invalid paramaters: %s" % e)
+            sys.exit(1)
+        if results:
+            print dumps(results, options.compact, indent=2)
+        if not ok:
+            sys.exit(1)
+        return
+    if env_names:
+        config = config.for_env(env_names[0])
+
+    if forwarded(config, options):
+        return
+
     try:
         log.debug("Connecting to database...")
         client, db = config.connect_db()
@@ -142,16 +536,28 @@ def main():
         print("Configuration error: %s" % str(e))
         sys.exit(1)
 
-    import json
+    if options.profile:
+        from juju_dbinspect.profile import ProfiledDatabase
+        db = ProfiledDatabase(db)
+
+    if options.txn_index:
+        log.debug("Updating transaction index")
+        index = txnindex.TxnIndex(options.txn_index)
+        log.debug("Indexed %d transactions", index.update(db))
+        txnindex.attach(db, index)
+
     try:
         log.debug("Invoking action")
-        result = invoke_action(client, db, options.targets)
+        result = invoke_action(client, db, options.targets, options)
         if result is not None:
-            print json.dumps(result, indent=2)
+            print dumps(result, options.compact, indent=2)
         log.debug("Action complete")
     except ValueError, e:
         print("Invalid paramaters: %s" % e)
         sys.exit(1)
+    finally:
+        if options.profile:
+            db.profile.report(sys.stderr)
 
 if __name__ == '__main__':
     main()
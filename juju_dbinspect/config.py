@@ -3,33 +3,161 @@ import logging
 import json
 import subprocess
 import os
+import time
 
 import yaml
 
-from pymongo import MongoClient
+from pymongo import MongoClient, MongoReplicaSetClient, uri_parser
+from pymongo.errors import PyMongoError
 
 from juju_dbinspect.exceptions import ConfigError
+from juju_dbinspect.snapshot import open_snapshot
 
 
 VERSION_1_15 = LooseVersion("1.15.1")
 
+# Bumped when the format of cached uris changes, ie. to list every
+# state server and the replica set.
+CACHE_VERSION = 2
+
+# Inspection is read only, so reads go to a secondary when there is one
+# rather than adding to the primary's load.
+DEFAULT_READ_PREFERENCE = 'secondaryPreferred'
+
+# Targets that read from the primary by default, the shell is used to
+# check the current state.
+PRIMARY_TARGETS = ('shell',)
+
+# Milliseconds allowed for connecting to a state server while
+# discovering the replica set.
+DISCOVERY_TIMEOUT = 5000
+
 
 class Config(object):
 
-    def __init__(self, options):
+    # Seconds a resolved db uri and secret are cached for.
+    cache_ttl = 6 * 60 * 60
+
+    def __init__(self, options, env_name=None):
         self.options = options
+        self.env_name = env_name
+        self.cached = False
+
+    def for_env(self, env_name):
+        """Return the config of another environment, with the same options.
+        """
+        return self.__class__(self.options, env_name)
 
     def connect_db(self):
         """Return a websocket connection to the environment.
         """
+        if self.options.snapshot:
+            return None, open_snapshot(self.options.snapshot)
         uri, password = self.get_db_uri()
-        client = MongoClient(uri)
-        client.admin.authenticate('admin', password)
+        try:
+            client = self.connect(uri, password)
+        except PyMongoError, e:
+            if not self.cached:
+                raise
+            # Cached endpoint or secret may be stale, resolve afresh.
+            logging.debug("Cached connection failed (%s), resolving", e)
+            self.clear_cached_db_uri()
+            uri, password = self.get_db_uri()
+            client = self.connect(uri, password)
         return client, client.juju
 
+    def connect(self, uri, password):
+        """Return an authenticated client, reading per the read preference.
+        """
+        uri = with_option(uri, 'readPreference', self.read_preference)
+        logging.debug("Connecting to mongo @ %s" % uri)
+        if uri_parser.parse_uri(uri)['options'].get('replicaset'):
+            # Only the replica set client spreads reads over members.
+            client = MongoReplicaSetClient(uri)
+        else:
+            client = MongoClient(uri)
+        client.admin.authenticate('admin', password)
+        return client
+
+    @property
+    def read_preference(self):
+        if self.options.read_preference:
+            return self.options.read_preference
+        targets = self.options.targets or ()
+        if targets and targets[0] in PRIMARY_TARGETS:
+            return 'primary'
+        return DEFAULT_READ_PREFERENCE
+
     def get_db_uri(self):
+        """Return the db uri and secret, from the local cache if current.
+        """
+        cached = self.get_cached_db_uri()
+        self.cached = cached is not None
+        if cached:
+            logging.debug("Using cached connection to %s" % cached[0])
+            return cached
+        uri, secret = self.resolve_db_uri()
+        self.set_cached_db_uri(uri, secret)
+        return uri, secret
+
+    @property
+    def socket_path(self):
+        """The unix socket of the juju db serve daemon."""
+        return os.path.join(self.juju_home, 'dbinspect', 'serve.sock')
+
+    @property
+    def cache_path(self):
+        return os.path.join(
+            self.juju_home, 'dbinspect', '%s.cache' % self.get_env_name())
+
+    def get_env_mtime(self):
+        conf = os.path.join(
+            self.juju_home, 'environments', '%s.jenv' % self.get_env_name())
+        if not os.path.exists(conf):
+            return None
+        return os.stat(conf).st_mtime
+
+    def get_cached_db_uri(self):
+        """Get the cached uri and secret, if present, current and unexpired.
+        """
+        try:
+            with open(self.cache_path) as fh:
+                data = json.load(fh)
+        except (IOError, ValueError):
+            return None
+        if data.get('version') != CACHE_VERSION:
+            return None
+        if data.get('jenv-mtime') != self.get_env_mtime():
+            return None
+        if time.time() - data.get('created', 0) > self.cache_ttl:
+            return None
+        return data['uri'], data['secret']
+
+    def set_cached_db_uri(self, uri, secret):
+        """Cache the uri and secret, readable only by the current user.
+        """
+        cache_dir = os.path.dirname(self.cache_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        tmp = "%s.%d" % (self.cache_path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump({'uri': uri, 'secret': secret,
+                       'version': CACHE_VERSION,
+                       'jenv-mtime': self.get_env_mtime(),
+                       'created': time.time()}, fh)
+        os.rename(tmp, self.cache_path)
+
+    def clear_cached_db_uri(self):
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+    def resolve_db_uri(self):
+        """Resolve the db uri and secret from the environment and juju.
+        """
         env_data = self.get_env_state()
         env_name = self.get_env_name()
+        hosts = None
         # Prior to 1.17 or not bootstrapped
         if not env_data:
             version = self.get_version()
@@ -37,8 +165,8 @@ class Config(object):
                 output = subprocess.check_output(
                     ["juju", "api-endpoints", "--format", "json",
                      "-e", env_name])
-                host, port = json.loads(output)[0].split(":", 1)
-                env_data['bootstrap-host'] = host
+                hosts = [e.rsplit(":", 1)[0] for e in json.loads(output)]
+                env_data['bootstrap-host'] = hosts[0]
             # Fallback to status parsing.
             else:
                 output = subprocess.check_output(
@@ -49,6 +177,7 @@ class Config(object):
             env_data['admin-secret'] = env_conf['admin-secret']
         # if 1.17/1.18 hack around juju (this changed without notice in 1.17.6
         elif 'state-servers' in env_data:
+            hosts = [s.rsplit(":", 1)[0] for s in env_data['state-servers']]
             # db password only stored in old-password of agent.conf
             # http://pad.lv/1270434 marked won't fix/opinion.. whatever.
             output = subprocess.check_output([
@@ -56,12 +185,35 @@ class Config(object):
                 "sudo cat /var/lib/juju/agents/machine-0/agent.conf"])
             mdata = yaml.safe_load(output)
             env_data['admin-secret'] = mdata['oldpassword']
-            env_data['bootstrap-host'] = env_data['state-servers'][
-                0].split(":")[0]
-        uri = "mongodb://%(bootstrap-host)s:37017/juju?w=1&ssl=true" % env_data
-        logging.debug("Connecting to mongo @ %s" % uri)
+        if hosts is None:
+            hosts = [env_data['bootstrap-host']]
+        uri = "mongodb://%s/juju?w=1&ssl=true" % ",".join(
+            "%s:37017" % h for h in hosts)
+        replica_set = self.discover_replica_set(uri)
+        if replica_set:
+            uri = with_option(uri, 'replicaSet', replica_set)
+        logging.debug("Resolved mongo @ %s" % uri)
         return uri, env_data['admin-secret']
 
+    def discover_replica_set(self, uri):
+        """Return the replica set of the state servers, None if there is
+        none or no server answers.
+        """
+        parsed = uri_parser.parse_uri(uri)
+        ssl = parsed['options'].get('ssl', False)
+        for host, port in parsed['nodelist']:
+            try:
+                client = MongoClient(
+                    host, port, ssl=ssl, connectTimeoutMS=DISCOVERY_TIMEOUT)
+                try:
+                    # ismaster needs no auth, and any member answers it.
+                    return client.admin.command('ismaster').get('setName')
+                finally:
+                    client.close()
+            except PyMongoError, e:
+                logging.debug("State server %s unreachable %s", host, e)
+        return None
+
     @property
     def verbose(self):
         return self.options.verbose
@@ -78,8 +230,14 @@ class Config(object):
     def get_env_name(self):
         """Get the environment name.
         """
-        if self.options.environment:
-            return self.options.environment
+        if self.env_name:
+            return self.env_name
+        names = split_env_names(self.options.environment)
+        if len(names) > 1:
+            raise ConfigError(
+                "Multiple environments specified %s" % ", ".join(names))
+        elif names:
+            return names[0]
         elif os.environ.get("JUJU_ENV"):
             return os.environ['JUJU_ENV']
 
@@ -94,6 +252,39 @@ class Config(object):
                 raise ConfigError("No Environment specified")
             return conf['default']
 
+    def get_env_names(self):
+        """Get the names of the environments to operate on.
+        """
+        if self.options.all_environments:
+            return self.list_env_names()
+        return split_env_names(
+            self.options.environment) or [self.get_env_name()]
+
+    def is_multi_env(self):
+        """Whether the command runs per environment, with results and
+        output tagged by environment, however many are found.
+        """
+        return bool(self.options.all_environments or
+                    len(split_env_names(self.options.environment)) > 1)
+
+    def list_env_names(self):
+        """List the environments in environments.yaml and the jenv files.
+        """
+        names = set()
+        conf = os.path.join(self.juju_home, 'environments.yaml')
+        if os.path.exists(conf):
+            with open(conf) as fh:
+                data = yaml.safe_load(fh.read()) or {}
+            names.update(data.get('environments') or ())
+        env_dir = os.path.join(self.juju_home, 'environments')
+        if os.path.isdir(env_dir):
+            names.update(
+                f[:-len('.jenv')] for f in os.listdir(env_dir)
+                if f.endswith('.jenv'))
+        if not names:
+            raise ConfigError("No environments found in %s" % self.juju_home)
+        return sorted(names)
+
     def get_env_conf(self):
         """Get the environment config file.
         """
@@ -109,3 +300,23 @@ class Config(object):
             return {}
         with open(conf) as fh:
             return yaml.load(fh.read())
+
+
+def with_option(uri, name, value):
+    """Return uri with an option added to its query string."""
+    return "%s%s%s=%s" % (uri, '?' in uri and '&' or '?', name, value)
+
+
+def split_env_names(value):
+    """Split -e values, repeated or comma separated, into names."""
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = [value]
+    names = []
+    for v in value:
+        for name in v.split(','):
+            name = name.strip()
+            if name and name not in names:
+                names.append(name)
+    return names
@@ -3,14 +3,46 @@
 license: GPLv3
 author: kapil.foss at gmail dot com
 """
+import datetime
 import itertools
 import pprint
+import time
 from bson.objectid import ObjectId
 
+from juju_dbinspect import replay, search, txnstats
+from juju_dbinspect.graph import RelationGraph
+from juju_dbinspect.identity import is_machine, is_service, is_unit
+from juju_dbinspect.loader import BatchLoader
+from juju_dbinspect.query import (
+    find_in, relation_settings_query, relations_query)
+from juju_dbinspect.txnindex import txn_history
+from juju_dbinspect.txnlog import TxnTail
+
 
 OMIT = {'txn-queue': 0, 'txn-revno': 0}
 
 
+TIME_FORMATS = (
+    '%Y/%m/%d-%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y/%m/%d',
+    '%Y-%m-%d')
+
+
+def parse_time(value):
+    """Parse a UTC timestamp, in the format history output uses or iso.
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError("Invalid timestamp %s" % value)
+
+
 def empty_err(v, k):
     if v is None:
         raise ValueError("No entity found for %s" % k)
@@ -32,6 +64,12 @@ def shellfunc(f):
     return f
 
 
+def iter_ids(db, collection):
+    """Stream the ids of the documents in a collection, in _id order."""
+    for d in db[collection].find({}, {'_id': 1}, sort=[('_id', 1)]):
+        yield d['_id']
+
+
 @shellfunc
 def units(db):
     """Get the names of all units in the environment."""
@@ -80,14 +118,20 @@ def machine(db, mid):
     return m
 
 
+def iter_relations(db, service=None, interface=None, role=None):
+    """Stream the keys of the relations with an endpoint matching the
+    given service, interface and role, in _id order."""
+    for r in db.relations.find(
+            relations_query(service, interface, role), {'_id': 1},
+            sort=[('_id', 1)]):
+        yield r['_id']
+
+
 @shellfunc
-def relations(db, service=None):
-    """Get all the relations in the environment."""
-    rels = [i['_id'] for i in db.relations.find({}, {'_id': 1})]
-    if not service:
-        return rels
-    else:
-        return [r for r in rels if "%s:" % service in r]
+def relations(db, service=None, interface=None, role=None):
+    """Get the relations in the environment, optionally only those of a
+    service, and by interface and the service's role in them."""
+    return list(iter_relations(db, service, interface, role))
 
 
 @shellfunc
@@ -101,6 +145,19 @@ def relation(db, relation_ep):
     return m
 
 
+@shellfunc
+def grep(db, pattern):
+    """Find the relation settings and service config with a value
+    matching pattern, a regular expression."""
+    return search.search_settings(db, pattern)
+
+
+@shellfunc
+def graph(db):
+    """Get the graph of services and the relations between them."""
+    return RelationGraph.load(db)
+
+
 @shellfunc
 def charms(db):
     """Get all the charms in the environment."""
@@ -118,13 +175,175 @@ def charm(db, charm_url):
 
 
 @shellfunc
-def history(db, count=100):
-    """Retrieve last n transactions on the environment."""
-    size = db.txns.count()
-    for t in db.txns.find(skip=max((size-count), 0)):
+def history(db, count=100, since=None, until=None):
+    """Print the last n transactions on the environment, newest first."""
+    for t in iter_history(db, count, since, until):
         Txn.format(t)
 
 
+def iter_history(db, limit=100, since=None, until=None):
+    """Stream transactions newest first, bounded by generation time.
+
+    The bounds are applied as a range on the txn _id, so only the
+    requested window is walked regardless of the size of the log. A
+    limit of 0 streams the whole window.
+    """
+    spec = {}
+    bounds = {}
+    if since is not None:
+        bounds['$gte'] = ObjectId.from_datetime(parse_time(since))
+    if until is not None:
+        bounds['$lt'] = ObjectId.from_datetime(parse_time(until))
+    if bounds:
+        spec['_id'] = bounds
+    cursor = db.txns.find(spec, sort=[('_id', -1)])
+    if limit:
+        cursor = cursor.limit(limit)
+    for t in cursor:
+        yield t
+
+
+@shellfunc
+def txn_stats(db, since=None, until=None):
+    """Get txn counts by state, collection and time, and the oldest txns
+    that haven't been applied or aborted."""
+    if since is not None:
+        since = parse_time(since)
+    if until is not None:
+        until = parse_time(until)
+    spec = txnstats.window(since, until)
+    return {
+        'states': dict(
+            (Txn.state_labels.get(k, k), v)
+            for k, v in txnstats.state_counts(db, spec).items()),
+        'collections': txnstats.collection_counts(db, spec),
+        'times': [
+            {'start': start.strftime('%Y/%m/%d-%H:%M:%S'), 'count': count}
+            for start, count in txnstats.time_buckets(db, since, until)],
+        'unsettled': [
+            Txn.record(t) for t in txnstats.oldest_unsettled(db, spec)]}
+
+
+@shellfunc
+def txn_queues(db, threshold=10, limit=100):
+    """Get the documents with more than threshold txns queued on them,
+    longest queue first, with the states of the queued txns."""
+    backlog = txnstats.queue_backlog(db, threshold, limit)
+    states = txnstats.txn_states(
+        db, [t for c, d, queue in backlog for t in queue])
+    result = []
+    for c, d, queue in backlog:
+        counts = {}
+        for t in queue:
+            label = Txn.state_labels.get(states.get(t), 'missing')
+            counts[label] = counts.get(label, 0) + 1
+        result.append({
+            'collection': c, 'id': d, 'length': len(queue),
+            'states': counts, 'first': str(queue[0])})
+    return result
+
+
+@shellfunc
+def watch(db, collection=None, entity=None, state=None, interval=1.0):
+    """Print transactions as they are made, until interrupted."""
+    try:
+        for t in iter_watch(db, collection, entity, state, interval=interval):
+            Txn.format(t)
+    except KeyboardInterrupt:
+        pass
+
+
+def iter_watch(db, collection=None, entity=None, state=None, since=None,
+               interval=1.0, polls=None):
+    """Follow the transaction log, yielding txns as they are made.
+
+    A txn is yielded again each time its state changes, unless state
+    restricts the output to one state (a label or number). Each poll is
+    an _id range query from the last txn seen, so its cost is
+    independent of the size of the log.
+    """
+    spec = {}
+    if collection and entity:
+        spec['o'] = {'$elemMatch': {'c': collection, 'd': entity}}
+    elif collection:
+        spec['o.c'] = collection
+    elif entity:
+        spec['o.d'] = entity
+    if state is not None:
+        state = Txn.state_id(state)
+    start = None
+    if since is not None:
+        start = ObjectId.from_datetime(parse_time(since))
+    # Start following the log now, rather than on first iteration.
+    tail = TxnTail(db, spec, start=start)
+
+    def follow():
+        count = 0
+        while True:
+            for t in tail.poll():
+                if state is None or t['s'] == state:
+                    yield t
+            count += 1
+            if polls is not None and count >= polls:
+                return
+            time.sleep(interval)
+    return follow()
+
+
+@shellfunc
+def status(db, *targets):
+    """Get the formatted details of the given machines, services and units.
+
+    With no targets every entity in the environment is included. Side
+    documents are fetched in bulk, so the number of queries is constant
+    rather than proportional to the number of entities.
+    """
+    groups = [('machines', Machine, is_machine),
+              ('services', Service, is_service),
+              ('units', Unit, is_unit)]
+    result = {}
+    for collection, cls, matcher in groups:
+        fields = OMIT if cls is Service else omit('nonce', 'passwordhash')
+        if targets:
+            ids = [t for t in targets if matcher(t)]
+            docs = find_in(
+                db[collection], '_id', ids, fields, as_class=cls)
+        else:
+            docs = db[collection].find({}, fields, as_class=cls)
+        entities = list(docs)
+        for e in entities:
+            e.db = db
+        result[collection] = dict(
+            (e.id, f) for e, f in zip(entities, bulk_formatted(db, entities)))
+    return result
+
+
+def bulk_formatted(db, entities):
+    """Return the formatted dicts of entities, with batched side lookups.
+    """
+    keys = set()
+    for e in entities:
+        keys.update(e._side_keys())
+    prefetched = dict.fromkeys(keys)
+    by_collection = {}
+    for collection, key in keys:
+        by_collection.setdefault(collection, []).append(key)
+    for collection, ids in by_collection.items():
+        for doc in find_in(db[collection], '_id', ids, OMIT):
+            prefetched[(collection, doc.pop('_id'))] = doc
+
+    machine_ids = [e.id for e in entities if isinstance(e, Machine)]
+    for mid in machine_ids:
+        prefetched[('units', mid)] = []
+    for u in find_in(
+            db.units, 'machineid', machine_ids, {'_id': 1, 'machineid': 1}):
+        prefetched[('units', u['machineid'])].append(u['_id'])
+
+    for e in entities:
+        e.prefetched = prefetched
+    return [e.formatted for e in entities]
+
+
 @shellfunc
 def stats(db):
     stats = db.command({'dbstats': 1})
@@ -139,27 +358,74 @@ class Base(dict):
     def id(self):
         return self['_id']
 
+    def as_dict(self):
+        """Return the document as a plain dict, see rawbson."""
+        return dict(self)
+
 
 class Entity(Base):
     __slots__ = ()
 
+    @property
+    def global_key(self):
+        return "%s#%s" % (self.ref_letter, self.id)
+
+    def _batch(self):
+        loader = getattr(self, 'loader', None)
+        if loader is None:
+            loader = self.loader = BatchLoader(self.db, [self])
+        return loader
+
+    def _side_doc(self, collection, key):
+        # Side documents may have been fetched in bulk, see bulk_formatted.
+        prefetched = getattr(self, 'prefetched', None)
+        if prefetched is not None and (collection, key) in prefetched:
+            return prefetched[(collection, key)]
+        return self.db[collection].find_one({"_id": key}, omit('_id'))
+
+    def _side_keys(self):
+        return [('constraints', self.global_key),
+                ('statuses', self.global_key)]
+
     @property
     def constraints(self):
-        return self.db.constraints.find_one(
-            {"_id": "%s#%s" % (self.ref_letter, self.id)}, omit('_id'))
+        return self._side_doc('constraints', self.global_key)
 
     @property
     def status(self):
-        return self.db.statuses.find_one(
-            {"_id": "%s#%s" % (self.ref_letter, self.id)}, omit('_id'))
+        return self._side_doc('statuses', self.global_key)
 
     @property
     def formatted(self):
-        d = dict(self)
+        d = self.as_dict()
         d['constraints'] = self.constraints
         d['status'] = self.status
         return d
 
+    def _history_docs(self):
+        return [(self.collection, self.id)] + self._side_keys()
+
+    def at(self, when):
+        """Reconstruct this entity as it was at a past time (UTC), by
+        replaying the transaction log. None if it didn't exist then.
+        """
+        doc = replay.document_at(
+            self.db, self.collection, self.id, parse_time(when))
+        if doc is None:
+            return None
+        for k in omit('nonce', 'passwordhash'):
+            doc.pop(k, None)
+        # The replayed doc is decoded, a lazy entity's class needs raw.
+        e = getattr(self.__class__, '_plain_class', self.__class__)(doc)
+        e.db = self.db
+        return e
+
+    def history(self):
+        """Print the transactions that modified this entity, oldest first.
+        """
+        for t in txn_history(self.db, self._history_docs()):
+            Txn.format(t)
+
 
 class RelationEndpoint(Entity):
     __slots__ = ()
@@ -174,22 +440,24 @@ class RelationEndpoint(Entity):
 
     @property
     def relations(self):
-        rels = self.db.relations.find(
-            {'endpoints': {'$elemMatch': {
-                'servicename': self.service_name}}},
-            OMIT)
-        return list(rels)
+        return self._batch().children(
+            self, 'relations', 'endpoints.servicename', fields=OMIT,
+            entity_key=lambda e: e.service_name,
+            doc_keys=lambda r: set(
+                ep['servicename'] for ep in r['endpoints']))
 
     @property
     def related_services(self):
-        related = []
+        names = []
         for r in self.relations:
             if len(r['endpoints']) == 1:
                 continue
             for ep in r['endpoints']:
                 if ep['servicename'] != self.service_name:
-                    related.append(service(self.db, ep['servicename']))
-        return related
+                    names.append(ep['servicename'])
+        found = dict((s.id, s) for s in self._batch().many(
+            'services', set(names), Service, OMIT))
+        return [empty_err(found.get(n), n) for n in names]
 
 
 def _invert_role(ep):
@@ -201,13 +469,16 @@ def _invert_role(ep):
 
 
 class Unit(RelationEndpoint):
-    __slots__ = ('db',)
+    __slots__ = ('db', 'prefetched', 'loader')
 
     ref_letter = "u"
+    collection = "units"
 
     @property
     def service(self):
-        return service(self.db, self['service'])
+        return empty_err(
+            self._batch().one(self, 'services', 'service', Service, OMIT),
+            self['service'])
 
     def relation_data(self, spec):
         found = False
@@ -224,30 +495,41 @@ class Unit(RelationEndpoint):
         u_rid = "r#%s#%s#%s" % (r['id'], self_role, self.id)
         return self.db.settings.find_one({"_id": u_rid}, omit("_id"))
 
+    def _history_docs(self):
+        docs = super(Unit, self)._history_docs()
+        for r in self.relations:
+            for ep in r['endpoints']:
+                if ep['servicename'] == self.service_name:
+                    docs.append(('settings', "r#%s#%s#%s" % (
+                        r['id'], ep['relation']['role'], self.id)))
+        return docs
+
 
 class Service(RelationEndpoint):
-    __slots__ = ('db',)
+    __slots__ = ('db', 'prefetched', 'loader')
 
     ref_letter = "s"
+    collection = "services"
 
     @property
-    def config(self):
-        conf_key = "%s#%s#%s" % (
+    def config_key(self):
+        return "%s#%s#%s" % (
             self.ref_letter,
             self.id,
             self.charm_url)
-        return self.db.settings.find_one(
-            {"_id": conf_key}, omit("_id"))
+
+    @property
+    def config(self):
+        return self._side_doc('settings', self.config_key)
+
+    def _side_keys(self):
+        return super(Service, self)._side_keys() + [
+            ('settings', self.config_key)]
 
     @property
     def units(self):
-        units = []
-        for u in self.db.units.find(
-                {"service": self.id}, omit('nonce', 'passwordhash'),
-                as_class=Unit):
-            u.db = self.db
-            units.append(u)
-        return units
+        return self._batch().children(
+            self, 'units', 'service', Unit, omit('nonce', 'passwordhash'))
 
     @property
     def formatted(self):
@@ -263,44 +545,62 @@ class Relation(Base):
         return [u.rsplit('#', 1)[1] for u in self._unit_rel_ids()]
 
     def _unit_rel_ids(self):
-        r_id = 'r#%d#' % self['id']
-        # This can be fulfilled from index, but a prefix begin/end
-        # would be faster.
         return [u['_id'] for u in self.db.settings.find(
-            {'_id': {'$regex': '^%s.*' % r_id}}, {"_id": 1})]
+            relation_settings_query(self['id']), {"_id": 1})]
+
+    def at(self, when):
+        """Reconstruct the relation settings of each unit as they were at
+        a past time (UTC), by replaying the transaction log.
+        """
+        when = parse_time(when)
+        settings = {}
+        for key in self._unit_rel_ids():
+            doc = replay.document_at(self.db, 'settings', key, when)
+            if doc is not None:
+                doc.pop('_id')
+                settings[key.rsplit('#', 1)[1]] = doc
+        return settings
 
     def history(self):
         # Won't include deleted units, would need to iterate
         # full set of units based on svc seq.
-        q = self.db.txns.find(
-            {"o.c": "settings", 'o.d': {'$in': self._unit_rel_ids()}})
-        for t in q:
+        docs = [('settings', u) for u in self._unit_rel_ids()]
+        for t in txn_history(self.db, docs):
             Txn.format(t)
 
 
 class Machine(Entity):
-    __slots__ = ('db',)
+    __slots__ = ('db', 'prefetched', 'loader')
 
     ref_letter = "m"
+    collection = "machines"
 
     @property
     def units(self):
-        units = []
-        for unit in self.db.units.find(
-                {'machineid': self.id}, OMIT, as_class=Unit):
-            unit.db = self.db
-            units.append(unit)
-        return units
+        return self._batch().children(self, 'units', 'machineid', Unit, OMIT)
+
+    @property
+    def unit_ids(self):
+        prefetched = getattr(self, 'prefetched', None)
+        if prefetched is not None and ('units', self.id) in prefetched:
+            return prefetched[('units', self.id)]
+        return [u['_id'] for u in self.db.units.find(
+            {'machineid': self.id}, {'_id': 1})]
 
     @property
     def formatted(self):
         d = super(Machine, self).formatted
-        d['units'] = [u['_id'] for u in self.units]
+        d['units'] = self.unit_ids
         return d
 
 
 class Charm(Entity):
-    __slots__ = ('db',)
+    __slots__ = ('db', 'loader')
+
+    collection = "charms"
+
+    def _side_keys(self):
+        return []
 
     @property
     def config(self):
@@ -308,12 +608,8 @@ class Charm(Entity):
 
     @property
     def services(self):
-        services = []
-        for svc in self.db.services.find(
-                {'charmurl': self.id}, OMIT, as_class=Service):
-            svc.db = self.db
-            services.append(svc)
-        return services
+        return self._batch().children(
+            self, 'services', 'charmurl', Service, OMIT)
 
 
 class Txn(dict):
@@ -327,6 +623,39 @@ class Txn(dict):
         5: 'aborted',
         6: 'applied'}
 
+    @classmethod
+    def state_id(cls, state):
+        """Resolve a state label or number to the state number."""
+        for k, v in cls.state_labels.items():
+            if state in (k, v, str(k)):
+                return k
+        raise ValueError("Invalid transaction state %s" % state)
+
+    @classmethod
+    def record(cls, txn):
+        """Return a structured representation of a transaction."""
+        ops = []
+        for o in txn['o']:
+            op = {'collection': o['c'], 'id': o['d']}
+            if 'i' in o:
+                op['op'], op['value'] = 'create', o['i']
+            elif 'u' in o:
+                op['op'], op['value'] = 'update', o['u']
+            elif 'a' in o:
+                op['op'], op['value'] = 'cond', o['a']
+            elif 'r' in o:
+                op['op'] = 'remove'
+            else:
+                raise AssertionError(
+                    "Invalid Transaction Operation %s" % o)
+            ops.append(op)
+        return {
+            'id': str(txn['_id']),
+            'time': ObjectId(txn['_id']).generation_time.strftime(
+                '%Y/%m/%d-%H:%M:%S'),
+            'state': cls.state_labels[txn['s']],
+            'ops': ops}
+
     @classmethod
     def format(cls, txn):
         print ObjectId(txn['_id']).generation_time.strftime(
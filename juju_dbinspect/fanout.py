@@ -0,0 +1,116 @@
+"""
+Run a command against several environments concurrently.
+
+Each environment gets a worker thread that connects to its state server
+and runs the command, so connection setup, which may shell out to juju,
+and the queries of the environments overlap. Returned results are
+merged into a mapping by environment name, and output printed by the
+workers is tagged line by line with the environment it came from, as a
+prefix for text or an "environment" field for json lines.
+"""
+import json
+import logging
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from juju_dbinspect.output import COMPACT
+
+
+# Environments connected to and queried at once.
+WORKERS = 16
+
+log = logging.getLogger("juju-db")
+
+
+def tag_line(env_name, line, compact=False):
+    """Tag a line of output with the environment it came from."""
+    if line.startswith('{') and line.endswith('}'):
+        key, sep = COMPACT[1], COMPACT[0]
+        if not compact:
+            key, sep = key + ' ', sep + ' '
+        rest = line[1:]
+        if rest.strip() == '}':
+            sep = ''
+        return '{%s%s%s%s%s' % (
+            json.dumps('environment'), key, json.dumps(env_name), sep, rest)
+    return '%s: %s' % (env_name, line)
+
+
+class TaggedOutput(object):
+    """A stream shared by the environment workers.
+
+    Complete lines written by a worker are tagged with its environment,
+    output from other threads passes through.
+    """
+
+    def __init__(self, out, compact=False):
+        self.out = out
+        self.compact = compact
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def bind(self, env_name):
+        """Tag the current thread's output with env_name."""
+        self.local.env_name = env_name
+        self.local.pending = ''
+
+    def write(self, data):
+        env_name = getattr(self.local, 'env_name', None)
+        if env_name is None:
+            with self.lock:
+                self.out.write(data)
+            return
+        lines = (self.local.pending + data).split('\n')
+        self.local.pending = lines.pop()
+        if lines:
+            with self.lock:
+                for line in lines:
+                    self.out.write(
+                        tag_line(env_name, line, self.compact) + '\n')
+
+    def release(self):
+        """Write out the current thread's unterminated output, if any."""
+        pending = getattr(self.local, 'pending', '')
+        if pending:
+            self.write('\n')
+        self.local.env_name = None
+
+    def flush(self):
+        with self.lock:
+            self.out.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+
+def fan_out(env_names, func, compact=False, workers=WORKERS):
+    """Call func(env_name) for each environment concurrently.
+
+    Returns a list of (env_name, ok, result) tuples in the order of
+    env_names. An environment whose call fails isn't ok and has a result
+    of {'error': message}, so one unreachable environment doesn't hide
+    the others.
+    """
+    output = TaggedOutput(sys.stdout, compact)
+
+    def run(env_name):
+        output.bind(env_name)
+        try:
+            return True, func(env_name)
+        except Exception, e:
+            log.debug("Environment %s failed", env_name, exc_info=True)
+            return False, {'error': "%s: %s" % (e.__class__.__name__, e)}
+        finally:
+            output.release()
+
+    original, sys.stdout = sys.stdout, output
+    pool = ThreadPool(min(workers, len(env_names)) or 1)
+    try:
+        results = pool.map(run, env_names, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        sys.stdout = original
+    return [(env_name, ok, result)
+            for env_name, (ok, result) in zip(env_names, results)]
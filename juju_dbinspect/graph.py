@@ -0,0 +1,91 @@
+"""
+Service relation graph.
+
+The graph is built from one scan of the services collection, for unit
+counts and charms, and one scan of the relations collection, whose
+endpoints carry each side's service, role and interface, so the cost is
+two queries regardless of the size of the environment.
+"""
+
+
+class RelationGraph(object):
+
+    def __init__(self):
+        # service name -> {'charm', 'units'}
+        self.services = {}
+        # relation key -> {'id', 'interface', 'units', 'endpoints'}
+        self.relations = {}
+        # service name -> {related service name -> [relation key]}
+        self.adjacency = {}
+
+    @classmethod
+    def load(cls, db):
+        graph = cls()
+        for s in db.services.find(
+                {}, {'charmurl': 1, 'unitcount': 1}, sort=[('_id', 1)]):
+            graph.add_service(s['_id'], s.get('charmurl'), s.get('unitcount'))
+        for r in db.relations.find(
+                {}, {'id': 1, 'unitcount': 1, 'endpoints': 1},
+                sort=[('_id', 1)]):
+            graph.add_relation(r)
+        return graph
+
+    def add_service(self, name, charm=None, units=None):
+        self.services[name] = {'charm': charm, 'units': units}
+        self.adjacency.setdefault(name, {})
+
+    def add_relation(self, doc):
+        endpoints = [
+            {'service': ep['servicename'],
+             'name': ep['relation']['name'],
+             'role': ep['relation']['role']}
+            for ep in doc['endpoints']]
+        interface = doc['endpoints'][0]['relation']['interface']
+        self.relations[doc['_id']] = {
+            'id': doc.get('id'), 'interface': interface,
+            'units': doc.get('unitcount'), 'endpoints': endpoints}
+        names = [ep['service'] for ep in endpoints]
+        for name in names:
+            if name not in self.services:
+                # Relations can outlive a service that is being removed.
+                self.add_service(name)
+        for name in names:
+            for other in names:
+                if other != name or len(names) == 1:
+                    self.adjacency[name].setdefault(other, []).append(
+                        doc['_id'])
+
+    def related(self, service):
+        """Return the services related to service, and via which relations.
+        """
+        return self.adjacency[service]
+
+    def to_json(self):
+        return {'services': self.services, 'relations': self.relations}
+
+    def to_dot(self):
+        lines = ['graph relations {']
+        for name, s in sorted(self.services.items()):
+            label = name
+            if s['units'] is not None:
+                label = "%s\\n%d units" % (name, s['units'])
+            lines.append('  %s [label=%s];' % (_quote(name), _quote(label)))
+        for key, r in sorted(self.relations.items()):
+            eps = r['endpoints']
+            left, right = eps[0], eps[-1]
+            label = r['interface']
+            if len(eps) == 1:
+                label = "%s (peer)" % label
+            else:
+                label = "%s:%s %s:%s" % (
+                    left['role'], left['name'], right['role'], right['name'])
+                label = "%s\\n%s" % (r['interface'], label)
+            lines.append('  %s -- %s [label=%s];' % (
+                _quote(left['service']), _quote(right['service']),
+                _quote(label)))
+        lines.append('}')
+        return "\n".join(lines)
+
+
+def _quote(value):
+    return '"%s"' % value.replace('"', '\\"')
@@ -16,3 +16,18 @@ def is_unit(s):
 
 def is_service(s):
     return bool(SERVICE_REGEX.match(s))
+
+
+def settings_owner(key):
+    """Decode the owner of a settings document from its _id.
+
+    Relation settings are keyed r#<relation id>#<role>#<unit> and
+    service config s#<service>#<charm url>. Returns None for other keys.
+    """
+    parts = key.split('#', 3)
+    if parts[0] == 'r' and len(parts) == 4 and parts[1].isdigit():
+        return {'relation_id': int(parts[1]), 'role': parts[2],
+                'unit': parts[3]}
+    if parts[0] == 's' and len(parts) >= 3:
+        return {'service': parts[1], 'charm': key.split('#', 2)[2]}
+    return None
@@ -0,0 +1,95 @@
+"""
+Batched resolution of entity traversals.
+
+Entities loaded together share a `BatchLoader`. The first time a
+related lookup is made from one of them (ie. `Service.units`), the
+loader resolves it for every entity of the same kind in the batch with
+one $in query, and answers the rest from memory. The entities it
+returns share a new loader in turn, so walking the topology costs a
+query per level rather than a query per entity.
+
+Results are memoized for the lifetime of the loaded entities, fetch the
+entity again to see later changes.
+"""
+from juju_dbinspect.query import find_in
+
+
+def _entity_id(e):
+    return e.id
+
+
+def _field_keys(field):
+    def keys(doc):
+        value = doc
+        for part in field.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        return [value]
+    return keys
+
+
+class BatchLoader(object):
+
+    def __init__(self, db, entities=()):
+        self.db = db
+        self.entities = list(entities)
+        self._docs = {}
+        self._groups = {}
+
+    def _siblings(self, entity):
+        return [e for e in self.entities if type(e) is type(entity)]
+
+    def _bind(self, docs):
+        loader = BatchLoader(self.db, docs)
+        for d in docs:
+            if hasattr(type(d), 'loader'):
+                d.db = self.db
+                d.loader = loader
+        return docs
+
+    def many(self, collection, ids, cls=dict, fields=None):
+        """Get documents by id, in the order of ids, skipping missing ones.
+        """
+        missing = set(
+            i for i in ids if (collection, i) not in self._docs)
+        if missing:
+            found = self._bind(list(find_in(
+                self.db[collection], '_id', missing, fields, as_class=cls)))
+            for i in missing:
+                self._docs[(collection, i)] = None
+            for d in found:
+                self._docs[(collection, d['_id'])] = d
+        return [self._docs[(collection, i)] for i in ids
+                if self._docs[(collection, i)] is not None]
+
+    def one(self, entity, collection, field, cls=dict, fields=None):
+        """Get the document whose id is entity[field], batched over siblings.
+        """
+        key = entity[field]
+        if (collection, key) not in self._docs:
+            self.many(
+                collection,
+                [e[field] for e in self._siblings(entity) if field in e],
+                cls, fields)
+        found = self.many(collection, [key], cls, fields)
+        return found[0] if found else None
+
+    def children(self, entity, collection, field, cls=dict, fields=None,
+                 entity_key=_entity_id, doc_keys=None):
+        """Get the documents whose field refers to entity.
+
+        entity_key gives the value the field holds for an entity and
+        doc_keys the entity keys a document belongs to, by default the
+        value of field.
+        """
+        group = (collection, field)
+        if group not in self._groups:
+            doc_keys = doc_keys or _field_keys(field)
+            grouped = {}
+            keys = [entity_key(e) for e in self._siblings(entity)]
+            docs = self._bind(list(find_in(
+                self.db[collection], field, keys, fields, as_class=cls)))
+            for d in docs:
+                for k in doc_keys(d):
+                    grouped.setdefault(k, []).append(d)
+            self._groups[group] = grouped
+        return list(self._groups[group].get(entity_key(entity), ()))
@@ -0,0 +1,38 @@
+"""
+Structured output.
+
+Results are written as json, either as a single document or as json
+lines, one record per line, written as each record arrives from the
+cursor so memory use doesn't grow with the size of the environment.
+"""
+import json
+import sys
+
+from bson import json_util
+
+
+COMPACT = (',', ':')
+
+
+def dumps(value, compact=False, indent=None):
+    """Serialize value, including bson types, to json."""
+    if compact:
+        return json.dumps(
+            value, default=json_util.default, separators=COMPACT)
+    return json.dumps(value, default=json_util.default, indent=indent)
+
+
+def write_lines(records, out=None, compact=False, flush=False):
+    """Write each record as a line of json, returning the count written.
+
+    flush pushes each line out as it is written, for followed output.
+    """
+    out = out or sys.stdout
+    count = 0
+    for r in records:
+        out.write(dumps(r, compact))
+        out.write('\n')
+        if flush:
+            out.flush()
+        count += 1
+    return count
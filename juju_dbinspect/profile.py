@@ -0,0 +1,227 @@
+"""
+Query instrumentation.
+
+`ProfiledDatabase` wraps a db handle and records each query made
+through it: the collection, operation, filter shape, documents and
+bytes returned, an estimate of the round trips and the wall time spent
+fetching results. `Profile.report` summarizes them, with the hottest
+query shapes first.
+"""
+import time
+
+from bson import BSON
+
+
+# Documents in the first reply to a query, and bytes per subsequent
+# reply, used to estimate the getmore round trips a cursor makes.
+FIRST_BATCH = 101
+BATCH_BYTES = 4 * 1024 * 1024
+
+
+def shape(spec):
+    """Return the shape of a query document, with values elided."""
+    if isinstance(spec, dict):
+        return dict((k, shape(v) if k.startswith('$') or isinstance(
+            v, dict) else '?') for k, v in spec.items())
+    if isinstance(spec, (list, tuple)):
+        if spec and isinstance(spec[0], dict):
+            return [shape(s) for s in spec]
+        return '[%d]' % len(spec)
+    return '?'
+
+
+def _key(value):
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(
+            '%s: %s' % (k, _key(v)) for k, v in sorted(value.items()))
+    if isinstance(value, list):
+        return '[%s]' % ', '.join(_key(v) for v in value)
+    return str(value)
+
+
+class Query(object):
+
+    def __init__(self, collection, op, spec):
+        self.collection = collection
+        self.op = op
+        self.shape = _key(shape(spec or {}))
+        self.docs = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def round_trips(self):
+        if self.docs <= FIRST_BATCH:
+            return 1
+        remaining = self.bytes * (self.docs - FIRST_BATCH) // self.docs
+        return 1 + max(1, -(-remaining // BATCH_BYTES))
+
+    def record(self, doc, elapsed):
+        self.elapsed += elapsed
+        if doc is not None:
+            self.docs += 1
+            self.bytes += len(BSON.encode(doc))
+
+
+class Profile(object):
+
+    def __init__(self):
+        self.queries = []
+        self.started = time.time()
+
+    def add(self, collection, op, spec):
+        q = Query(collection, op, spec)
+        self.queries.append(q)
+        return q
+
+    def summary(self):
+        """Aggregate the queries by collection, operation and shape."""
+        groups = {}
+        for q in self.queries:
+            k = (q.collection, q.op, q.shape)
+            g = groups.setdefault(k, {
+                'collection': q.collection, 'op': q.op, 'filter': q.shape,
+                'queries': 0, 'round_trips': 0, 'docs': 0, 'bytes': 0,
+                'elapsed': 0.0})
+            g['queries'] += 1
+            g['round_trips'] += q.round_trips
+            g['docs'] += q.docs
+            g['bytes'] += q.bytes
+            g['elapsed'] += q.elapsed
+        return sorted(groups.values(), key=lambda g: -g['elapsed'])
+
+    def report(self, out, top=10):
+        """Write each query, followed by the hottest query shapes."""
+        for q in self.queries:
+            out.write("%-12s %-8s %6d docs %9d bytes %8.2fms %s\n" % (
+                q.collection, q.op, q.docs, q.bytes, q.elapsed * 1000,
+                q.shape))
+        summary = self.summary()
+        out.write(
+            "\n%d queries, ~%d round trips, %d docs, %d bytes, %.2fms "
+            "in queries, %.2fms total\n" % (
+                len(self.queries),
+                sum(q.round_trips for q in self.queries),
+                sum(q.docs for q in self.queries),
+                sum(q.bytes for q in self.queries),
+                sum(q.elapsed for q in self.queries) * 1000,
+                (time.time() - self.started) * 1000))
+        out.write("\nHottest queries\n")
+        for g in summary[:top]:
+            out.write(
+                "%4dx %-12s %-8s ~%d round trips %6d docs %9d bytes "
+                "%8.2fms %s\n" % (
+                    g['queries'], g['collection'], g['op'],
+                    g['round_trips'], g['docs'], g['bytes'],
+                    g['elapsed'] * 1000, g['filter']))
+
+
+class ProfiledDatabase(object):
+
+    def __init__(self, db, profile=None):
+        self.db = db
+        self.profile = profile or Profile()
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(self.db, name)
+        if hasattr(attr, 'find_one'):
+            return self[name]
+        return attr
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = ProfiledCollection(
+                self.profile, self.db[name])
+        return self._collections[name]
+
+    def command(self, spec, *args, **kw):
+        q = self.profile.add('$cmd', 'command', spec)
+        start = time.time()
+        result = self.db.command(spec, *args, **kw)
+        q.record(result, time.time() - start)
+        return result
+
+
+class ProfiledCollection(object):
+
+    def __init__(self, profile, collection):
+        self.profile = profile
+        self.collection = collection
+        self.name = collection.name
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def find_one(self, spec_or_id=None, *args, **kw):
+        spec = spec_or_id
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        q = self.profile.add(self.name, 'find_one', spec)
+        start = time.time()
+        doc = self.collection.find_one(spec_or_id, *args, **kw)
+        q.record(doc, time.time() - start)
+        return doc
+
+    def find(self, *args, **kw):
+        spec = args[0] if args else kw.get('spec')
+        return ProfiledCursor(
+            self.profile.add(self.name, 'find', spec),
+            self.collection.find(*args, **kw))
+
+    def count(self):
+        q = self.profile.add(self.name, 'count', None)
+        start = time.time()
+        result = self.collection.count()
+        q.record(None, time.time() - start)
+        return result
+
+    def aggregate(self, pipeline, *args, **kw):
+        q = self.profile.add(self.name, 'aggregate', pipeline)
+        start = time.time()
+        result = self.collection.aggregate(pipeline, *args, **kw)
+        q.record(result, time.time() - start)
+        return result
+
+
+class ProfiledCursor(object):
+
+    def __init__(self, query, cursor):
+        self._query = query
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kw):
+            result = attr(*args, **kw)
+            # Cursor modifiers return the cursor, keep profiling it.
+            if result is self._cursor:
+                return self
+            return result
+        return wrapper
+
+    def count(self, *args, **kw):
+        q = self._query
+        q.op = 'count'
+        start = time.time()
+        result = self._cursor.count(*args, **kw)
+        q.elapsed += time.time() - start
+        return result
+
+    def __iter__(self):
+        q = self._query
+        it = iter(self._cursor)
+        while True:
+            start = time.time()
+            try:
+                doc = next(it)
+            except StopIteration:
+                q.elapsed += time.time() - start
+                return
+            q.record(doc, time.time() - start)
+            yield doc
@@ -0,0 +1,84 @@
+"""
+Query helpers for juju's structured document ids.
+
+Juju encodes ownership into string _ids, ie. relation settings are keyed
+as r#<relation id>#<role>#<unit> and service settings as
+s#<service>#<charm url>. Lookups by such a prefix are expressed as a
+$gte/$lt range on _id, which mongo answers from the _id index rather
+than by evaluating a regex against every key.
+"""
+import sys
+
+
+def prefix_bounds(prefix):
+    """Return the (begin, end) bounds of all strings starting with prefix.
+    """
+    if not prefix:
+        raise ValueError("Empty prefix")
+    end = prefix
+    while end:
+        last = ord(end[-1])
+        if last < sys.maxunicode:
+            return prefix, end[:-1] + unichr(last + 1)
+        end = end[:-1]
+    raise ValueError("Unbounded prefix %r" % prefix)
+
+
+def prefix_query(prefix, field='_id'):
+    """Return a query spec matching values of field starting with prefix.
+    """
+    begin, end = prefix_bounds(prefix)
+    return {field: {'$gte': begin, '$lt': end}}
+
+
+def relation_prefix(relation_id, role=None):
+    """Return the settings key prefix for a relation, optionally a role.
+    """
+    prefix = 'r#%d#' % relation_id
+    if role:
+        prefix += '%s#' % role
+    return prefix
+
+
+def relation_settings_query(relation_id, role=None):
+    """Return a query spec for the unit settings documents of a relation.
+    """
+    return prefix_query(relation_prefix(relation_id, role))
+
+
+def relations_query(service=None, interface=None, role=None):
+    """Return a query spec for the relations with an endpoint matching
+    the given service, interface and role.
+
+    The conditions apply to the same endpoint, so role is the role of
+    service in the relation.
+    """
+    endpoint = {}
+    if service:
+        endpoint['servicename'] = service
+    if interface:
+        endpoint['relation.interface'] = interface
+    if role:
+        endpoint['relation.role'] = role
+    if len(endpoint) < 2:
+        return dict(('endpoints.%s' % k, v) for k, v in endpoint.items())
+    return {'endpoints': {'$elemMatch': endpoint}}
+
+
+# Bounds the size of $in query documents sent to the server.
+IN_BATCH_SIZE = 1000
+
+
+def batched(values, size=IN_BATCH_SIZE):
+    """Split values into lists of at most size items."""
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def find_in(collection, field, values, fields=None, **kw):
+    """Yield documents whose field is in values, one $in query per batch.
+    """
+    for chunk in batched(set(values)):
+        for doc in collection.find({field: {'$in': chunk}}, fields, **kw):
+            yield doc
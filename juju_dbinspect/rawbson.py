@@ -0,0 +1,284 @@
+"""
+Entities backed by raw BSON.
+
+Decoded documents cost several times their BSON size in memory, mostly
+in fields that are rarely looked at, like a unit's tools or a charm's
+config. A lazy entity keeps its document as the raw BSON string and
+decodes a field the first time it is accessed, keeping the entity
+property API.
+
+`LazyDatabase` wraps a db handle, so entities fetched through it with
+an `as_class` are lazy::
+
+  >>> db = LazyDatabase(db)
+  >>> units = service(db, 'mysql').units
+
+Iterating over a lazy entity, or comparing it, decodes it in full.
+`dict(entity)` doesn't see undecoded fields, use `entity.as_dict()`.
+"""
+import struct
+
+from bson import BSON
+from bson.objectid import ObjectId
+
+
+INT32 = struct.Struct("<i")
+INT64 = struct.Struct("<q")
+DOUBLE = struct.Struct("<d")
+
+# Sizes of the values of fixed width BSON types.
+FIXED_SIZES = {
+    0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4,
+    0x11: 8, 0x12: 8, 0x13: 16, 0xFF: 0, 0x7F: 0}
+
+
+def _value_size(data, kind, pos):
+    if kind in FIXED_SIZES:
+        return FIXED_SIZES[kind]
+    if kind in (0x02, 0x0D, 0x0E):
+        # string, code, symbol
+        return 4 + INT32.unpack_from(data, pos)[0]
+    if kind in (0x03, 0x04, 0x0F):
+        # document, array, code with scope
+        return INT32.unpack_from(data, pos)[0]
+    if kind == 0x05:
+        return 5 + INT32.unpack_from(data, pos)[0]
+    if kind == 0x0B:
+        return data.find('\x00', data.find('\x00', pos) + 1) + 1 - pos
+    if kind == 0x0C:
+        return 16 + INT32.unpack_from(data, pos)[0]
+    raise ValueError("Unknown BSON type 0x%02x" % kind)
+
+
+def iter_elements(data, offset=0):
+    """Yield (name, type, start, value start, end) of each element of the
+    BSON document at offset in data, a string or mmap.
+
+    Only the element headers are read, values aren't decoded.
+    """
+    pos = offset + 4
+    end = offset + INT32.unpack_from(data, offset)[0] - 1
+    while pos < end:
+        kind = ord(data[pos])
+        name_end = data.find('\x00', pos + 1)
+        value = name_end + 1
+        next_pos = value + _value_size(data, kind, value)
+        yield data[pos + 1:name_end], kind, pos, value, next_pos
+        pos = next_pos
+
+
+def elements(data):
+    """Yield the (name, start, end) of each element of a BSON document."""
+    for name, kind, start, value, end in iter_elements(data):
+        yield name, start, end
+
+
+def find_element(data, key):
+    """Return the (start, end) of the element named key, or None."""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    for name, kind, start, value, end in iter_elements(data):
+        if name == key:
+            return start, end
+    return None
+
+
+def decode_element(data, start, end):
+    """Decode the value of the element between start and end."""
+    element = data[start:end]
+    doc = BSON(INT32.pack(len(element) + 5) + element + '\x00').decode()
+    return doc.values()[0]
+
+
+SCALARS = {
+    0x01: lambda data, pos: DOUBLE.unpack_from(data, pos)[0],
+    0x02: lambda data, pos: data[
+        pos + 4:pos + 3 + INT32.unpack_from(data, pos)[0]].decode('utf-8'),
+    0x07: lambda data, pos: ObjectId(data[pos:pos + 12]),
+    0x08: lambda data, pos: data[pos] == '\x01',
+    0x0A: lambda data, pos: None,
+    0x10: lambda data, pos: INT32.unpack_from(data, pos)[0],
+    0x12: lambda data, pos: INT64.unpack_from(data, pos)[0],
+}
+
+
+def decode_value(data, kind, start, value, end):
+    """Decode an element given its iter_elements position."""
+    if kind in SCALARS:
+        return SCALARS[kind](data, value)
+    return decode_element(data, start, end)
+
+
+class LazyDocument(object):
+    """Mixin for dicts holding a raw BSON document, see lazy_class.
+
+    Fields are decoded into the dict on first access.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_raw(cls, data):
+        d = cls()
+        d.raw = data
+        return d
+
+    def __missing__(self, key):
+        found = find_element(self.raw, key)
+        if found is None:
+            raise KeyError(key)
+        value = decode_element(self.raw, *found)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def _decode_all(self):
+        for name, start, end in elements(self.raw):
+            name = name.decode('utf-8')
+            if not dict.__contains__(self, name):
+                dict.__setitem__(
+                    self, name, decode_element(self.raw, start, end))
+
+    def as_dict(self):
+        self._decode_all()
+        return dict(self)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (
+            find_element(self.raw, key) is not None)
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        self._decode_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._decode_all()
+        return dict.__len__(self)
+
+    def __eq__(self, other):
+        self._decode_all()
+        if isinstance(other, LazyDocument):
+            other._decode_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._decode_all()
+        return dict.__repr__(self)
+
+    def __delitem__(self, key):
+        self._decode_all()
+        dict.__delitem__(self, key)
+
+
+def _decoding(name):
+    method = getattr(dict, name)
+
+    def wrapper(self, *args):
+        self._decode_all()
+        return method(self, *args)
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ('keys', 'values', 'items', 'iterkeys', 'itervalues',
+              'iteritems', 'pop', 'popitem', 'copy'):
+    setattr(LazyDocument, _name, _decoding(_name))
+
+
+_lazy_classes = {}
+
+
+def lazy_class(cls):
+    """Return the lazy variant of a dict subclass, ie. an entity class."""
+    if cls not in _lazy_classes:
+        _lazy_classes[cls] = type(
+            'Lazy%s' % cls.__name__, (LazyDocument, cls),
+            {'__slots__': ('raw',), '__module__': cls.__module__,
+             '_plain_class': cls})
+    return _lazy_classes[cls]
+
+
+def lazy(cls, doc):
+    """Return doc as a lazy instance of cls."""
+    return lazy_class(cls).from_raw(BSON.encode(doc))
+
+
+def _is_lazy(as_class):
+    return as_class not in (None, dict) and issubclass(as_class, dict)
+
+
+class LazyDatabase(object):
+
+    def __init__(self, db):
+        self.db = db
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(self.db, name)
+        if hasattr(attr, 'find_one'):
+            return self[name]
+        return attr
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = LazyCollection(self.db[name])
+        return self._collections[name]
+
+
+class LazyCollection(object):
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.name = collection.name
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def find_one(self, spec_or_id=None, fields=None, as_class=None, **kw):
+        if not _is_lazy(as_class):
+            return self.collection.find_one(
+                spec_or_id, fields, as_class=as_class or dict, **kw)
+        doc = self.collection.find_one(spec_or_id, fields, **kw)
+        return doc if doc is None else lazy(as_class, doc)
+
+    def find(self, *args, **kw):
+        as_class = kw.get('as_class')
+        if not _is_lazy(as_class):
+            return self.collection.find(*args, **kw)
+        del kw['as_class']
+        return LazyCursor(self.collection.find(*args, **kw), as_class)
+
+
+class LazyCursor(object):
+
+    def __init__(self, cursor, as_class):
+        self._cursor = cursor
+        self._as_class = as_class
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kw):
+            result = attr(*args, **kw)
+            # Cursor modifiers return the cursor, keep wrapping it.
+            if result is self._cursor:
+                return self
+            return result
+        return wrapper
+
+    def __iter__(self):
+        for doc in self._cursor:
+            yield lazy(self._as_class, doc)
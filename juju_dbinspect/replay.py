@@ -0,0 +1,214 @@
+"""
+Point in time reconstruction of documents.
+
+Txns record the inserts, updates and removals of each document, so the
+state of a document at a past time can be rebuilt by replaying the
+applied operations on it, oldest first. Replayed states are kept as
+checkpoints every few txns, so asking for a nearby time only replays
+the txns since the closest earlier checkpoint.
+"""
+import bisect
+import collections
+import copy
+import datetime
+import threading
+
+from bson.objectid import ObjectId
+
+from juju_dbinspect.snapshot import matches
+from juju_dbinspect.txnindex import txn_history
+from juju_dbinspect.txnlog import TERMINAL_STATES
+
+
+APPLIED = 6
+
+# Txns on a document between checkpoints of its state.
+CHECKPOINT_INTERVAL = 50
+
+# Documents whose checkpoints are kept.
+MAX_DOCUMENTS = 100
+
+# The state of a document before its first txn in the log. Its insert
+# may have been pruned from the log, so updates then apply to a
+# document holding only the _id.
+UNKNOWN = object()
+
+
+def document_at(db, collection, doc_id, when):
+    """Return the document as it was after the txns made up to when.
+
+    Returns None if the document didn't exist then.
+    """
+    key = (id(db), collection, doc_id)
+    # A replayer is taken out while in use, a concurrent request for the
+    # same document, ie. in the daemon, replays with its own.
+    with _lock:
+        replayer = _replayers.pop(key, None)
+    if replayer is None:
+        replayer = Replayer(db, collection, doc_id)
+    doc = replayer.at(when)
+    with _lock:
+        _replayers[key] = replayer
+        while len(_replayers) > MAX_DOCUMENTS:
+            _replayers.popitem(last=False)
+    return None if doc is UNKNOWN else doc
+
+
+_replayers = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+class Replayer(object):
+    """Replays the txns on one document, keeping checkpoints."""
+
+    def __init__(self, db, collection, doc_id,
+                 interval=CHECKPOINT_INTERVAL):
+        self.db = db
+        self.collection = collection
+        self.doc_id = doc_id
+        self.interval = interval
+        # Parallel lists of txn ids, and the state after that txn.
+        self.checkpoint_ids = []
+        self.checkpoints = []
+        self.replayed = 0
+
+    def at(self, when):
+        # Txn ids have a resolution of a second, include the txns made
+        # during the second of when.
+        until = ObjectId.from_datetime(
+            when.replace(microsecond=0) + datetime.timedelta(seconds=1))
+        i = bisect.bisect_left(self.checkpoint_ids, until)
+        bounds = {'$lt': until}
+        doc = UNKNOWN
+        if i:
+            bounds['$gt'] = self.checkpoint_ids[i - 1]
+            doc = copy.deepcopy(self.checkpoints[i - 1])
+        settled = True
+        count = 0
+        for t in txn_history(
+                self.db, [(self.collection, self.doc_id)], bounds):
+            self.replayed += 1
+            if t['s'] not in TERMINAL_STATES:
+                # Checkpoints past a txn that may yet apply would go stale.
+                settled = False
+            if t['s'] != APPLIED:
+                continue
+            for op in t['o']:
+                if op['c'] == self.collection and op['d'] == self.doc_id:
+                    doc = apply_op(doc, op)
+            count += 1
+            if settled and count % self.interval == 0:
+                self._checkpoint(t['_id'], doc)
+        return doc
+
+    def _checkpoint(self, txn_id, doc):
+        if doc is UNKNOWN:
+            # The sentinel doesn't survive a copy, replay from the start.
+            return
+        i = bisect.bisect_left(self.checkpoint_ids, txn_id)
+        if i < len(self.checkpoint_ids) and self.checkpoint_ids[i] == txn_id:
+            return
+        self.checkpoint_ids.insert(i, txn_id)
+        self.checkpoints.insert(i, copy.deepcopy(doc))
+
+
+def apply_op(doc, op):
+    """Return doc after a txn operation on it, None once removed."""
+    if 'i' in op:
+        if doc is None or doc is UNKNOWN:
+            doc = copy.deepcopy(op['i'])
+            doc['_id'] = op['d']
+        return doc
+    elif 'r' in op:
+        return None
+    elif 'u' in op:
+        if doc is None:
+            return None
+        if not any(k.startswith('$') for k in op['u']):
+            # A replacement document.
+            doc = copy.deepcopy(op['u'])
+            doc['_id'] = op['d']
+            return doc
+        if doc is UNKNOWN:
+            doc = {'_id': op['d']}
+        apply_update(doc, op['u'])
+    return doc
+
+
+def apply_update(doc, update):
+    """Apply a mongo update document to doc, in place."""
+    for operator, changes in update.items():
+        if operator not in UPDATE_OPERATORS:
+            raise NotImplementedError(
+                "Update operator not supported %s" % operator)
+        for path, value in changes.items():
+            parent, key = _parent(doc, path, operator != '$unset')
+            if parent is not None:
+                UPDATE_OPERATORS[operator](parent, key, value)
+
+
+def _parent(doc, path, create):
+    parts = path.split('.')
+    parent = doc
+    for part in parts[:-1]:
+        if isinstance(parent, list) and part.isdigit():
+            parent = parent[int(part)]
+            continue
+        if part not in parent:
+            if not create:
+                return None, None
+            parent[part] = {}
+        parent = parent[part]
+    last = parts[-1]
+    if isinstance(parent, list) and last.isdigit():
+        last = int(last)
+    return parent, last
+
+
+def _set(parent, key, value):
+    parent[key] = copy.deepcopy(value)
+
+
+def _unset(parent, key, value):
+    if isinstance(parent, list):
+        parent[key] = None
+    else:
+        parent.pop(key, None)
+
+
+def _inc(parent, key, value):
+    parent[key] = parent.get(key, 0) + value
+
+
+def _add_to_set(parent, key, value):
+    values = parent.setdefault(key, [])
+    if isinstance(value, dict) and '$each' in value:
+        new = value['$each']
+    else:
+        new = [value]
+    for v in new:
+        if v not in values:
+            values.append(copy.deepcopy(v))
+
+
+def _pull(parent, key, cond):
+    if key not in parent:
+        return
+    parent[key] = [v for v in parent[key] if not _pulled(v, cond)]
+
+
+def _pulled(value, cond):
+    if isinstance(cond, dict) and cond:
+        if all(k.startswith('$') for k in cond):
+            return matches({'v': value}, {'v': cond})
+        return isinstance(value, dict) and matches(value, cond)
+    return value == cond
+
+
+UPDATE_OPERATORS = {
+    '$set': _set,
+    '$unset': _unset,
+    '$inc': _inc,
+    '$addToSet': _add_to_set,
+    '$pull': _pull,
+}
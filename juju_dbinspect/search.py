@@ -0,0 +1,98 @@
+"""
+Search the values of relation settings and service config.
+
+Settings values aren't indexed, and their keys vary by charm, so they
+can't be searched server side without a scan either. The settings _id
+keyspace is instead split into prefix ranges, r#<first digit of the
+relation id> and s#<first letter of the service>, each answered from
+the _id index, and the ranges are fetched and searched concurrently so
+the round trips and decoding of one overlap with the others.
+"""
+import re
+import string
+from multiprocessing.pool import ThreadPool
+
+from juju_dbinspect.identity import settings_owner
+from juju_dbinspect.query import prefix_query
+
+
+# Concurrent range scans.
+WORKERS = 8
+
+# Relation ids are decimal without leading zeros, service names start
+# with a lowercase letter.
+SETTINGS_PREFIXES = (
+    ['r#%s' % d for d in string.digits] +
+    ['s#%s' % c for c in string.ascii_lowercase])
+
+# Fields juju's txn machinery adds to each document.
+SKIPPED = ('_id', 'txn-queue', 'txn-revno')
+
+
+def settings_ranges():
+    """Return the _id range queries covering relation and service settings.
+    """
+    return [prefix_query(p) for p in SETTINGS_PREFIXES]
+
+
+def matching_values(doc, pattern):
+    """Return the fields of doc whose values match pattern, a compiled re.
+
+    Nested values are flattened to dotted keys.
+    """
+    found = {}
+    for key, value in doc.items():
+        if key in SKIPPED:
+            continue
+        _match_value(key, value, pattern, found)
+    return found
+
+
+def _match_value(key, value, pattern, found):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            _match_value('%s.%s' % (key, k), v, pattern, found)
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            _match_value('%s.%d' % (key, i), v, pattern, found)
+    else:
+        text = value if isinstance(value, basestring) else unicode(value)
+        if pattern.search(text):
+            found[key] = value
+
+
+def search_range(collection, spec, pattern):
+    """Return the settings matching pattern within one _id range."""
+    results = []
+    for doc in collection.find(spec, {'txn-queue': 0, 'txn-revno': 0}):
+        found = matching_values(doc, pattern)
+        if found:
+            results.append({
+                'id': doc['_id'], 'owner': settings_owner(doc['_id']),
+                'matches': found})
+    return results
+
+
+def search_settings(db, pattern, workers=WORKERS):
+    """Return the settings documents with a value matching pattern.
+
+    Each result holds the document id, its decoded owner, and the
+    matching fields, in _id order. The pattern is compiled once, for all
+    the range scans, and raises ValueError if it's invalid.
+    """
+    if isinstance(pattern, basestring):
+        try:
+            pattern = re.compile(pattern)
+        except re.error, e:
+            raise ValueError("Invalid pattern %r: %s" % (pattern, e))
+    collection = db.settings
+    pool = ThreadPool(workers)
+    try:
+        found = pool.map(
+            lambda spec: search_range(collection, spec, pattern),
+            settings_ranges(), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return sorted((r for results in found for r in results),
+                  key=lambda r: r['id'])
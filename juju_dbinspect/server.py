@@ -0,0 +1,213 @@
+"""
+Resident daemon holding warm connections.
+
+`juju db serve` listens on a unix socket, by default
+$JUJU_HOME/dbinspect/serve.sock, and keeps an authenticated client and
+a document cache per environment. When the socket exists the cli
+forwards its targets to the daemon instead of resolving the state
+server, which may shell out to juju, and connecting afresh.
+
+The protocol is json lines, one request and one response per line,
+over a connection that can carry many requests::
+
+  {"environment": "prod", "targets": ["mysql/0"], "options": {...}}
+  {"result": {...}, "output": ""}
+  {"error": "No entity found for mysql/9", "kind": "ValueError"}
+
+Output a target prints, like history or jsonl listings, is returned in
+the response's output rather than streamed.
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+from StringIO import StringIO
+
+from juju_dbinspect.exceptions import ConfigError
+from juju_dbinspect.output import dumps
+
+
+log = logging.getLogger("juju-db")
+
+# Targets run by the cli itself, they need its terminal or files.
+LOCAL_TARGETS = ('shell', 'watch', 'snapshot', 'batch', 'serve')
+
+# Options sent along with the targets.
+FORWARDED_OPTIONS = (
+    'limit', 'since', 'until', 'collection', 'entity', 'state', 'output',
+    'compact', 'all', 'interface', 'role')
+
+
+class ThreadOutput(object):
+    """Stdout capturing what each request thread prints separately."""
+
+    def __init__(self, out):
+        self.out = out
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = StringIO()
+
+    def release(self):
+        value = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return value
+
+    def write(self, data):
+        buf = getattr(self.local, 'buffer', None)
+        (buf or self.out).write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+
+class Environment(object):
+    """A connection to an environment, and the cache over it."""
+
+    def __init__(self, client, db):
+        self.client = client
+        # The cache is locked, requests on an environment run
+        # concurrently.
+        self.db = db
+
+
+class Server(SocketServer.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, config):
+        self.config = config
+        self.environments = {}
+        self.lock = threading.Lock()
+        self.output = ThreadOutput(sys.stdout)
+        SocketServer.ThreadingUnixStreamServer.__init__(
+            self, path, Handler)
+
+    def environment(self, env_name):
+        with self.lock:
+            env = self.environments.get(env_name)
+            if env is None:
+                log.info("Connecting to %s", env_name)
+                from juju_dbinspect.cache import CachedDatabase
+                client, db = self.config.for_env(env_name).connect_db()
+                if client is not None:
+                    db = CachedDatabase(db)
+                env = self.environments[env_name] = Environment(client, db)
+            return env
+
+    def answer(self, request):
+        """Return the response to a request."""
+        from juju_dbinspect.cli import invoke_action
+        targets = request.get('targets') or []
+        if not targets or targets[0] in LOCAL_TARGETS:
+            return {'error': "Can't serve %s" % targets,
+                    'kind': 'ValueError'}
+        options = argparse.Namespace(**request.get('options', {}))
+        try:
+            env = self.environment(request.get('environment'))
+        except Exception, e:
+            log.warning("Connecting failed %s", e)
+            return {'error': str(e), 'kind': e.__class__.__name__}
+        self.output.capture()
+        try:
+            result = invoke_action(env.client, env.db, targets, options)
+        except Exception, e:
+            log.debug("Request %s failed", targets, exc_info=True)
+            return {'error': str(e), 'kind': e.__class__.__name__,
+                    'output': self.output.release()}
+        return {'result': result, 'output': self.output.release()}
+
+    def serve(self):
+        original, sys.stdout = sys.stdout, self.output
+        try:
+            self.serve_forever()
+        finally:
+            sys.stdout = original
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {'error': "Invalid request", 'kind': 'ValueError'}
+            else:
+                response = self.server.answer(request)
+            self.wfile.write(dumps(response, compact=True))
+            self.wfile.write('\n')
+            self.wfile.flush()
+
+
+def serve(path, config):
+    """Listen on path until interrupted."""
+    if os.path.exists(path):
+        if is_running(path):
+            raise ConfigError("Already serving on %s" % path)
+        os.remove(path)
+    sock_dir = os.path.dirname(path)
+    if not os.path.exists(sock_dir):
+        os.makedirs(sock_dir, 0700)
+    # The socket hands out db access, keep it to the current user.
+    umask = os.umask(0177)
+    try:
+        server = Server(path, config)
+    finally:
+        os.umask(umask)
+    log.info("Serving on %s", path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def is_running(path):
+    try:
+        connect(path).close()
+    except socket.error:
+        return False
+    return True
+
+
+def forward(path, env_name, targets, options):
+    """Send targets to the daemon, returning its response.
+
+    Raises socket.error if the daemon isn't reachable.
+    """
+    options = dict(
+        (k, getattr(options, k)) for k in FORWARDED_OPTIONS
+        if getattr(options, k, None) is not None)
+    sock = connect(path)
+    try:
+        fh = sock.makefile('rwb')
+        fh.write(dumps(
+            {'environment': env_name, 'targets': targets,
+             'options': options}, compact=True))
+        fh.write('\n')
+        fh.flush()
+        line = fh.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise socket.error("Connection closed by %s" % path)
+    return json.loads(line)
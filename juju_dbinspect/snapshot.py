@@ -0,0 +1,890 @@
+"""
+Offline snapshots of the juju database.
+
+A snapshot is a single file holding the collections the entity helpers
+query, stored as concatenated BSON documents so it can be memory mapped
+and decoded a collection at a time, or for the txn log, queried in
+place. `SnapshotDatabase` exposes the
+subset of the pymongo `Database`/`Collection` interface the entity
+helpers use, so every function in `juju_dbinspect.entities` can run
+against a snapshot in place of a live state server.
+
+File layout::
+
+   MAGIC | header offset (int64) | collection data ... | header (BSON)
+
+The header records the offset, length and document count of each
+collection.
+"""
+import bisect
+import datetime
+import itertools
+import mmap
+import operator
+import os
+import re
+import struct
+
+from bson import BSON, decode_all
+
+from juju_dbinspect import rawbson
+
+
+MAGIC = "JUJUDBSNAP1\n"
+OFFSET = struct.Struct("<q")
+DOC_SIZE = struct.Struct("<i")
+LONG = struct.Struct("<q")
+DOUBLE = struct.Struct("<d")
+
+SNAPSHOT_COLLECTIONS = (
+    "units", "services", "machines", "relations", "settings",
+    "statuses", "constraints", "charms", "txns")
+
+# Collections kept as raw BSON. Documents are prefiltered by searching
+# their buffers for the encoded values a query requires, and only the
+# candidates are decoded. The txn log is most of a snapshot, largely op
+# payloads history queries don't look at.
+RAW_COLLECTIONS = ("txns",)
+
+# Queries on more than 1/SCAN_RATIO of a raw collection search the whole
+# collection for their needles, rather than each candidate document.
+SCAN_RATIO = 16
+
+
+def dump(db, path, collections=SNAPSHOT_COLLECTIONS):
+    """Write the given collections of db to a snapshot file at path.
+
+    The snapshot holds settings and credentials, it's readable by the
+    current user only, and only appears at path once complete.
+    """
+    index = {}
+    tmp = "%s.%d" % (path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            _write_snapshot(db, fh, collections, index)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+    return index
+
+
+def _write_snapshot(db, fh, collections, index):
+    fh.write(MAGIC)
+    fh.write(OFFSET.pack(0))
+    for name in collections:
+        start = fh.tell()
+        count = 0
+        for doc in db[name].find():
+            fh.write(BSON.encode(doc))
+            count += 1
+        index[name] = [start, fh.tell() - start, count]
+    header_offset = fh.tell()
+    fh.write(BSON.encode({
+        'version': 1,
+        'created': datetime.datetime.utcnow(),
+        'collections': index}))
+    fh.seek(len(MAGIC))
+    fh.write(OFFSET.pack(header_offset))
+
+
+def open_snapshot(path):
+    """Open a snapshot file for reading."""
+    return SnapshotDatabase(path)
+
+
+class SnapshotDatabase(object):
+    """Read only, pymongo compatible view of a snapshot file."""
+
+    name = "juju"
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fh:
+            self._buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a juju db snapshot %s" % path)
+        header_offset = OFFSET.unpack_from(self._buf, len(MAGIC))[0]
+        self.header = BSON(self._buf[header_offset:]).decode()
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            start, length, count = self.header['collections'].get(
+                name, (0, 0, 0))
+            self._collections[name] = SnapshotCollection(
+                name, self._buf, start, length)
+        return self._collections[name]
+
+    def collection_names(self):
+        return sorted(self.header['collections'])
+
+    def command(self, spec):
+        if 'dbstats' in spec:
+            return {
+                'db': self.name,
+                'snapshot': self.path,
+                'created': self.header['created'],
+                'collections': len(self.header['collections']),
+                'objects': sum(
+                    c[2] for c in self.header['collections'].values()),
+                'dataSize': len(self._buf)}
+        raise NotImplementedError(
+            "Command not supported on snapshots %s" % spec)
+
+
+class SnapshotCollection(object):
+
+    def __init__(self, name, buf, start, length):
+        self.name = name
+        self._buf = buf
+        self._start = start
+        self._length = length
+        self._raw = name in RAW_COLLECTIONS
+        self._docs = None
+        self._offsets = None
+        self._starts = None
+
+    def _load(self):
+        if self._offsets is not None:
+            return
+        docs, ids, offsets = [], [], []
+        pos, end = self._start, self._start + self._length
+        while pos < end:
+            size = DOC_SIZE.unpack_from(self._buf, pos)[0]
+            if self._raw:
+                ids.append(_raw_id(self._buf, pos))
+            else:
+                doc = BSON(self._buf[pos:pos + size]).decode()
+                docs.append(doc)
+                ids.append(doc['_id'])
+            offsets.append((pos, size))
+            pos += size
+        if not self._raw:
+            self._docs = docs
+        self._by_id = dict((d, i) for i, d in enumerate(ids))
+        self._ids = sorted((_sort_key(d), i) for i, d in enumerate(ids))
+        # Set last, it marks the collection loaded for other threads.
+        self._offsets = offsets
+
+    def _doc(self, i):
+        if self._docs is not None:
+            return self._docs[i]
+        pos, size = self._offsets[i]
+        return BSON(self._buf[pos:pos + size]).decode()
+
+    def _decode(self):
+        """Decode a raw collection in full, for the queries that follow."""
+        # One call decodes the collection's contiguous documents.
+        self._docs = decode_all(
+            self._buf[self._start:self._start + self._length])
+        self._raw = False
+
+    def _selective(self, positions, spec, limit):
+        """Whether scanning raw documents beats decoding the collection.
+
+        It does for few candidates, or a limited query without
+        conditions, or conditions on strings, like document ids, that
+        few txns contain. Numbers, like txn states, are in every txn.
+        """
+        if len(positions) * SCAN_RATIO <= len(self._offsets):
+            return True
+        if not spec:
+            return bool(limit)
+        return _selective_needles(needles(spec))
+
+    def _scan(self, positions, spec):
+        """Yield the documents at positions matching spec, of a raw
+        collection.
+
+        Documents are prefiltered by the needles of spec, then matched
+        on the top level fields spec refers to, and only decoded in
+        full if they match.
+        """
+        if not spec:
+            for i in positions:
+                yield self._doc(i)
+            return
+        spec_needles = needles(spec)
+        if spec_needles and len(positions) * SCAN_RATIO > len(self._offsets):
+            # Cheaper to search the whole collection for the needles.
+            hits = self._hits(spec_needles)
+            positions = [i for i in positions if i in hits]
+            spec_needles = None
+        fields = _top_level(spec)
+        for i in positions:
+            pos, size = self._offsets[i]
+            if spec_needles and not _prefilter(
+                    self._buf, pos, pos + size, spec_needles):
+                continue
+            if matches(_decode_fields(self._buf, pos, fields), spec):
+                yield self._doc(i)
+
+    def _hits(self, spec_needles):
+        """Return the positions of the documents containing the needles."""
+        hits = None
+        for alternatives in spec_needles:
+            if isinstance(alternatives, _AnyOf):
+                found = set()
+                for clause in alternatives:
+                    found.update(self._hits(clause))
+            else:
+                found = self._search(alternatives)
+            hits = found if hits is None else hits & found
+        return hits
+
+    def _search(self, alternatives):
+        """Return the positions of the documents containing any of the
+        alternative byte strings."""
+        if self._starts is None:
+            self._starts = [pos for pos, size in self._offsets]
+        starts = self._starts
+        pattern = re.compile("|".join(re.escape(a) for a in alternatives))
+        found = set()
+        pos, end = self._start, self._start + self._length
+        while True:
+            m = pattern.search(self._buf, pos, end)
+            if m is None:
+                return found
+            i = bisect.bisect_right(starts, m.start()) - 1
+            found.add(i)
+            # Continue from the next document.
+            pos = starts[i + 1] if i + 1 < len(starts) else end
+
+
+    def _candidates(self, spec, by_id=False):
+        """Positions of documents that may match spec.
+
+        Positions are in _id order when the _id index is used, or when
+        by_id is set, otherwise in natural order.
+        """
+        self._load()
+        if '_id' not in spec:
+            if by_id:
+                return [i for k, i in self._ids]
+            return range(len(self._offsets))
+        cond = spec['_id']
+        if not isinstance(cond, dict) or not any(
+                k.startswith('$') for k in cond):
+            pos = self._by_id.get(cond)
+            return [] if pos is None else [pos]
+        if '$in' in cond:
+            return [i for k, i in sorted(
+                (_sort_key(v), self._by_id[v]) for v in set(cond['$in'])
+                if v in self._by_id)]
+        lo, hi = 0, len(self._ids)
+        if '$gte' in cond:
+            lo = bisect.bisect_left(self._ids, (_sort_key(cond['$gte']),))
+        elif '$gt' in cond:
+            lo = bisect.bisect_right(
+                self._ids, (_sort_key(cond['$gt']), len(self._offsets)))
+        if '$lt' in cond:
+            hi = bisect.bisect_left(self._ids, (_sort_key(cond['$lt']),))
+        elif '$lte' in cond:
+            hi = bisect.bisect_right(
+                self._ids, (_sort_key(cond['$lte']), len(self._offsets)))
+        return [i for k, i in self._ids[lo:hi]]
+
+    def find(self, spec=None, fields=None, skip=0, limit=0, sort=None,
+             as_class=None, **kw):
+        return SnapshotCursor(
+            self, spec or {}, fields, skip, limit, sort, as_class or dict)
+
+    def find_one(self, spec_or_id=None, *args, **kw):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for doc in self.find(spec_or_id, *args, **kw).limit(1):
+            return doc
+        return None
+
+    def count(self):
+        self._load()
+        return len(self._offsets)
+
+    def aggregate(self, pipeline, **kw):
+        """Run an aggregation pipeline, in the mongo 2.4 result format.
+
+        Supports the $match, $project, $unwind, $group, $sort, $skip
+        and $limit stages, with $sum, $min, $max and $first accumulators.
+        """
+        if isinstance(pipeline, dict):
+            pipeline = [pipeline]
+        docs = None
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if docs is None:
+                # A leading $match can use the _id index. Stages don't
+                # modify their input, so documents aren't copied.
+                spec = arg if op == '$match' else {}
+                docs = SnapshotCursor(
+                    self, spec, None, 0, 0, None, dict)._matching()
+                if op == '$match':
+                    continue
+            if op not in STAGES:
+                raise NotImplementedError(
+                    "Aggregation stage not supported on snapshots %s" % op)
+            docs = STAGES[op](docs, arg)
+        if docs is None:
+            docs = self.find()
+        return {'result': list(docs), 'ok': 1.0}
+
+
+class SnapshotCursor(object):
+
+    def __init__(self, collection, spec, fields, skip, limit, sort,
+                 as_class):
+        self._collection = collection
+        self._spec = spec
+        self._fields = fields
+        self._skip = skip
+        self._limit = limit
+        self._sort = None
+        self._as_class = as_class
+        if sort:
+            self.sort(sort)
+
+    def sort(self, key_or_list, direction=1):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction)]
+        self._sort = list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def _matching(self, limit=0):
+        coll = self._collection
+        sort = self._sort or []
+        positions = coll._candidates(
+            self._spec, by_id=bool(sort) and sort[0][0] == '_id')
+        # Candidates are then in _id order, and need no sorting.
+        if sort and sort[0][0] == '_id':
+            if sort[0][1] < 0:
+                positions.reverse()
+            sort = []
+        docs = []
+        spec = compile_spec(self._spec)
+        if _exact(spec):
+            # The _id index found exactly the matching documents.
+            spec = {}
+        if coll._raw and not coll._selective(
+                positions, spec, not sort and limit):
+            coll._decode()
+        if coll._raw:
+            found = coll._scan(positions, spec)
+        else:
+            found = (coll._docs[i] for i in positions
+                     if matches(coll._docs[i], spec))
+        for doc in found:
+            docs.append(doc)
+            if limit and not sort and len(docs) >= limit:
+                break
+        for key, direction in reversed(sort):
+            docs.sort(
+                key=lambda d: _sort_key(_first(resolve(d, key))),
+                reverse=direction < 0)
+        return docs
+
+    def count(self, with_limit_and_skip=False):
+        n = len(self._matching())
+        if with_limit_and_skip:
+            n = max(n - self._skip, 0)
+            if self._limit:
+                n = min(n, self._limit)
+        return n
+
+    def __iter__(self):
+        limit = abs(self._limit)
+        docs = self._matching(limit and self._skip + limit)[self._skip:]
+        if limit:
+            docs = docs[:limit]
+        for d in docs:
+            yield self._as_class(project(d, self._fields))
+
+
+def _exact(spec):
+    """Whether the _id index candidates for spec all match it.
+
+    That's the case for equality, hashable $in values, and ranges
+    bounded on both sides by values of the same type.
+    """
+    if spec.keys() != ['_id']:
+        return False
+    cond = spec['_id']
+    if not isinstance(cond, dict) or not any(
+            k.startswith('$') for k in cond):
+        return not hasattr(cond, 'search')
+    if cond.keys() == ['$in']:
+        return cond['$in'].hashed is not None
+    lower = [cond[k] for k in ('$gt', '$gte') if k in cond]
+    upper = [cond[k] for k in ('$lt', '$lte') if k in cond]
+    return len(cond) == 2 and len(lower) == len(upper) == 1 and (
+        _sort_key(lower[0])[0] == _sort_key(upper[0])[0])
+
+
+def _sort_key(value):
+    # Approximates mongo's cross type ordering, numbers before strings
+    # before documents before object ids.
+    if value is None:
+        return (0, None)
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, basestring):
+        return (2, value)
+    if isinstance(value, dict):
+        return (3, sorted(value.items()))
+    if isinstance(value, list):
+        return (4, value)
+    return (5, value)
+
+
+def _first(values):
+    return values[0] if values else None
+
+
+def resolve(doc, path):
+    """Return the candidate values for a dotted path, spanning arrays."""
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for v in values:
+            if isinstance(v, dict):
+                if part in v:
+                    found.append(v[part])
+            elif isinstance(v, list):
+                if part.isdigit() and int(part) < len(v):
+                    found.append(v[int(part)])
+                for e in v:
+                    if isinstance(e, dict) and part in e:
+                        found.append(e[part])
+        values = found
+    return values
+
+
+def _expand(values):
+    # A field compares against both an array and its elements.
+    for v in values:
+        yield v
+        if isinstance(v, list):
+            for e in v:
+                yield e
+
+
+def _compare(op):
+    def check(values, arg):
+        return any(
+            _sort_key(v)[0] == _sort_key(arg)[0] and op(v, arg)
+            for v in _expand(values))
+    return check
+
+
+def _regex(values, arg, options=""):
+    if isinstance(arg, basestring):
+        flags = re.I if 'i' in options else 0
+        arg = re.compile(arg, flags)
+    return any(isinstance(v, basestring) and arg.search(v)
+               for v in _expand(values))
+
+
+class _InSet(list):
+    """$in arguments, with a set for lookups when they are all scalars."""
+
+    def __init__(self, args):
+        super(_InSet, self).__init__(args)
+        try:
+            self.hashed = frozenset(self)
+        except TypeError:
+            self.hashed = None
+        if self.hashed is not None and any(
+                hasattr(a, 'search') or a is None for a in self.hashed):
+            self.hashed = None
+
+
+def compile_spec(spec):
+    """Prepare a query document for repeated evaluation by matches."""
+    if isinstance(spec, list):
+        return [compile_spec(s) for s in spec]
+    if not isinstance(spec, dict):
+        return spec
+    compiled = {}
+    for k, v in spec.items():
+        if k in ('$in', '$nin') and not isinstance(v, _InSet):
+            compiled[k] = _InSet(v)
+        else:
+            compiled[k] = compile_spec(v)
+    return compiled
+
+
+def _in(values, args):
+    if not isinstance(args, _InSet):
+        args = _InSet(args)
+    hashed = args.hashed
+    if hashed is None:
+        return any(_equal(values, a) for a in args)
+    for v in _expand(values):
+        try:
+            if v in hashed:
+                return True
+        except TypeError:
+            continue
+    return False
+
+
+def _equal(values, arg):
+    if hasattr(arg, 'search') and hasattr(arg, 'pattern'):
+        return _regex(values, arg)
+    if arg is None and not values:
+        return True
+    return any(v == arg for v in _expand(values))
+
+
+def _elem_match(values, arg):
+    for v in values:
+        if not isinstance(v, list):
+            continue
+        for e in v:
+            if isinstance(e, dict) and matches(e, arg):
+                return True
+            if not isinstance(e, dict) and _operators([e], arg):
+                return True
+    return False
+
+
+OPERATORS = {
+    '$gt': _compare(operator.gt),
+    '$gte': _compare(operator.ge),
+    '$lt': _compare(operator.lt),
+    '$lte': _compare(operator.le),
+    '$ne': lambda values, arg: not _equal(values, arg),
+    '$in': _in,
+    '$nin': lambda values, arg: not _in(values, arg),
+    '$exists': lambda values, arg: bool(values) == bool(arg),
+    '$size': lambda values, arg: any(
+        isinstance(v, list) and len(v) == arg for v in values),
+    '$elemMatch': _elem_match,
+    '$not': lambda values, arg: not _operators(values, arg),
+}
+
+
+def _operators(values, cond):
+    for op, arg in cond.items():
+        if op == '$options':
+            continue
+        if op == '$regex':
+            if not _regex(values, arg, cond.get('$options', '')):
+                return False
+        elif op not in OPERATORS:
+            raise NotImplementedError(
+                "Query operator not supported on snapshots %s" % op)
+        elif not OPERATORS[op](values, arg):
+            return False
+    return True
+
+
+def matches(doc, spec):
+    """Evaluate a mongo query document against doc."""
+    for key, cond in spec.items():
+        if key == '$or':
+            if not any(matches(doc, s) for s in cond):
+                return False
+        elif key == '$and':
+            if not all(matches(doc, s) for s in cond):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, s) for s in cond):
+                return False
+        elif isinstance(cond, dict) and cond and all(
+                k.startswith('$') for k in cond):
+            if not _operators(resolve(doc, key), cond):
+                return False
+        elif not _equal(resolve(doc, key), cond):
+            return False
+    return True
+
+
+def _raw_id(data, offset):
+    for name, kind, start, value, end in rawbson.iter_elements(data, offset):
+        if name == '_id':
+            return rawbson.decode_value(data, kind, start, value, end)
+    return None
+
+
+def _encoded(name, value):
+    """The BSON encodings of an element holding value, for prefiltering.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        return ['\x02%s\x00%s%s\x00' % (
+            name, DOC_SIZE.pack(len(value) + 1), value)]
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        # Integers may be stored as any numeric type.
+        found = ['\x12%s\x00%s' % (name, LONG.pack(value)),
+                 '\x01%s\x00%s' % (name, DOUBLE.pack(value))]
+        if -2 ** 31 <= value < 2 ** 31:
+            found.append('\x10%s\x00%s' % (name, DOC_SIZE.pack(value)))
+        return found
+    return None
+
+
+class _AnyOf(list):
+    """Needles met when those of any one of its clauses are."""
+
+
+def needles(spec):
+    """Return the byte strings a raw document must contain to match spec.
+
+    Each entry is a list of alternatives, one of which must be found,
+    or for an $or, an _AnyOf holding the needles of each clause.
+    Conditions that can't be expressed this way are left out, so
+    documents containing the needles still need matching in full. An
+    equality on a field is assumed to be on a scalar, not an array of
+    them, which holds for the txn log.
+    """
+    found = []
+    for key, cond in spec.items():
+        if key == '$or':
+            clauses = _AnyOf(needles(clause) for clause in cond)
+            if clauses and all(clauses):
+                found.append(clauses)
+        elif key == '$and':
+            for clause in cond:
+                found.extend(needles(clause))
+        elif key.startswith('$') or key == '_id':
+            continue
+        elif isinstance(cond, dict) and cond and all(
+                k.startswith('$') for k in cond):
+            elem = cond.get('$elemMatch')
+            if isinstance(elem, dict):
+                found.extend(needles(elem))
+            if '$in' in cond:
+                encoded = [_encoded(key.rsplit('.', 1)[-1], v)
+                           for v in cond['$in']]
+                if encoded and None not in encoded:
+                    found.append([e for alts in encoded for e in alts])
+        else:
+            encoded = _encoded(key.rsplit('.', 1)[-1], cond)
+            if encoded:
+                found.append(encoded)
+    return found
+
+
+def _top_level(spec):
+    """Return the top level fields a query document refers to."""
+    fields = set()
+    for key, cond in spec.items():
+        if key in ('$or', '$and', '$nor'):
+            for clause in cond:
+                fields.update(_top_level(clause))
+        else:
+            fields.add(key.split('.', 1)[0])
+    return fields
+
+
+def _decode_fields(data, offset, fields):
+    """Decode the given top level fields of the document at offset."""
+    doc = {}
+    for name, kind, start, value, end in rawbson.iter_elements(
+            data, offset):
+        if name in fields:
+            doc[name] = rawbson.decode_value(data, kind, start, value, end)
+    return doc
+
+
+def _selective_needles(spec_needles):
+    """Whether the needles include strings, for each $or clause."""
+    for alternatives in spec_needles:
+        if isinstance(alternatives, _AnyOf):
+            if all(_selective_needles(c) for c in alternatives):
+                return True
+        elif all(n.startswith('\x02') for n in alternatives):
+            return True
+    return False
+
+
+def _prefilter(data, start, end, spec_needles):
+    for alternatives in spec_needles:
+        if isinstance(alternatives, _AnyOf):
+            if not any(_prefilter(data, start, end, clause)
+                       for clause in alternatives):
+                return False
+            continue
+        for n in alternatives:
+            if data.find(n, start, end) != -1:
+                break
+        else:
+            return False
+    return True
+
+
+def project(doc, fields):
+    """Apply a mongo field projection to doc."""
+    if not fields:
+        return dict(doc)
+    if isinstance(fields, (list, tuple)):
+        fields = dict.fromkeys(fields, 1)
+    include = [k for k, v in fields.items() if v and k != '_id']
+    if not include:
+        result = dict(doc)
+        for k, v in fields.items():
+            if not v:
+                _drop(result, k.split('.'))
+        return result
+    result = {}
+    if fields.get('_id', 1) and '_id' in doc:
+        result['_id'] = doc['_id']
+    for k in include:
+        _pick(doc, result, k.split('.'))
+    return result
+
+
+def _pick(src, dest, parts):
+    head, rest = parts[0], parts[1:]
+    if head not in src:
+        return
+    value = src[head]
+    if not rest:
+        dest[head] = value
+    elif isinstance(value, dict):
+        _pick(value, dest.setdefault(head, {}), rest)
+    elif isinstance(value, list):
+        existing = dest.get(head)
+        elems = [e for e in value if isinstance(e, dict)]
+        if existing is None:
+            existing = dest[head] = [{} for e in elems]
+        for e, d in zip(elems, existing):
+            _pick(e, d, rest)
+
+
+def _drop(doc, parts):
+    head, rest = parts[0], parts[1:]
+    if head not in doc:
+        return
+    if not rest:
+        del doc[head]
+        return
+    value = doc[head] = _copy(doc[head])
+    for v in (value if isinstance(value, list) else [value]):
+        if isinstance(v, dict):
+            _drop(v, rest)
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _evaluate(doc, expr):
+    """Evaluate an aggregation expression, a field path or a literal."""
+    if isinstance(expr, basestring) and expr.startswith('$'):
+        values = resolve(doc, expr[1:])
+        if len(values) == 1:
+            return values[0]
+        return values or None
+    if isinstance(expr, dict):
+        return dict((k, _evaluate(doc, v)) for k, v in expr.items())
+    return expr
+
+
+def _stage_match(docs, spec):
+    spec = compile_spec(spec)
+    return (d for d in docs if matches(d, spec))
+
+
+def _stage_project(docs, fields):
+    return (project(d, fields) for d in docs)
+
+
+def _stage_unwind(docs, path):
+    parts = path[1:].split('.')
+    for d in docs:
+        values = resolve(d, path[1:])
+        if not values or not isinstance(values[0], list):
+            continue
+        for v in values[0]:
+            doc = _copy(d)
+            target = doc
+            for p in parts[:-1]:
+                target = target[p] = dict(target[p])
+            target[parts[-1]] = v
+            yield doc
+
+
+ACCUMULATORS = {
+    '$sum': lambda acc, v: acc + (
+        v if isinstance(v, (int, long, float)) else 0),
+    '$min': lambda acc, v: v if acc is None or (
+        v is not None and _sort_key(v) < _sort_key(acc)) else acc,
+    '$max': lambda acc, v: v if acc is None or (
+        _sort_key(v) > _sort_key(acc)) else acc,
+}
+
+
+def _stage_group(docs, spec):
+    accumulators = [
+        (field, acc.items()[0]) for field, acc in spec.items()
+        if field != '_id']
+    for field, (op, expr) in accumulators:
+        if op != '$first' and op not in ACCUMULATORS:
+            raise NotImplementedError(
+                "Accumulator not supported on snapshots %s" % op)
+    groups = {}
+    order = []
+    for d in docs:
+        key = _evaluate(d, spec['_id'])
+        hashed = key
+        if isinstance(key, (dict, list)):
+            hashed = repr(_sort_key(key))
+        group = groups.get(hashed)
+        if group is None:
+            group = groups[hashed] = {'_id': key}
+            order.append(hashed)
+            for field, (op, expr) in accumulators:
+                value = _evaluate(d, expr)
+                group[field] = value if op == '$first' else \
+                    ACCUMULATORS[op](0 if op == '$sum' else None, value)
+            continue
+        for field, (op, expr) in accumulators:
+            if op != '$first':
+                group[field] = ACCUMULATORS[op](
+                    group[field], _evaluate(d, expr))
+    return (groups[hashed] for hashed in order)
+
+
+def _stage_sort(docs, spec):
+    docs = list(docs)
+    for key, direction in reversed(list(spec.items())):
+        docs.sort(
+            key=lambda d: _sort_key(_first(resolve(d, key))),
+            reverse=direction < 0)
+    return iter(docs)
+
+
+STAGES = {
+    '$match': _stage_match,
+    '$project': _stage_project,
+    '$unwind': _stage_unwind,
+    '$group': _stage_group,
+    '$sort': _stage_sort,
+    '$skip': lambda docs, n: itertools.islice(docs, n, None),
+    '$limit': lambda docs, n: itertools.islice(docs, n),
+}
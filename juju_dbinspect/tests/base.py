@@ -21,3 +21,80 @@ class Base(unittest.TestCase):
             os.environ.update(original_environ)
 
         os.environ.update(kw)
+
+    def patch(self, obj, name, value):
+        """Set an attribute for the duration of the test."""
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def snapshot_db(self, collections):
+        """Return a snapshot database holding the given documents.
+
+        collections is a mapping of collection name to a list of docs.
+        """
+        from juju_dbinspect.snapshot import dump, open_snapshot
+        source = dict(
+            (name, FakeCollection(docs)) for name, docs in collections.items())
+        path = os.path.join(self.mkdir(), 'env.snapshot')
+        dump(source, path, sorted(collections))
+        return open_snapshot(path)
+
+
+class FakeCollection(list):
+
+    def find(self):
+        return iter(self)
+
+
+class MemoryDB(object):
+    """Mutable in-memory stand-in for a database, recording queries."""
+
+    def __init__(self, collections):
+        self.collections = dict(
+            (name, MemoryCollection(self, name, docs))
+            for name, docs in collections.items())
+        self.queries = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self, name, [])
+        return self.collections[name]
+
+
+class MemoryCollection(object):
+
+    def __init__(self, db, name, docs):
+        self.db = db
+        self.name = name
+        self.docs = list(docs)
+
+    def find(self, spec=None, fields=None, skip=0, limit=0, sort=None,
+             as_class=dict):
+        from juju_dbinspect.snapshot import matches, project, resolve
+        self.db.queries.append((self.name, spec))
+        docs = [d for d in self.docs if matches(d, spec or {})]
+        for key, direction in reversed(sort or []):
+            docs.sort(key=lambda d: resolve(d, key), reverse=direction < 0)
+        docs = docs[skip:]
+        if limit:
+            docs = docs[:limit]
+        return [as_class(project(d, fields)) for d in docs]
+
+    def find_one(self, spec_or_id=None, fields=None, as_class=dict):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for d in self.find(spec_or_id, fields, limit=1, as_class=as_class):
+            return d
+
+    def insert(self, doc):
+        self.docs.append(doc)
+
+    def update(self, doc_id, changes):
+        for d in self.docs:
+            if d['_id'] == doc_id:
+                d.update(changes)
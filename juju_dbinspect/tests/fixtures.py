@@ -0,0 +1,85 @@
+"""Sample juju collections modeled after a small wordpress deployment."""
+import datetime
+
+from bson.objectid import ObjectId
+
+
+def txn_id(minute):
+    return ObjectId.from_datetime(
+        datetime.datetime(2014, 3, 6, 19, minute))
+
+
+def environment():
+    return {
+        'machines': [
+            {'_id': '0', 'series': 'precise', 'life': 0,
+             'passwordhash': 'secret', 'txn-queue': [], 'txn-revno': 2},
+            {'_id': '1', 'series': 'precise', 'life': 0},
+            {'_id': '2', 'series': 'precise', 'life': 0}],
+        'services': [
+            {'_id': 'mysql', 'charmurl': 'cs:precise/mysql-38',
+             'unitcount': 1, 'life': 0},
+            {'_id': 'wordpress', 'charmurl': 'cs:precise/wordpress-21',
+             'unitcount': 1, 'life': 0}],
+        'units': [
+            {'_id': 'mysql/0', 'service': 'mysql', 'machineid': '1',
+             'charmurl': 'cs:precise/mysql-38', 'passwordhash': 'secret',
+             'nonce': 'abc', 'life': 0},
+            {'_id': 'wordpress/0', 'service': 'wordpress',
+             'machineid': '2', 'charmurl': 'cs:precise/wordpress-21',
+             'life': 0}],
+        'relations': [
+            {'_id': 'wordpress:db mysql:db', 'id': 1, 'unitcount': 2,
+             'endpoints': [
+                 {'servicename': 'wordpress',
+                  'relation': {'name': 'db', 'role': 'requirer',
+                               'interface': 'mysql', 'scope': 'global'}},
+                 {'servicename': 'mysql',
+                  'relation': {'name': 'db', 'role': 'provider',
+                               'interface': 'mysql', 'scope': 'global'}}]},
+            {'_id': 'mysql:cluster', 'id': 2, 'unitcount': 1,
+             'endpoints': [
+                 {'servicename': 'mysql',
+                  'relation': {'name': 'cluster', 'role': 'peer',
+                               'interface': 'mysql-ha',
+                               'scope': 'global'}}]}],
+        'settings': [
+            {'_id': 'r#1#provider#mysql/0', 'host': '10.0.3.1',
+             'password': 'hunter2'},
+            {'_id': 'r#1#requirer#wordpress/0',
+             'private-address': '10.0.3.2'},
+            {'_id': 'r#10#peer#other/0', 'private-address': '10.0.3.9'},
+            {'_id': 'r#2#peer#mysql/0', 'private-address': '10.0.3.1'},
+            {'_id': 's#mysql#cs:precise/mysql-38', 'dataset-size': '80%'},
+            {'_id': 's#wordpress#cs:precise/wordpress-21'}],
+        'statuses': [
+            {'_id': 'u#mysql/0', 'status': 'started', 'statusinfo': ''},
+            {'_id': 'u#wordpress/0', 'status': 'error',
+             'statusinfo': 'hook failed: "db-relation-changed"'},
+            {'_id': 'm#0', 'status': 'started'},
+            {'_id': 'm#1', 'status': 'started'},
+            {'_id': 'm#2', 'status': 'started'}],
+        'constraints': [
+            {'_id': 'm#1', 'mem': 2048},
+            {'_id': 's#mysql', 'mem': 4096},
+            {'_id': 'u#mysql/0', 'mem': 4096}],
+        'charms': [
+            {'_id': 'cs:precise/mysql-38', 'config': {}},
+            {'_id': 'cs:precise/wordpress-21', 'config': {}}],
+        'txns': [
+            {'_id': txn_id(1), 's': 6, 'o': [
+                {'c': 'units', 'd': 'mysql/0', 'i': {'service': 'mysql'}}]},
+            {'_id': txn_id(2), 's': 6, 'o': [
+                {'c': 'units', 'd': 'mysql/0', 'a': {'life': 0}},
+                {'c': 'settings', 'd': 'r#1#provider#mysql/0',
+                 'i': {'host': '10.0.3.1'}}]},
+            {'_id': txn_id(3), 's': 5, 'o': [
+                {'c': 'units', 'd': 'wordpress/0',
+                 'u': {'$set': {'life': 1}}}]},
+            {'_id': txn_id(4), 's': 6, 'o': [
+                {'c': 'settings', 'd': 'r#1#provider#mysql/0',
+                 'u': {'$set': {'password': 'hunter2'}}}]},
+            {'_id': txn_id(5), 's': 1, 'o': [
+                {'c': 'statuses', 'd': 'u#wordpress/0',
+                 'u': {'$set': {'status': 'error'}}}]}],
+    }
@@ -0,0 +1,58 @@
+import json
+from StringIO import StringIO
+
+from juju_dbinspect.batch import read_targets, run_batch
+from juju_dbinspect.profile import ProfiledDatabase
+
+from base import Base
+import fixtures
+
+
+class BatchTest(Base):
+
+    def setUp(self):
+        self.db = self.snapshot_db(fixtures.environment())
+
+    def run_batch(self, text, db=None):
+        out = StringIO()
+        failed = run_batch(
+            None, db or self.db, read_targets(StringIO(text)), out=out)
+        return failed, [json.loads(l) for l in out.getvalue().splitlines()]
+
+    def test_read_targets(self):
+        self.assertEqual(
+            read_targets(StringIO(
+                "mysql/0 wordpress\n\n# comment\nhistory 2  # last two\n"
+                "'mysql/0'\n")),
+            [['mysql/0', 'wordpress'], ['history', '2'], ['mysql/0']])
+
+    def test_batch(self):
+        failed, records = self.run_batch(
+            "mysql/0\nmysql/0 wordpress\nnosuch\n1\nmysql/0\nshell\n")
+        self.assertEqual(failed, 2)
+        self.assertEqual(len(records), 6)
+        self.assertEqual(records[0]['targets'], ['mysql/0'])
+        self.assertEqual(records[0]['result']['status']['status'], 'started')
+        self.assertEqual(records[4], records[0])
+        self.assertEqual(
+            records[1]['result'], {'host': '10.0.3.1', 'password': 'hunter2'})
+        self.assertIn('No entity found', records[2]['error'])
+        self.assertEqual(records[3]['result']['units'], ['mysql/0'])
+        self.assertIn('error', records[5])
+
+    def test_entities_prefetched(self):
+        # The entities and their side documents are fetched in bulk, so
+        # the queries don't grow with the number of targets.
+        counts = []
+        for text in ("0\nmysql\nmysql/0\n",
+                     "0\n1\n2\nmysql\nwordpress\nmysql/0\nwordpress/0\n"):
+            db = ProfiledDatabase(self.db)
+            self.run_batch(text, db)
+            counts.append(len(db.profile.queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_output_captured(self):
+        failed, records = self.run_batch("history 2\n")
+        self.assertEqual(failed, 0)
+        self.assertEqual(records[0]['result'], None)
+        self.assertTrue(records[0]['output'])
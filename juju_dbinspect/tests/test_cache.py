@@ -0,0 +1,113 @@
+import threading
+
+from juju_dbinspect.cache import CachedDatabase
+from juju_dbinspect.entities import grep, unit
+
+from base import Base, MemoryDB
+import fixtures
+
+
+class CacheTest(Base):
+
+    def setUp(self):
+        self.db = MemoryDB(fixtures.environment())
+        self.cache = CachedDatabase(self.db, interval=0)
+
+    def entity_queries(self):
+        return [q for q in self.db.queries if q[0] != 'txns']
+
+    def test_repeated_lookups_are_cached(self):
+        first = unit(self.cache, 'mysql/0').formatted
+        count = len(self.entity_queries())
+        second = unit(self.cache, 'mysql/0').formatted
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.entity_queries()), count)
+        self.assertTrue(self.cache.hits)
+
+    def test_invalidated_by_txn(self):
+        self.assertEqual(
+            unit(self.cache, 'mysql/0').status['status'], 'started')
+        self.db.statuses.update('u#mysql/0', {'status': 'error'})
+        self.assertEqual(
+            unit(self.cache, 'mysql/0').status['status'], 'started')
+        self.db.txns.insert({'_id': fixtures.txn_id(30), 's': 6, 'o': [
+            {'c': 'statuses', 'd': 'u#mysql/0',
+             'u': {'$set': {'status': 'error'}}}]})
+        self.assertEqual(
+            unit(self.cache, 'mysql/0').status['status'], 'error')
+
+    def test_pending_txn_rechecked(self):
+        self.cache.refresh()
+        txn = {'_id': fixtures.txn_id(30), 's': 1, 'o': [
+            {'c': 'units', 'd': 'mysql/0', 'u': {'$set': {'life': 1}}}]}
+        self.db.txns.insert(txn)
+        self.cache.refresh()
+        self.assertEqual(unit(self.cache, 'mysql/0')['life'], 0)
+        self.db.units.update('mysql/0', {'life': 1})
+        txn['s'] = 6
+        self.assertEqual(unit(self.cache, 'mysql/0')['life'], 1)
+
+    def test_query_results_invalidated_by_collection(self):
+        svc = list(self.cache.units.find({'service': 'mysql'}))
+        self.assertEqual(len(svc), 1)
+        self.db.units.insert(
+            {'_id': 'mysql/1', 'service': 'mysql', 'machineid': '1'})
+        self.assertEqual(
+            len(list(self.cache.units.find({'service': 'mysql'}))), 1)
+        self.db.txns.insert({'_id': fixtures.txn_id(30), 's': 6, 'o': [
+            {'c': 'units', 'd': 'mysql/1', 'i': {'service': 'mysql'}}]})
+        self.assertEqual(
+            len(list(self.cache.units.find({'service': 'mysql'}))), 2)
+
+    def test_lru_eviction(self):
+        cache = CachedDatabase(self.db, size=2, interval=0)
+        for name in ('mysql/0', 'wordpress/0', 'mysql/0'):
+            cache.units.find_one({'_id': name})
+        self.assertEqual(len(cache._entries), 2)
+        cache.statuses.find_one({'_id': 'u#mysql/0'})
+        keys = [k[2] for k in cache._entries]
+        self.assertEqual(keys, ['mysql/0', 'u#mysql/0'])
+        # Evicted entries are dropped from the invalidation indexes.
+        self.assertEqual(
+            sorted(cache._by_doc),
+            [('statuses', 'u#mysql/0'), ('units', 'mysql/0')])
+        for name in ('mysql', 'wordpress', 'mysql'):
+            list(cache.units.find({'service': name}))
+        self.assertEqual(cache._by_doc, {})
+        self.assertEqual(len(cache._by_collection['units']), 2)
+
+    def test_find_one_without_spec(self):
+        self.assertEqual(
+            self.cache.units.find_one(), self.db.units.find_one())
+
+    def test_shared_by_threads(self):
+        cache = CachedDatabase(self.db, size=8, interval=0)
+        errors = []
+
+        def work(n):
+            try:
+                for i in range(500):
+                    key = (n, i % 12)
+                    try:
+                        cache.get(key)
+                    except KeyError:
+                        cache.put(key, i, 'units', key)
+                    if i % 50 == 0:
+                        cache.invalidate('units', key)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(cache._entries), 8)
+
+    def test_grep(self):
+        db = self.snapshot_db(fixtures.environment())
+        cached = CachedDatabase(db)
+        self.assertEqual(grep(cached, 'hunter2'), grep(db, 'hunter2'))
+        self.assertEqual(grep(cached, 'hunter2'), grep(db, 'hunter2'))
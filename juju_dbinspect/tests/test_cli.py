@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+from StringIO import StringIO
+
+from juju_dbinspect import cli
+from juju_dbinspect.output import dumps
+
+from base import Base, MemoryDB
+import fixtures
+
+
+# Seconds allowed for importing the cli and parsing arguments, on the
+# paths juju runs when listing plugins and showing help.
+STARTUP_BUDGET = 0.25
+
+HEAVY_MODULES = ('pymongo', 'bson', 'yaml', 'sqlite3', 'code')
+
+PROBE = """
+import json, sys, time
+start = time.time()
+sys.argv = ['juju-db'] + %r
+from juju_dbinspect import cli
+try:
+    cli.setup_parser().parse_args()
+except SystemExit:
+    pass
+elapsed = time.time() - start
+sys.stderr.write(json.dumps({
+    'elapsed': elapsed,
+    'heavy': [m for m in %r if sys.modules.get(m)]}))
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+def probe_startup(args):
+    """Return the startup time and heavy modules loaded for cli args."""
+    proc = subprocess.Popen(
+        [sys.executable, '-c', PROBE % (args, HEAVY_MODULES)],
+        cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return out, json.loads(err.strip().splitlines()[-1])
+
+
+class StartupTest(Base):
+
+    def test_description(self):
+        out, result = probe_startup(['--description'])
+        self.assertEqual(out.strip(), "Juju database introspection")
+        self.assertEqual(result['heavy'], [])
+        self.assertLess(result['elapsed'], STARTUP_BUDGET)
+
+    def test_help(self):
+        out, result = probe_startup(['--help'])
+        self.assertIn("juju db shell", out)
+        self.assertEqual(result['heavy'], [])
+        self.assertLess(result['elapsed'], STARTUP_BUDGET)
+
+
+class OutputTest(Base):
+
+    def setUp(self):
+        self.db = self.snapshot_db(fixtures.environment())
+
+    def invoke(self, targets, **options):
+        options.setdefault('output', 'jsonl')
+        out = StringIO()
+        self.patch(sys, 'stdout', out)
+        result = cli.invoke_action(
+            None, self.db, targets, argparse.Namespace(**options))
+        self.assertEqual(result, None)
+        return [json.loads(l) for l in out.getvalue().splitlines()]
+
+    def test_listing_jsonl(self):
+        self.assertEqual(
+            self.invoke(['machines']),
+            [{'id': '0'}, {'id': '1'}, {'id': '2'}])
+        self.assertEqual(
+            [r['id'] for r in self.invoke(['units'])],
+            cli.invoke_action(None, self.db, ['units']))
+
+    def test_relations(self):
+        self.assertEqual(
+            self.invoke(['relations', 'wordpress']),
+            [{'id': 'wordpress:db mysql:db'}])
+        self.assertEqual(
+            cli.invoke_action(
+                None, self.db, ['relations', 'mysql'],
+                argparse.Namespace(role='peer')),
+            ['mysql:cluster'])
+        self.assertRaises(
+            ValueError, cli.invoke_action, None, self.db,
+            ['relations', 'mysql/0'])
+
+    def test_history_jsonl(self):
+        records = self.invoke(['history', '2'], compact=True)
+        self.assertEqual(
+            [r['id'] for r in records],
+            [str(fixtures.txn_id(5)), str(fixtures.txn_id(4))])
+        self.assertEqual(records[0]['state'], 'preparing')
+        self.assertEqual(len(self.invoke(['history', '0'])), 5)
+
+    def test_compact(self):
+        self.assertEqual(dumps({'a': [1, 2]}, compact=True), '{"a":[1,2]}')
+        self.assertEqual(
+            json.loads(dumps({'_id': fixtures.txn_id(1)})),
+            {'_id': {'$oid': str(fixtures.txn_id(1))}})
+
+    def test_grep_jsonl(self):
+        records = self.invoke(['grep', 'hunter2'])
+        self.assertEqual(
+            records,
+            [{'id': 'r#1#provider#mysql/0',
+              'owner': {'relation_id': 1, 'role': 'provider',
+                        'unit': 'mysql/0'},
+              'matches': {'password': 'hunter2'}}])
+
+
+class ShellTest(Base):
+
+    def shell_context(self, db):
+        import code
+        ctxt = {}
+        self.patch(code, 'interact', lambda local, banner: ctxt.update(local))
+        cli.shell(FakeClient(), db)
+        return ctxt
+
+    def test_profile_beneath_cache(self):
+        db = MemoryDB(fixtures.environment())
+        ctxt = self.shell_context(db)
+        out = StringIO()
+        self.patch(sys, 'stdout', out)
+        ctxt['profile'](ctxt['unit'], 'mysql/0')
+        first = out.getvalue()
+        out.truncate(0)
+        ctxt['profile'](ctxt['unit'], 'mysql/0')
+        second = out.getvalue()
+        self.assertIn("units        find_one", first)
+        self.assertIn("0 cache hits", first)
+        # The repeat is answered by the cache, it makes no queries.
+        self.assertNotIn("units        find_one", second)
+        self.assertIn("1 cache hits", second)
+        # The cache queries the db directly again.
+        self.assertIs(ctxt['db'].db, db)
+
+
+class FlushCounter(StringIO):
+
+    flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+
+class WatchTest(Base):
+
+    def test_text_flushed_per_txn(self):
+        from juju_dbinspect import entities
+        db = self.snapshot_db(fixtures.environment())
+        self.patch(entities, 'iter_watch', lambda db, *args: db.txns.find())
+        out = FlushCounter()
+        self.patch(sys, 'stdout', out)
+        cli.watch(db, None, None, None, None, 0, 'text')
+        self.assertEqual(out.flushes, db.txns.count())
+
+
+class FakeClient(object):
+
+    def close(self):
+        pass
+
+
+class FakeConfig(object):
+    """Connects every environment to a snapshot, except those in down."""
+
+    def __init__(self, db, down=()):
+        self.db = db
+        self.down = down
+        self.env_name = None
+
+    def for_env(self, env_name):
+        config = FakeConfig(self.db, self.down)
+        config.env_name = env_name
+        return config
+
+    def connect_db(self):
+        if self.env_name in self.down:
+            raise IOError("Connection refused")
+        return FakeClient(), self.db
+
+
+class EnvironmentsTest(Base):
+
+    def setUp(self):
+        self.db = self.snapshot_db(fixtures.environment())
+        self.out = StringIO()
+        self.patch(sys, 'stdout', self.out)
+
+    def options(self, targets, **options):
+        defaults = dict(targets=targets, output='text', compact=False,
+                        profile=False, txn_index=None)
+        defaults.update(options)
+        return argparse.Namespace(**defaults)
+
+    def test_results_by_environment(self):
+        results, ok = cli.run_environments(
+            FakeConfig(self.db, down=('mars',)), ['moon', 'mars'],
+            self.options(['units']))
+        self.assertFalse(ok)
+        self.assertEqual(results.keys(), ['moon', 'mars'])
+        self.assertEqual(results['moon'], ['mysql/0', 'wordpress/0'])
+        self.assertIn('Connection refused', results['mars']['error'])
+
+    def test_streamed_output_tagged(self):
+        results, ok = cli.run_environments(
+            FakeConfig(self.db), ['moon', 'mars'],
+            self.options(['machines'], output='jsonl', compact=True))
+        self.assertTrue(ok)
+        self.assertEqual(results, {})
+        records = [json.loads(l) for l in self.out.getvalue().splitlines()]
+        self.assertEqual(len(records), 6)
+        self.assertEqual(
+            sorted(r['id'] for r in records if r['environment'] == 'mars'),
+            ['0', '1', '2'])
+
+    def test_error_results_succeed(self):
+        # A result that only looks like a failure.
+        self.patch(cli, 'invoke_action', lambda *args: {'error': 'x'})
+        results, ok = cli.run_environments(
+            FakeConfig(self.db), ['moon', 'mars'], self.options(['units']))
+        self.assertTrue(ok)
+        self.assertEqual(results['mars'], {'error': 'x'})
+
+    def test_single_environment_targets(self):
+        for target in ('shell', 'batch'):
+            self.assertRaises(
+                ValueError, cli.run_environments, FakeConfig(self.db),
+                ['moon', 'mars'], self.options([target]))
+
+    def test_batch_failures_exit_non_zero(self):
+        self.patch(sys, 'stdin', StringIO("mysql/0\nnosuch\n"))
+        self.assertRaises(
+            SystemExit, cli.invoke_action, None, self.db, ['batch'],
+            self.options(['batch']))
+        self.assertEqual(len(self.out.getvalue().splitlines()), 2)
+        self.patch(sys, 'stdin', StringIO("mysql/0\n"))
+        self.assertEqual(
+            cli.invoke_action(
+                None, self.db, ['batch'], self.options(['batch'])), None)
@@ -1,6 +1,11 @@
 import os
+import stat
+import time
 import yaml
 
+from pymongo.errors import ConnectionFailure, OperationFailure
+
+from juju_dbinspect import config as config_module
 from juju_dbinspect.config import Config
 from juju_dbinspect.exceptions import ConfigError
 
@@ -56,3 +61,192 @@ class ConfigTest(Base):
         # Via Environment
         self.change_environment(JUJU_ENV="mercury")
         self.assertEqual(config.get_env_name(), 'mercury')
+
+    def write_jenv(self, name):
+        env_dir = os.path.join(self.juju_home, 'environments')
+        if not os.path.exists(env_dir):
+            os.mkdir(env_dir)
+        path = os.path.join(env_dir, '%s.jenv' % name)
+        with open(path, 'w') as fh:
+            fh.write(yaml.safe_dump({'state-servers': ['10.0.0.1:17070']}))
+        return path
+
+    def test_db_uri_cache(self):
+        jenv = self.write_jenv('moon')
+        config = self.get_config(environment='moon')
+        resolved = []
+
+        def resolve():
+            resolved.append(True)
+            return 'mongodb://10.0.0.1:37017/juju', 'sekrit'
+        config.resolve_db_uri = resolve
+
+        self.assertEqual(config.get_db_uri()[1], 'sekrit')
+        self.assertFalse(config.cached)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(config.cache_path).st_mode), 0600)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(
+                os.path.dirname(config.cache_path)).st_mode), 0700)
+
+        self.assertEqual(config.get_db_uri()[1], 'sekrit')
+        self.assertTrue(config.cached)
+        self.assertEqual(len(resolved), 1)
+
+        # A changed jenv invalidates the cache.
+        os.utime(jenv, (time.time() + 10, time.time() + 10))
+        config.get_db_uri()
+        self.assertEqual(len(resolved), 2)
+
+        # As does expiry.
+        config.cache_ttl = -1
+        config.get_db_uri()
+        self.assertEqual(len(resolved), 3)
+
+    def test_connect_falls_back_on_auth_failure(self):
+        self.write_jenv('moon')
+        config = self.get_config(environment='moon')
+        config.set_cached_db_uri('mongodb://10.0.0.1:37017/juju', 'stale')
+        config.resolve_db_uri = lambda: (
+            'mongodb://10.0.0.2:37017/juju', 'fresh')
+
+        clients = []
+
+        class FakeAdmin(object):
+            def __init__(self, uri):
+                self.uri = uri
+
+            def authenticate(self, user, password):
+                if password != 'fresh':
+                    raise OperationFailure("auth failed")
+
+        class FakeClient(object):
+            def __init__(self, uri):
+                self.admin = FakeAdmin(uri)
+                self.juju = uri
+                clients.append(uri)
+
+        original = config_module.MongoClient
+        config_module.MongoClient = FakeClient
+        self.addCleanup(setattr, config_module, 'MongoClient', original)
+
+        client, db = config.connect_db()
+        self.assertEqual(
+            db, 'mongodb://10.0.0.2:37017/juju'
+            '?readPreference=secondaryPreferred')
+        self.assertEqual(len(clients), 2)
+        self.assertEqual(config.get_cached_db_uri()[1], 'fresh')
+
+    def test_get_env_names(self):
+        config = self.get_config(environment=['moon,mars', 'pluto', 'moon'])
+        self.assertEqual(config.get_env_names(), ['moon', 'mars', 'pluto'])
+        self.assertRaises(ConfigError, config.get_env_name)
+        self.assertEqual(config.for_env('mars').get_env_name(), 'mars')
+        self.assertEqual(
+            self.get_config(environment=['moon']).get_env_name(), 'moon')
+
+        config = self.get_config(all_environments=True)
+        self.assertRaises(ConfigError, config.get_env_names)
+        with open(os.path.join(
+                self.juju_home, 'environments.yaml'), 'w') as fh:
+            fh.write(yaml.safe_dump(
+                {'environments': {'moon': {}, 'mars': {}}}))
+        self.write_jenv('pluto')
+        self.write_jenv('moon')
+        self.assertEqual(config.get_env_names(), ['mars', 'moon', 'pluto'])
+
+    def test_is_multi_env(self):
+        self.assertFalse(self.get_config().is_multi_env())
+        self.assertFalse(
+            self.get_config(environment=['moon', 'moon']).is_multi_env())
+        self.assertTrue(
+            self.get_config(environment=['moon', 'mars']).is_multi_env())
+        # Tagged by environment, even if only one is found.
+        config = self.get_config(all_environments=True)
+        self.write_jenv('prod')
+        self.assertTrue(config.is_multi_env())
+        self.assertEqual(config.get_env_names(), ['prod'])
+
+    def test_resolve_all_state_servers(self):
+        env_dir = os.path.join(self.juju_home, 'environments')
+        os.mkdir(env_dir)
+        with open(os.path.join(env_dir, 'moon.jenv'), 'w') as fh:
+            fh.write(yaml.safe_dump({'state-servers': [
+                '10.0.0.1:17070', '10.0.0.2:17070', '10.0.0.3:17070']}))
+        self.patch(config_module.subprocess, 'check_output',
+                   lambda args: yaml.safe_dump({'oldpassword': 'sekrit'}))
+        config = self.get_config(environment='moon')
+        seeds = []
+
+        def discover(uri):
+            seeds.append(uri)
+            return 'juju'
+        config.discover_replica_set = discover
+
+        self.assertEqual(
+            config.resolve_db_uri(),
+            ('mongodb://10.0.0.1:37017,10.0.0.2:37017,10.0.0.3:37017/juju'
+             '?w=1&ssl=true&replicaSet=juju', 'sekrit'))
+        self.assertEqual(len(seeds), 1)
+
+    def test_discover_replica_set(self):
+        class FakeAdmin(object):
+            def command(self, name):
+                return {'ismaster': False, 'setName': 'juju'}
+
+        class FakeClient(object):
+            def __init__(self, host, port, **kw):
+                if host == '10.0.0.1':
+                    raise ConnectionFailure("down")
+                self.admin = FakeAdmin()
+
+            def close(self):
+                pass
+
+        self.patch(config_module, 'MongoClient', FakeClient)
+        config = self.get_config()
+        self.assertEqual(
+            config.discover_replica_set(
+                'mongodb://10.0.0.1:37017,10.0.0.2:37017/juju?ssl=true'),
+            'juju')
+        self.assertEqual(
+            config.discover_replica_set('mongodb://10.0.0.1:37017/juju'),
+            None)
+
+    def test_read_preference(self):
+        self.assertEqual(
+            self.get_config(targets=['history']).read_preference,
+            'secondaryPreferred')
+        self.assertEqual(
+            self.get_config(targets=['shell']).read_preference, 'primary')
+        self.assertEqual(
+            self.get_config(
+                targets=['shell'], read_preference='nearest').read_preference,
+            'nearest')
+
+    def test_replica_set_client(self):
+        clients = []
+
+        class FakeClient(object):
+            def __init__(self, uri):
+                clients.append((self.__class__, uri))
+                self.admin = self
+
+            def authenticate(self, user, password):
+                pass
+
+        class FakeReplicaSetClient(FakeClient):
+            pass
+
+        self.patch(config_module, 'MongoClient', FakeClient)
+        self.patch(
+            config_module, 'MongoReplicaSetClient', FakeReplicaSetClient)
+        config = self.get_config(targets=['status'])
+        config.connect('mongodb://a:37017,b:37017/juju?replicaSet=juju', 's')
+        config.connect('mongodb://a:37017/juju', 's')
+        self.assertEqual(clients, [
+            (FakeReplicaSetClient,
+             'mongodb://a:37017,b:37017/juju?replicaSet=juju'
+             '&readPreference=secondaryPreferred'),
+            (FakeClient,
+             'mongodb://a:37017/juju?readPreference=secondaryPreferred')])
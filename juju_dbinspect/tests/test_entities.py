@@ -0,0 +1,174 @@
+import datetime
+
+from juju_dbinspect.entities import (
+    charm, iter_history, iter_watch, machine, parse_time, service, status,
+    unit, Txn)
+
+from base import Base, MemoryDB
+import fixtures
+
+
+class HistoryTest(Base):
+
+    def setUp(self):
+        self.db = self.snapshot_db(fixtures.environment())
+
+    def test_parse_time(self):
+        expected = datetime.datetime(2014, 3, 6, 19, 31, 39)
+        self.assertEqual(parse_time('2014/03/06-19:31:39'), expected)
+        self.assertEqual(parse_time('2014-03-06T19:31:39'), expected)
+        self.assertEqual(parse_time(expected), expected)
+        self.assertEqual(
+            parse_time('2014-03-06'), datetime.datetime(2014, 3, 6))
+        self.assertRaises(ValueError, parse_time, 'yesterday')
+
+    def test_iter_history_newest_first(self):
+        txns = list(iter_history(self.db, 2))
+        self.assertEqual(
+            [t['_id'] for t in txns], [fixtures.txn_id(5), fixtures.txn_id(4)])
+        self.assertEqual(len(list(iter_history(self.db, 0))), 5)
+
+    def test_iter_history_window(self):
+        txns = iter_history(
+            self.db, 0, since='2014/03/06-19:02:00',
+            until=datetime.datetime(2014, 3, 6, 19, 4))
+        self.assertEqual(
+            [t['_id'] for t in txns], [fixtures.txn_id(3), fixtures.txn_id(2)])
+
+
+class StatusTest(Base):
+
+    def setUp(self):
+        self.db = self.snapshot_db(fixtures.environment())
+
+    def test_status_matches_formatted(self):
+        result = status(self.db)
+        self.assertEqual(sorted(result['units']), ['mysql/0', 'wordpress/0'])
+        self.assertEqual(sorted(result['machines']), ['0', '1', '2'])
+        for uid, formatted in result['units'].items():
+            self.assertEqual(formatted, unit(self.db, uid).formatted)
+        for sid, formatted in result['services'].items():
+            self.assertEqual(formatted, service(self.db, sid).formatted)
+        for mid, formatted in result['machines'].items():
+            self.assertEqual(formatted, machine(self.db, mid).formatted)
+        self.assertEqual(result['machines']['1']['units'], ['mysql/0'])
+        self.assertEqual(
+            result['services']['mysql']['config'], {'dataset-size': '80%'})
+
+    def test_status_targets(self):
+        result = status(self.db, 'mysql/0', '2', 'wordpress')
+        self.assertEqual(result['units'].keys(), ['mysql/0'])
+        self.assertEqual(result['machines'].keys(), ['2'])
+        self.assertEqual(result['services'].keys(), ['wordpress'])
+        self.assertEqual(result['machines']['2']['units'], ['wordpress/0'])
+
+
+class CountingDB(object):
+    """Record the find calls made against each collection."""
+
+    def __init__(self, db):
+        self.db = db
+        self.queries = []
+
+    def __getattr__(self, name):
+        return self[name]
+
+    def __getitem__(self, name):
+        return CountingCollection(self, self.db[name])
+
+
+class CountingCollection(object):
+
+    def __init__(self, counter, collection):
+        self.counter = counter
+        self.collection = collection
+
+    def find(self, *args, **kw):
+        self.counter.queries.append(self.collection.name)
+        return self.collection.find(*args, **kw)
+
+    def find_one(self, *args, **kw):
+        self.counter.queries.append(self.collection.name)
+        return self.collection.find_one(*args, **kw)
+
+
+class BatchLoaderTest(Base):
+
+    def setUp(self):
+        self.db = CountingDB(self.snapshot_db(fixtures.environment()))
+
+    def test_traversal_batches_siblings(self):
+        c = charm(self.db, 'cs:precise/mysql-38')
+        del self.db.queries[:]
+        svcs = c.services
+        self.assertEqual([s.id for s in svcs], ['mysql'])
+        units = svcs[0].units
+        self.assertEqual([u.id for u in units], ['mysql/0'])
+        self.assertEqual(units[0].service.id, 'mysql')
+        self.assertEqual(
+            [s.id for s in units[0].related_services], ['wordpress'])
+        self.assertEqual(
+            self.db.queries,
+            ['services', 'units', 'services', 'relations', 'services'])
+
+    def test_children_batched_across_siblings(self):
+        svcs = charm(self.db, 'cs:precise/wordpress-21').services
+        wordpress = svcs[0]
+        mysql = service(self.db, 'mysql')
+        # Entities loaded independently don't share a batch.
+        self.assertEqual([u.id for u in mysql.units], ['mysql/0'])
+        self.assertEqual([u.id for u in wordpress.units], ['wordpress/0'])
+        loader = wordpress.loader
+        loader.entities.append(mysql)
+        mysql.loader = loader
+        del self.db.queries[:]
+        self.assertEqual([r['_id'] for r in mysql.relations],
+                         ['wordpress:db mysql:db', 'mysql:cluster'])
+        self.assertEqual([r['_id'] for r in wordpress.relations],
+                         ['wordpress:db mysql:db'])
+        self.assertEqual(self.db.queries, ['relations'])
+
+
+class WatchTest(Base):
+
+    def setUp(self):
+        self.db = MemoryDB(fixtures.environment())
+
+    def test_watch_new_and_changed(self):
+        txns = iter_watch(
+            self.db, since='2014/03/06-19:20:00', interval=0, polls=3)
+        self.db.txns.insert({'_id': fixtures.txn_id(30), 's': 2, 'o': [
+            {'c': 'units', 'd': 'mysql/0', 'a': {'life': 0}}]})
+        t = next(txns)
+        self.assertEqual((t['_id'], t['s']), (fixtures.txn_id(30), 2))
+        self.db.txns.docs[-1]['s'] = 6
+        self.assertEqual(
+            [(c['_id'], c['s']) for c in txns], [(fixtures.txn_id(30), 6)])
+
+    def test_watch_tracks_pending(self):
+        txns = iter_watch(self.db, interval=0, polls=2)
+        self.db.txns.docs[4]['s'] = 6
+        self.assertEqual(
+            [(t['_id'], t['s']) for t in txns], [(fixtures.txn_id(5), 6)])
+
+    def test_watch_filters(self):
+        self.db.txns.insert({'_id': fixtures.txn_id(30), 's': 6, 'o': [
+            {'c': 'units', 'd': 'mysql/0', 'a': {'life': 0}},
+            {'c': 'settings', 'd': 'r#1#provider#mysql/0',
+             'u': {'$set': {'a': 1}}}]})
+        self.db.txns.insert({'_id': fixtures.txn_id(31), 's': 5, 'o': [
+            {'c': 'settings', 'd': 'r#1#provider#mysql/0',
+             'u': {'$set': {'a': 2}}}]})
+        found = list(iter_watch(
+            self.db, 'settings', 'r#1#provider#mysql/0', 'applied',
+            since='2014/03/06-19:10:00', interval=0, polls=1))
+        self.assertEqual([t['_id'] for t in found], [fixtures.txn_id(30)])
+        self.assertRaises(ValueError, Txn.state_id, 'stuck')
+
+    def test_record(self):
+        record = Txn.record(fixtures.environment()['txns'][1])
+        self.assertEqual(record['state'], 'applied')
+        self.assertEqual(record['time'], '2014/03/06-19:02:00')
+        self.assertEqual(
+            [(o['collection'], o['op']) for o in record['ops']],
+            [('units', 'cond'), ('settings', 'create')])
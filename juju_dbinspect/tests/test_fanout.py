@@ -0,0 +1,44 @@
+import json
+import sys
+from StringIO import StringIO
+
+from juju_dbinspect.fanout import fan_out, tag_line
+
+from base import Base
+
+
+class FanOutTest(Base):
+
+    def test_tag_line(self):
+        self.assertEqual(
+            json.loads(tag_line('moon', '{"id": "0"}')),
+            {'environment': 'moon', 'id': '0'})
+        self.assertEqual(
+            tag_line('moon', '{"id":"0"}', compact=True),
+            '{"environment":"moon","id":"0"}')
+        self.assertEqual(
+            json.loads(tag_line('moon', '{}')), {'environment': 'moon'})
+        self.assertEqual(tag_line('moon', 'text'), 'moon: text')
+
+    def test_fan_out(self):
+        out = StringIO()
+        self.patch(sys, 'stdout', out)
+
+        def run(env_name):
+            if env_name == 'mars':
+                raise ValueError("unreachable")
+            print("line one\nline two")
+            sys.stdout.write('{"id": 1}\n')
+            return env_name.upper()
+
+        results = fan_out(['moon', 'mars', 'pluto'], run)
+        self.assertEqual(
+            results,
+            [('moon', True, 'MOON'),
+             ('mars', False, {'error': 'ValueError: unreachable'}),
+             ('pluto', True, 'PLUTO')])
+        self.assertIs(sys.stdout, out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertIn('pluto: line two', lines)
+        self.assertIn('{"environment": "moon", "id": 1}', lines)
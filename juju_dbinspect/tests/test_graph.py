@@ -0,0 +1,48 @@
+from juju_dbinspect.entities import graph, service
+from juju_dbinspect.profile import ProfiledDatabase
+
+from base import Base
+import fixtures
+
+
+class GraphTest(Base):
+
+    def setUp(self):
+        self.db = self.snapshot_db(fixtures.environment())
+
+    def test_single_scan(self):
+        db = ProfiledDatabase(self.db)
+        g = graph(db)
+        self.assertEqual(
+            [q.collection for q in db.profile.queries],
+            ['services', 'relations'])
+        self.assertEqual(
+            g.services['mysql'],
+            {'charm': 'cs:precise/mysql-38', 'units': 1})
+        self.assertEqual(
+            g.related('wordpress'), {'mysql': ['wordpress:db mysql:db']})
+        self.assertEqual(
+            g.related('mysql'),
+            {'wordpress': ['wordpress:db mysql:db'],
+             'mysql': ['mysql:cluster']})
+        self.assertEqual(
+            sorted(g.related('wordpress')),
+            sorted(s.id for s in service(
+                self.db, 'wordpress').related_services))
+
+    def test_json(self):
+        rel = graph(self.db).to_json()['relations']['wordpress:db mysql:db']
+        self.assertEqual(rel['interface'], 'mysql')
+        self.assertEqual(rel['units'], 2)
+        self.assertEqual(
+            [(e['service'], e['role']) for e in rel['endpoints']],
+            [('wordpress', 'requirer'), ('mysql', 'provider')])
+
+    def test_dot(self):
+        dot = graph(self.db).to_dot()
+        self.assertTrue(dot.startswith('graph relations {'))
+        self.assertIn('"mysql" [label="mysql\\n1 units"];', dot)
+        self.assertIn(
+            '"wordpress" -- "mysql" '
+            '[label="mysql\\nrequirer:db provider:db"];', dot)
+        self.assertIn('"mysql" -- "mysql" [label="mysql-ha (peer)"];', dot)
@@ -0,0 +1,44 @@
+from StringIO import StringIO
+
+from juju_dbinspect.entities import unit
+from juju_dbinspect.profile import ProfiledDatabase, shape
+
+from base import Base
+import fixtures
+
+
+class ProfileTest(Base):
+
+    def setUp(self):
+        self.db = ProfiledDatabase(self.snapshot_db(fixtures.environment()))
+
+    def test_shape(self):
+        self.assertEqual(
+            shape({'_id': 'x', 'o.d': {'$in': [1, 2, 3]},
+                   '$or': [{'a': 1}, {'b': {'$gt': 2}}]}),
+            {'_id': '?', 'o.d': {'$in': '[3]'},
+             '$or': [{'a': '?'}, {'b': {'$gt': '?'}}]})
+
+    def test_formatted_queries(self):
+        unit(self.db, 'mysql/0').formatted
+        queries = self.db.profile.queries
+        self.assertEqual(
+            [(q.collection, q.op, q.shape) for q in queries],
+            [('units', 'find_one', '{_id: ?}'),
+             ('constraints', 'find_one', '{_id: ?}'),
+             ('statuses', 'find_one', '{_id: ?}')])
+        self.assertEqual([q.docs for q in queries], [1, 1, 1])
+        self.assertTrue(all(q.bytes for q in queries))
+        self.assertEqual(sum(q.round_trips for q in queries), 3)
+
+    def test_cursor_and_report(self):
+        cursor = self.db.txns.find({}).sort('_id', -1).limit(2)
+        self.assertEqual(len(list(cursor)), 2)
+        self.assertEqual(self.db.txns.find({'s': 6}).count(), 3)
+        q = self.db.profile.queries
+        self.assertEqual((q[0].op, q[0].docs), ('find', 2))
+        self.assertEqual(q[1].op, 'count')
+        out = StringIO()
+        self.db.profile.report(out)
+        self.assertIn("2 queries, ~2 round trips, 2 docs", out.getvalue())
+        self.assertIn("Hottest queries", out.getvalue())
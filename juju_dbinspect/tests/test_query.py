@@ -0,0 +1,54 @@
+from juju_dbinspect.entities import relation, relations
+from juju_dbinspect.query import (
+    prefix_bounds, prefix_query, relation_settings_query, relations_query)
+
+from base import Base
+import fixtures
+
+
+class QueryTest(Base):
+
+    def test_prefix_bounds(self):
+        self.assertEqual(prefix_bounds('r#1#'), ('r#1#', 'r#1$'))
+        self.assertEqual(prefix_bounds('s#a'), ('s#a', 's#b'))
+        self.assertRaises(ValueError, prefix_bounds, '')
+
+    def test_prefix_query(self):
+        self.assertEqual(
+            prefix_query('u#', 'o.d'), {'o.d': {'$gte': 'u#', '$lt': 'u$'}})
+        self.assertEqual(
+            relation_settings_query(1, 'peer'),
+            {'_id': {'$gte': 'r#1#peer#', '$lt': 'r#1#peer$'}})
+
+    def test_relation_unit_ids(self):
+        # r#10# shares the r#1 prefix, but not the r#1# prefix.
+        db = self.snapshot_db(fixtures.environment())
+        rel = relation(db, 'wordpress:db mysql:db')
+        self.assertEqual(rel.unit_ids, ['mysql/0', 'wordpress/0'])
+
+    def test_relations_query(self):
+        self.assertEqual(
+            relations_query('mysql'), {'endpoints.servicename': 'mysql'})
+        self.assertEqual(
+            relations_query(interface='mysql'),
+            {'endpoints.relation.interface': 'mysql'})
+        self.assertEqual(relations_query(), {})
+        self.assertEqual(
+            relations_query('mysql', role='peer'),
+            {'endpoints': {'$elemMatch': {
+                'servicename': 'mysql', 'relation.role': 'peer'}}})
+
+    def test_relations(self):
+        db = self.snapshot_db(fixtures.environment())
+        self.assertEqual(
+            relations(db, 'mysql'), ['mysql:cluster', 'wordpress:db mysql:db'])
+        self.assertEqual(relations(db, 'sql'), [])
+        self.assertEqual(
+            relations(db, 'mysql', interface='mysql'),
+            ['wordpress:db mysql:db'])
+        # The role is that of the service's own endpoint.
+        self.assertEqual(relations(db, 'wordpress', role='provider'), [])
+        self.assertEqual(
+            relations(db, 'mysql', role='provider'),
+            ['wordpress:db mysql:db'])
+        self.assertEqual(relations(db, role='peer'), ['mysql:cluster'])
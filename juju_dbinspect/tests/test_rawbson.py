@@ -0,0 +1,78 @@
+import datetime
+import re
+
+from bson import BSON
+from bson.objectid import ObjectId
+
+from juju_dbinspect.entities import machine, service, status, unit, Unit
+from juju_dbinspect.rawbson import (
+    LazyDatabase, decode_element, elements, find_element, lazy, lazy_class)
+
+from base import Base
+import fixtures
+
+
+class RawBSONTest(Base):
+
+    def test_elements(self):
+        doc = {'f': 1.5, 's': u'caf\xe9', 'd': {'a': [1, 2]}, 'l': [],
+               'o': ObjectId(), 'b': True, 't': datetime.datetime(2014, 3, 6),
+               'n': None, 'r': re.compile('^x', re.I), 'i': 3, 'L': 2 ** 40,
+               'bin': BSON.encode({})}
+        data = BSON.encode(doc)
+        self.assertEqual(
+            sorted(name for name, start, end in elements(data)),
+            sorted(doc))
+        for key in doc:
+            value = decode_element(data, *find_element(data, key))
+            if key == 'r':
+                self.assertEqual(value.pattern, '^x')
+            else:
+                self.assertEqual(value, doc[key])
+        self.assertEqual(find_element(data, 'missing'), None)
+
+    def test_lazy_document(self):
+        doc = {'_id': 'mysql/0', 'service': 'mysql', 'tools': {'v': 1}}
+        u = lazy(Unit, doc)
+        self.assertTrue(isinstance(u, Unit))
+        self.assertEqual(dict.__len__(u), 0)
+        self.assertEqual(u.service_name, 'mysql')
+        self.assertEqual(dict.keys(u), ['_id'])
+        self.assertTrue('tools' in u)
+        self.assertEqual(u.get('missing', 1), 1)
+        self.assertRaises(KeyError, u.__getitem__, 'missing')
+        self.assertEqual(u, doc)
+        self.assertEqual(u.as_dict(), doc)
+        self.assertTrue(lazy_class(Unit) is type(u))
+
+
+class LazyEntityTest(Base):
+
+    def setUp(self):
+        self.db = self.snapshot_db(fixtures.environment())
+        self.lazy_db = LazyDatabase(self.db)
+
+    def test_entities(self):
+        u = unit(self.lazy_db, 'mysql/0')
+        self.assertEqual(type(u).__name__, 'LazyUnit')
+        self.assertEqual(u.formatted, unit(self.db, 'mysql/0').formatted)
+        self.assertEqual(
+            u.relation_data('wordpress'),
+            {'host': '10.0.3.1', 'password': 'hunter2'})
+        units = service(self.lazy_db, 'mysql').units
+        self.assertEqual(type(units[0]).__name__, 'LazyUnit')
+        self.assertEqual(units[0].service.config, {'dataset-size': '80%'})
+        self.assertEqual(
+            machine(self.lazy_db, '1').formatted,
+            machine(self.db, '1').formatted)
+
+    def test_entity_at(self):
+        u = unit(self.lazy_db, 'mysql/0')
+        past = u.at(datetime.datetime(2014, 3, 6, 19, 1))
+        self.assertIs(type(past), Unit)
+        self.assertEqual(past, {'_id': 'mysql/0', 'service': 'mysql'})
+        self.assertIn('mysql/0', repr(past))
+        self.assertEqual(past.service_name, 'mysql')
+
+    def test_status(self):
+        self.assertEqual(status(self.lazy_db), status(self.db))
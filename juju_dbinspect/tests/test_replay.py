@@ -0,0 +1,89 @@
+import datetime
+
+from juju_dbinspect.entities import relation, unit
+from juju_dbinspect.replay import UNKNOWN, Replayer, apply_update
+
+from base import Base
+import fixtures
+
+
+def at(minute):
+    return datetime.datetime(2014, 3, 6, 19, minute)
+
+
+class ReplayTest(Base):
+
+    def test_apply_update(self):
+        doc = {'_id': 'x', 'a': 1, 'tags': ['a', 'b'],
+               'ports': [{'number': 80}, {'number': 443}]}
+        apply_update(doc, {
+            '$set': {'life': 1, 'tools.version': '1.18'},
+            '$unset': {'a': 1, 'missing.x': 1},
+            '$inc': {'n': 2},
+            '$addToSet': {'tags': {'$each': ['b', 'c']}},
+            '$pull': {'ports': {'number': 80}}})
+        self.assertEqual(doc, {
+            '_id': 'x', 'life': 1, 'tools': {'version': '1.18'}, 'n': 2,
+            'tags': ['a', 'b', 'c'], 'ports': [{'number': 443}]})
+        apply_update(doc, {'$pull': {'tags': {'$in': ['a', 'c']}}})
+        self.assertEqual(doc['tags'], ['b'])
+        self.assertRaises(
+            NotImplementedError, apply_update, doc, {'$rename': {'n': 'm'}})
+
+    def test_entity_at(self):
+        db = self.snapshot_db(fixtures.environment())
+        u = unit(db, 'mysql/0')
+        self.assertEqual(u.at(at(0)), None)
+        past = u.at('2014-03-06T19:01:00')
+        self.assertEqual(past, {'_id': 'mysql/0', 'service': 'mysql'})
+        self.assertEqual(past.service_name, 'mysql')
+        # The aborted txn didn't change the unit.
+        self.assertEqual(
+            unit(db, 'wordpress/0').at(at(5)), None)
+
+    def test_relation_at(self):
+        db = self.snapshot_db(fixtures.environment())
+        rel = relation(db, 'wordpress:db mysql:db')
+        self.assertEqual(rel.at(at(1)), {})
+        self.assertEqual(rel.at(at(3)), {'mysql/0': {'host': '10.0.3.1'}})
+        self.assertEqual(
+            rel.at(at(4)),
+            {'mysql/0': {'host': '10.0.3.1', 'password': 'hunter2'}})
+
+    def test_checkpoints(self):
+        env = fixtures.environment()
+        env['txns'] = [
+            {'_id': fixtures.txn_id(0), 's': 6, 'o': [
+                {'c': 'units', 'd': 'mysql/0', 'i': {'n': 0}}]}]
+        env['txns'].extend(
+            {'_id': fixtures.txn_id(i), 's': 6, 'o': [
+                {'c': 'units', 'd': 'mysql/0', 'u': {'$inc': {'n': 1}}}]}
+            for i in range(1, 11))
+        replayer = Replayer(
+            self.snapshot_db(env), 'units', 'mysql/0', interval=3)
+        self.assertEqual(replayer.at(at(8))['n'], 8)
+        self.assertEqual(replayer.replayed, 9)
+        self.assertEqual(
+            replayer.checkpoint_ids,
+            [fixtures.txn_id(2), fixtures.txn_id(5), fixtures.txn_id(8)])
+        self.assertEqual(replayer.at(at(10))['n'], 10)
+        self.assertEqual(replayer.replayed, 11)
+        self.assertEqual(replayer.at(at(4))['n'], 4)
+        self.assertEqual(replayer.replayed, 13)
+
+    def test_checkpoints_unknown_doc(self):
+        # The insert was pruned, and the first txns only assert.
+        env = fixtures.environment()
+        env['txns'] = [
+            {'_id': fixtures.txn_id(i), 's': 6, 'o': [
+                {'c': 'units', 'd': 'mysql/0', 'a': {'life': 0}}]}
+            for i in range(1, 5)]
+        env['txns'].append(
+            {'_id': fixtures.txn_id(5), 's': 6, 'o': [
+                {'c': 'units', 'd': 'mysql/0', 'u': {'$set': {'life': 1}}}]})
+        replayer = Replayer(
+            self.snapshot_db(env), 'units', 'mysql/0', interval=2)
+        self.assertIs(replayer.at(at(4)), UNKNOWN)
+        self.assertEqual(replayer.checkpoint_ids, [])
+        self.assertEqual(
+            replayer.at(at(5)), {'_id': 'mysql/0', 'life': 1})
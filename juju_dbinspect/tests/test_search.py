@@ -0,0 +1,50 @@
+import re
+
+from juju_dbinspect.entities import grep
+from juju_dbinspect.identity import settings_owner
+from juju_dbinspect.search import matching_values, settings_ranges
+
+from base import Base
+import fixtures
+
+
+class SearchTest(Base):
+
+    def setUp(self):
+        self.db = self.snapshot_db(fixtures.environment())
+
+    def test_settings_owner(self):
+        self.assertEqual(
+            settings_owner('r#10#peer#other/0'),
+            {'relation_id': 10, 'role': 'peer', 'unit': 'other/0'})
+        self.assertEqual(
+            settings_owner('s#mysql#cs:precise/mysql-38'),
+            {'service': 'mysql', 'charm': 'cs:precise/mysql-38'})
+        self.assertEqual(settings_owner('u#mysql/0'), None)
+        self.assertEqual(settings_owner('r#x#peer#other/0'), None)
+
+    def test_ranges_cover_settings(self):
+        found = []
+        for spec in settings_ranges():
+            found.extend(d['_id'] for d in self.db.settings.find(spec))
+        self.assertEqual(
+            sorted(found), sorted(d['_id'] for d in self.db.settings.find()))
+
+    def test_matching_values(self):
+        doc = {'_id': 'r#1#peer#a/0', 'txn-revno': 10, 'n': 10,
+               'nested': {'list': ['a', '10.0.0.1']}}
+        self.assertEqual(
+            matching_values(doc, re.compile('10')),
+            {'n': 10, 'nested.list.1': '10.0.0.1'})
+
+    def test_grep(self):
+        found = grep(self.db, r'10\.0\.3\.1$')
+        self.assertEqual(
+            [(r['id'], r['matches']) for r in found],
+            [('r#1#provider#mysql/0', {'host': '10.0.3.1'}),
+             ('r#2#peer#mysql/0', {'private-address': '10.0.3.1'})])
+        self.assertEqual(found[1]['owner']['role'], 'peer')
+        found = grep(self.db, '80%')
+        self.assertEqual(found[0]['owner']['service'], 'mysql')
+        self.assertEqual(grep(self.db, 'nomatch'), [])
+        self.assertRaises(ValueError, grep, self.db, '(')
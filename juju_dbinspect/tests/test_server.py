@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+from StringIO import StringIO
+
+from juju_dbinspect import cli
+from juju_dbinspect.server import Server, forward, is_running
+
+from base import Base
+import fixtures
+
+
+class SnapshotConfig(object):
+
+    def __init__(self, db, socket_path):
+        self.db = db
+        self.socket_path = socket_path
+        self.connected = []
+
+    def for_env(self, env_name):
+        self.connected.append(env_name)
+        return self
+
+    def connect_db(self):
+        return None, self.db
+
+    def get_env_name(self):
+        return 'moon'
+
+
+class ServerTest(Base):
+
+    def setUp(self):
+        self.path = os.path.join(self.mkdir(), 'serve.sock')
+        self.config = SnapshotConfig(
+            self.snapshot_db(fixtures.environment()), self.path)
+        self.server = Server(self.path, self.config)
+        # As Server.serve does, from this thread to avoid racing tests
+        # that patch stdout.
+        self.patch(sys, 'stdout', self.server.output)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def options(self, targets, **options):
+        defaults = dict(
+            targets=targets, limit=100, output='text', compact=False,
+            no_daemon=False, snapshot=None, txn_index=None, profile=False,
+            read_preference=None)
+        defaults.update(options)
+        return argparse.Namespace(**defaults)
+
+    def test_forward(self):
+        self.assertTrue(is_running(self.path))
+        response = forward(self.path, 'moon', ['units'], self.options([]))
+        self.assertEqual(response['result'], ['mysql/0', 'wordpress/0'])
+        response = forward(
+            self.path, 'moon', ['mysql/0', 'wordpress'], self.options([]))
+        self.assertEqual(response['result']['password'], 'hunter2')
+        # One connection per environment.
+        self.assertEqual(self.config.connected, ['moon'])
+
+    def test_errors(self):
+        response = forward(self.path, 'moon', ['mysql/9'], self.options([]))
+        self.assertEqual(response['kind'], 'ValueError')
+        self.assertIn('mysql/9', response['error'])
+        response = forward(self.path, 'moon', ['shell'], self.options([]))
+        self.assertIn("Can't serve", response['error'])
+
+    def test_output_returned(self):
+        response = forward(
+            self.path, 'moon', ['machines'],
+            self.options([], output='jsonl', compact=True))
+        self.assertEqual(response['result'], None)
+        self.assertEqual(
+            response['output'], '{"id":"0"}\n{"id":"1"}\n{"id":"2"}\n')
+
+    def test_many_requests_per_connection(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.addCleanup(sock.close)
+        fh = sock.makefile('rwb')
+        for targets in (['units'], ['services'], 'bad'):
+            fh.write(json.dumps({'environment': 'moon', 'targets': targets,
+                                 'options': {}}) + '\n')
+        fh.write('not json\n')
+        fh.flush()
+        responses = [json.loads(fh.readline()) for i in range(4)]
+        self.assertEqual(responses[1]['result'], ['mysql', 'wordpress'])
+        self.assertIn('error', responses[2])
+        self.assertEqual(responses[3]['error'], 'Invalid request')
+
+    def test_cli_forwards(self):
+        out = StringIO()
+        self.patch(sys, 'stdout', out)
+        self.assertTrue(
+            cli.forwarded(self.config, self.options(['machines'])))
+        self.assertEqual(json.loads(out.getvalue()), ['0', '1', '2'])
+        self.assertFalse(cli.forwarded(
+            self.config, self.options(['machines'], no_daemon=True)))
+        self.assertFalse(
+            cli.forwarded(self.config, self.options(['shell'])))
+        self.assertFalse(cli.forwarded(
+            self.config,
+            self.options(['machines'], read_preference='primary')))
+
+    def test_cli_runs_locally_without_daemon(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertFalse(is_running(self.path))
+        self.assertFalse(
+            cli.forwarded(self.config, self.options(['machines'])))
@@ -0,0 +1,163 @@
+import os
+
+from juju_dbinspect.entities import (
+    unit, units, service, machine, relation, relations, history)
+from juju_dbinspect.snapshot import (
+    SnapshotCollection, SnapshotDatabase, matches, needles, project)
+from juju_dbinspect.txnindex import txn_history
+
+from base import Base
+import fixtures
+
+
+class SnapshotTest(Base):
+
+    def setUp(self):
+        self.db = self.snapshot_db(fixtures.environment())
+
+    def test_invalid_file(self):
+        path = os.path.join(self.mkdir(), 'bad')
+        with open(path, 'w') as fh:
+            fh.write('x' * 32)
+        self.assertRaises(ValueError, SnapshotDatabase, path)
+
+    def test_dump_private(self):
+        from base import FakeCollection
+        from juju_dbinspect.snapshot import dump
+        d = self.mkdir()
+        path = os.path.join(d, 'env.snapshot')
+        dump({'units': FakeCollection([{'_id': 'mysql/0'}])}, path,
+             ['units'])
+        self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+        # A failed dump leaves the previous snapshot in place.
+        self.assertRaises(
+            KeyError, dump, {'units': FakeCollection([])}, path,
+            ['units', 'missing'])
+        self.assertEqual(os.listdir(d), ['env.snapshot'])
+        self.assertEqual(SnapshotDatabase(path).units.count(), 1)
+
+    def test_collections(self):
+        self.assertEqual(self.db.units.count(), 2)
+        self.assertEqual(self.db.missing.count(), 0)
+        self.assertIn('txns', self.db.collection_names())
+
+    def test_entities(self):
+        self.assertEqual(sorted(units(self.db)), ['mysql/0', 'wordpress/0'])
+        u = unit(self.db, 'mysql/0')
+        self.assertNotIn('passwordhash', u)
+        self.assertEqual(u.status['status'], 'started')
+        self.assertEqual(u.constraints, {'mem': 4096})
+        self.assertEqual(u.service.config, {'dataset-size': '80%'})
+        self.assertEqual(
+            u.relation_data('wordpress'),
+            {'host': '10.0.3.1', 'password': 'hunter2'})
+        self.assertEqual(
+            [s.id for s in u.related_services], ['wordpress'])
+        self.assertEqual(
+            machine(self.db, '1').formatted['units'], ['mysql/0'])
+        self.assertNotIn('txn-queue', machine(self.db, '0'))
+        self.assertEqual(
+            service(self.db, 'wordpress').formatted['status'], None)
+        self.assertEqual(
+            sorted(relation(self.db, 'wordpress:db mysql:db').unit_ids),
+            ['mysql/0', 'wordpress/0'])
+        self.assertEqual(relations(self.db, 'wordpress'),
+                         ['wordpress:db mysql:db'])
+        history(self.db, 2)
+
+    def test_id_ranges(self):
+        found = [s['_id'] for s in self.db.settings.find(
+            {'_id': {'$gte': 'r#1#', '$lt': 'r#1$'}})]
+        self.assertEqual(
+            found, ['r#1#provider#mysql/0', 'r#1#requirer#wordpress/0'])
+        self.assertEqual(
+            self.db.settings.find({'_id': {'$gt': 's#'}}).count(), 2)
+
+    def test_matches(self):
+        doc = {'_id': 'x', 'o': [{'c': 'units', 'd': 'mysql/0'}], 'n': 3}
+        self.assertTrue(matches(doc, {'o.c': 'units'}))
+        self.assertTrue(matches(doc, {'o.d': {'$in': ['a', 'mysql/0']}}))
+        self.assertFalse(matches(doc, {'o.c': 'settings'}))
+        self.assertTrue(matches(doc, {'n': {'$gt': 1, '$lte': 3}}))
+        self.assertFalse(matches(doc, {'n': {'$gt': 'a'}}))
+        self.assertTrue(matches(doc, {'missing': {'$exists': False}}))
+        self.assertTrue(matches(doc, {'$or': [{'n': 1}, {'_id': 'x'}]}))
+        self.assertTrue(matches(doc, {'_id': {'$regex': '^x'}}))
+
+    def test_project(self):
+        doc = {'_id': 1, 'a': 1, 'o': [{'c': 'u', 'i': {'big': 1}}]}
+        self.assertEqual(project(doc, {'o.c': 1}),
+                         {'_id': 1, 'o': [{'c': 'u'}]})
+        self.assertEqual(project(doc, {'a': 0, '_id': 0}),
+                         {'o': [{'c': 'u', 'i': {'big': 1}}]})
+        self.assertEqual(project(doc, {'o.i': 0}),
+                         {'_id': 1, 'a': 1, 'o': [{'c': 'u'}]})
+        self.assertEqual(doc['o'][0]['i'], {'big': 1})
+
+    def test_aggregate(self):
+        result = self.db.txns.aggregate([
+            {'$match': {'s': 6}},
+            {'$project': {'o.c': 1}},
+            {'$unwind': '$o'},
+            {'$group': {'_id': '$o.c', 'count': {'$sum': 1},
+                        'first': {'$min': '$_id'}}},
+            {'$sort': {'count': -1}}])
+        self.assertEqual(result['ok'], 1.0)
+        self.assertEqual(
+            [(r['_id'], r['count'], r['first']) for r in result['result']],
+            [('units', 2, fixtures.txn_id(1)),
+             ('settings', 2, fixtures.txn_id(2))])
+        self.assertEqual(
+            self.db.txns.aggregate(
+                [{'$group': {'_id': None, 'n': {'$sum': '$s'}}}])['result'],
+            [{'_id': None, 'n': 24}])
+
+    def test_needles(self):
+        self.assertEqual(
+            needles({'o.d': 'mysql/0', '_id': {'$gt': 1}}),
+            [['\x02d\x00\x08\x00\x00\x00mysql/0\x00']])
+        self.assertEqual(len(needles({'s': 6})[0]), 3)
+        self.assertEqual(needles({'s': {'$ne': 6}}), [])
+        found = needles({'$or': [{'o.c': 'units'}, {'n': {'$gt': 1}}]})
+        self.assertEqual(found, [])
+        found = needles({'$or': [{'o.c': 'units'}, {'o.c': 'settings'}]})
+        self.assertEqual(len(found), 1)
+        self.assertEqual(len(found[0]), 2)
+
+    def test_raw_txns(self):
+        # Scan raw, however unselective the query.
+        self.patch(SnapshotCollection, '_selective',
+                   lambda self, positions, spec, limit: True)
+        raw = self.db.txns
+        decoded = self.snapshot_db(fixtures.environment()).txns
+        decoded._raw = False
+        self.assertEqual(raw.count(), decoded.count())
+        for spec in [
+                {}, {'s': 6}, {'s': {'$ne': 6}}, {'o.d': 'mysql/0'},
+                {'o': {'$elemMatch': {'c': 'settings',
+                                      'd': 'r#1#provider#mysql/0'}}},
+                {'$or': [{'o.c': 'statuses'}, {'s': 5}]},
+                {'_id': {'$gt': fixtures.txn_id(2)}, 'o.c': 'units'}]:
+            self.assertEqual(list(raw.find(spec)), list(decoded.find(spec)))
+        self.assertEqual(
+            [t['_id'] for t in txn_history(
+                self.db, [('units', 'mysql/0'),
+                          ('settings', 'r#1#provider#mysql/0')])],
+            [fixtures.txn_id(1), fixtures.txn_id(2), fixtures.txn_id(4)])
+
+    def test_raw_txns_decoded_when_unselective(self):
+        for spec, raw in [
+                ({'o.d': 'mysql/0'}, True),
+                ({'o': {'$elemMatch': {'c': 'units', 'd': 'mysql/0'}}},
+                 True),
+                ({'s': 6}, False),
+                ({'s': {'$nin': [5, 6]}}, False),
+                ({'$or': [{'o.c': 'statuses'}, {'s': 5}]}, False),
+                ({}, False)]:
+            txns = self.snapshot_db(fixtures.environment()).txns
+            found = list(txns.find(spec))
+            self.assertEqual(txns._raw, raw, spec)
+            self.assertEqual(found, list(txns.find(spec)))
+        txns = self.snapshot_db(fixtures.environment()).txns
+        self.assertEqual(len(list(txns.find(limit=1))), 1)
+        self.assertTrue(txns._raw)
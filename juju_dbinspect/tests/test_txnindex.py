@@ -0,0 +1,112 @@
+import os
+
+from juju_dbinspect.entities import machine, relation, service, unit
+from juju_dbinspect.txnindex import TxnIndex, attach, detach, txn_history
+
+from base import Base, MemoryDB
+import fixtures
+
+
+class TxnIndexTest(Base):
+
+    def setUp(self):
+        self.db = MemoryDB(fixtures.environment())
+        self.index = TxnIndex(os.path.join(self.mkdir(), 'txns.db'))
+        self.addCleanup(self.index.close)
+
+    def test_incremental_update(self):
+        self.assertEqual(self.index.update(self.db), 5)
+        self.assertEqual(self.index.last_id, fixtures.txn_id(5))
+        self.assertEqual(self.index.update(self.db), 0)
+        self.db.txns.insert({'_id': fixtures.txn_id(30), 's': 6, 'o': [
+            {'c': 'units', 'd': 'mysql/0', 'u': {'$set': {'life': 1}}}]})
+        # The pending txn is rechecked once its state changes.
+        self.db.txns.docs[4]['s'] = 6
+        self.assertEqual(self.index.update(self.db), 2)
+        self.assertEqual(
+            self.index.txn_ids([('units', 'mysql/0')]),
+            [fixtures.txn_id(1), fixtures.txn_id(2), fixtures.txn_id(30)])
+        state = self.index.conn.execute(
+            "SELECT state FROM txns WHERE txn = ?",
+            (str(fixtures.txn_id(5)),)).fetchone()[0]
+        self.assertEqual(state, 6)
+
+    def test_update_committed_in_batches(self):
+        txns = self.db.txns
+        find = txns.find
+
+        def failing_find(*args, **kw):
+            for i, t in enumerate(find(*args, **kw)):
+                if i == 3:
+                    raise IOError("Connection reset")
+                yield t
+        self.patch(txns, 'find', failing_find)
+        self.assertRaises(IOError, self.index.update, self.db, interval=2)
+        # The txns read before the last commit stay indexed.
+        self.assertEqual(self.index.last_id, fixtures.txn_id(2))
+        self.assertEqual(
+            self.index.conn.execute("SELECT count(*) FROM txns").fetchone(),
+            (2,))
+        self.patch(txns, 'find', find)
+        self.assertEqual(self.index.update(self.db, interval=2), 3)
+        self.assertEqual(self.index.last_id, fixtures.txn_id(5))
+
+    def test_lookup(self):
+        self.index.update(self.db)
+        found = self.index.lookup(
+            [('settings', 'r#1#provider#mysql/0'),
+             ('units', 'wordpress/0')])
+        self.assertEqual(
+            [t for t, ts in found],
+            [fixtures.txn_id(2), fixtures.txn_id(3), fixtures.txn_id(4)])
+        self.assertEqual(
+            found[0][1], 1394132520)
+
+    def assertHistory(self, docs, expected):
+        self.assertEqual(
+            [t['_id'] for t in txn_history(self.db, docs)],
+            [fixtures.txn_id(m) for m in expected])
+
+    def test_history_with_and_without_index(self):
+        docs = [('settings', 'r#1#provider#mysql/0'), ('units', 'mysql/0')]
+        self.assertHistory(docs, [1, 2, 4])
+        attach(self.db, self.index)
+        self.addCleanup(detach, self.db)
+        del self.db.queries[:]
+        self.assertHistory(docs, [1, 2, 4])
+        # The index answers, only the matching txns are fetched.
+        self.assertEqual(
+            self.db.queries[-1][1], {'_id': {'$in': [
+                fixtures.txn_id(1), fixtures.txn_id(2),
+                fixtures.txn_id(4)]}})
+
+    def test_attached_to_handle(self):
+        from juju_dbinspect.cache import CachedDatabase
+        from juju_dbinspect.txnindex import for_db
+        self.assertIs(for_db(self.db), None)
+        attach(self.db, self.index)
+        self.addCleanup(detach, self.db)
+        self.assertIs(for_db(self.db), self.index)
+        # A wrapper, or another handle, has its own index or none.
+        self.assertIs(for_db(CachedDatabase(self.db)), None)
+        self.assertIs(for_db(MemoryDB(fixtures.environment())), None)
+        detach(self.db)
+        self.assertIs(for_db(self.db), None)
+
+    def test_entity_history_docs(self):
+        self.assertEqual(
+            unit(self.db, 'mysql/0')._history_docs(),
+            [('units', 'mysql/0'), ('constraints', 'u#mysql/0'),
+             ('statuses', 'u#mysql/0'),
+             ('settings', 'r#1#provider#mysql/0'),
+             ('settings', 'r#2#peer#mysql/0')])
+        self.assertIn(
+            ('settings', 's#mysql#cs:precise/mysql-38'),
+            service(self.db, 'mysql')._history_docs())
+        self.assertEqual(
+            machine(self.db, '1')._history_docs(),
+            [('machines', '1'), ('constraints', 'm#1'), ('statuses', 'm#1')])
+        attach(self.db, self.index)
+        self.addCleanup(detach, self.db)
+        unit(self.db, 'wordpress/0').history()
+        relation(self.db, 'wordpress:db mysql:db').history()
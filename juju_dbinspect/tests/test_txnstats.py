@@ -0,0 +1,78 @@
+import datetime
+
+from bson.objectid import ObjectId
+
+from juju_dbinspect import txnstats
+from juju_dbinspect.entities import txn_queues, txn_stats
+
+from base import Base
+import fixtures
+
+
+class TxnStatsTest(Base):
+
+    def setUp(self):
+        self.db = self.snapshot_db(fixtures.environment())
+
+    def test_counts(self):
+        self.assertEqual(
+            txnstats.state_counts(self.db), {1: 1, 5: 1, 6: 3})
+        self.assertEqual(
+            txnstats.collection_counts(self.db),
+            {'units': 3, 'settings': 2, 'statuses': 1})
+        spec = txnstats.window(until=datetime.datetime(2014, 3, 6, 19, 3))
+        self.assertEqual(txnstats.state_counts(self.db, spec), {6: 2})
+
+    def test_time_buckets(self):
+        self.assertEqual(
+            [c for t, c in txnstats.time_buckets(self.db, buckets=4)],
+            [2, 1, 1, 1])
+        buckets = txnstats.time_buckets(
+            self.db, datetime.datetime(2014, 3, 6, 19),
+            datetime.datetime(2014, 3, 6, 20), buckets=2)
+        self.assertEqual(buckets, [
+            (datetime.datetime(2014, 3, 6, 19), 5),
+            (datetime.datetime(2014, 3, 6, 19, 30), 0)])
+
+    def test_txn_stats(self):
+        stats = txn_stats(self.db)
+        self.assertEqual(
+            stats['states'], {'preparing': 1, 'aborted': 1, 'applied': 3})
+        self.assertEqual(sum(b['count'] for b in stats['times']), 5)
+        self.assertEqual(
+            [t['id'] for t in stats['unsettled']],
+            [str(fixtures.txn_id(5))])
+        stats = txn_stats(self.db, since='2014-03-06T19:02:00')
+        self.assertEqual(stats['collections'], {
+            'units': 2, 'settings': 2, 'statuses': 1})
+
+
+class TxnQueueTest(Base):
+
+    def setUp(self):
+        env = fixtures.environment()
+        token = lambda minute: '%s_%08x' % (fixtures.txn_id(minute), minute)
+        env['units'][1]['txn-queue'] = [token(3), token(5), token(5)]
+        env['statuses'][0]['txn-queue'] = [token(5)] * 4 + [
+            '%s_00000000' % ObjectId()]
+        self.db = self.snapshot_db(env)
+
+    def test_backlog(self):
+        backlog = txnstats.queue_backlog(self.db, 2)
+        self.assertEqual(
+            [(c, len(queue)) for c, d, queue in backlog],
+            [('statuses', 5), ('units', 3)])
+        self.assertEqual(backlog[1][2][0], fixtures.txn_id(3))
+        self.assertEqual(txnstats.queue_backlog(self.db, 3, 1), backlog[:1])
+        self.assertEqual(txnstats.queue_backlog(self.db, 2, 0), backlog)
+        self.assertEqual(txnstats.queue_backlog(self.db, 5), [])
+
+    def test_txn_queues(self):
+        result = txn_queues(self.db, 2)
+        self.assertEqual(result[0]['length'], 5)
+        self.assertEqual(
+            result[0]['states'], {'preparing': 4, 'missing': 1})
+        self.assertEqual(result[1], {
+            'collection': 'units', 'id': 'wordpress/0', 'length': 3,
+            'states': {'aborted': 1, 'preparing': 2},
+            'first': str(fixtures.txn_id(3))})
@@ -0,0 +1,171 @@
+"""
+Local index of the transaction log by document.
+
+Juju doesn't index txns on the collection and document ids of their
+operations, so finding the history of a document is a scan of the
+whole log on the state server. `TxnIndex` keeps a sqlite table mapping
+(collection, document id) to txn ids and times, built once and then
+updated incrementally from the tail of the log.
+
+An index is attached to a db handle, after which the history methods
+of the entities answer from it.
+"""
+import calendar
+import sqlite3
+
+from bson.objectid import ObjectId
+
+from juju_dbinspect.query import batched
+from juju_dbinspect.txnlog import TxnTail, TERMINAL_STATES
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS txns (
+    txn TEXT PRIMARY KEY,
+    ts INTEGER,
+    state INTEGER);
+CREATE TABLE IF NOT EXISTS ops (
+    c TEXT,
+    d TEXT,
+    txn TEXT);
+CREATE INDEX IF NOT EXISTS ops_doc ON ops (c, d);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT);
+"""
+
+# Before any txn id.
+ORIGIN = ObjectId("0" * 24)
+
+# Txns indexed per commit, a first build streams the whole log.
+COMMIT_INTERVAL = 10000
+
+
+def attach(db, index):
+    """Answer entity history lookups on db from index.
+
+    The index is kept on the db handle, and goes away with it.
+    """
+    db.__dict__['_txn_index'] = index
+
+
+def detach(db):
+    db.__dict__.pop('_txn_index', None)
+
+
+def for_db(db):
+    """Return the index attached to db, or None."""
+    # Not getattr, pymongo's Database makes a collection of any name and
+    # the wrappers would answer from the db they wrap.
+    return vars(db).get('_txn_index')
+
+
+def txn_history(db, docs, bounds=None):
+    """Yield the txns touching any of docs, (collection, id) pairs, in order.
+
+    bounds optionally restricts the txn ids, with $gt/$lt conditions.
+    """
+    index = for_db(db)
+    if index is not None:
+        index.update(db)
+        txn_ids = index.txn_ids(docs)
+        if bounds:
+            txn_ids = [
+                t for t in txn_ids
+                if ('$gt' not in bounds or t > bounds['$gt']) and
+                ('$lt' not in bounds or t < bounds['$lt'])]
+        for chunk in batched(txn_ids):
+            for t in db.txns.find(
+                    {'_id': {'$in': chunk}}, sort=[('_id', 1)]):
+                yield t
+        return
+    by_collection = {}
+    for c, d in docs:
+        by_collection.setdefault(c, []).append(d)
+    clauses = [{'o': {'$elemMatch': {'c': c, 'd': {'$in': ids}}}}
+               for c, ids in sorted(by_collection.items())]
+    if not clauses:
+        return
+    spec = clauses[0] if len(clauses) == 1 else {'$or': clauses}
+    if bounds:
+        spec = dict(spec, _id=bounds)
+    for t in db.txns.find(spec, sort=[('_id', 1)]):
+        yield t
+
+
+class TxnIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    @property
+    def last_id(self):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'last_id'").fetchone()
+        return row and ObjectId(row[0]) or None
+
+    def update(self, db, interval=COMMIT_INTERVAL):
+        """Index the txns made, or changed state, since the last update.
+
+        Txns are read as a stream and committed every interval txns, an
+        interrupted update resumes from the last commit. Returns the
+        number of txns indexed.
+        """
+        tail = TxnTail(
+            db, fields={'o.c': 1, 'o.d': 1}, start=self.last_id or ORIGIN)
+        tail.pending = dict(
+            (ObjectId(txn), state) for txn, state in self.conn.execute(
+                "SELECT txn, state FROM txns WHERE state NOT IN (?, ?)",
+                TERMINAL_STATES))
+        count = 0
+        try:
+            for t in tail.iter_poll():
+                self._index(t)
+                count += 1
+                if count % interval == 0:
+                    self._commit(tail)
+            self._commit(tail)
+        except:
+            self.conn.rollback()
+            raise
+        return count
+
+    def _index(self, t):
+        txn = str(t['_id'])
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO txns VALUES (?, ?, ?)",
+            (txn, calendar.timegm(
+                t['_id'].generation_time.utctimetuple()), t['s']))
+        if cursor.rowcount:
+            self.conn.executemany(
+                "INSERT INTO ops VALUES (?, ?, ?)",
+                [(o['c'], unicode(o['d']), txn) for o in t['o']])
+        else:
+            self.conn.execute(
+                "UPDATE txns SET state = ? WHERE txn = ?", (t['s'], txn))
+
+    def _commit(self, tail):
+        if tail.last_id is not None and tail.last_id != ORIGIN:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('last_id', ?)",
+                (str(tail.last_id),))
+        self.conn.commit()
+
+    def lookup(self, docs):
+        """Return (txn id, unix time) pairs touching docs, in txn order.
+        """
+        found = set()
+        for c, d in docs:
+            found.update(self.conn.execute(
+                "SELECT txns.txn, txns.ts FROM ops JOIN txns "
+                "ON ops.txn = txns.txn WHERE ops.c = ? AND ops.d = ?",
+                (c, unicode(d))).fetchall())
+        return [(ObjectId(txn), ts) for txn, ts in sorted(found)]
+
+    def txn_ids(self, docs):
+        return [txn for txn, ts in self.lookup(docs)]
@@ -0,0 +1,80 @@
+"""
+Incremental reads of the transaction log.
+
+Juju's txn ids are ObjectIds, so new transactions can be found with an
+_id range from the last one seen, at a constant cost per poll. A txn is
+created before it is prepared and applied though, so transactions seen
+in a non terminal state are tracked and rechecked until they settle.
+"""
+
+# Txn states, see entities.Txn.state_labels
+TERMINAL_STATES = (5, 6)
+
+# How many of the most recent txns to check for in progress ones when
+# starting to follow the log.
+LOOKBACK = 1000
+
+# Bounds the number of in progress txns rechecked on each poll.
+MAX_PENDING = 10000
+
+
+class TxnTail(object):
+    """Follow the txns collection.
+
+    Each poll returns the txns created since the previous poll, along
+    with earlier ones whose state has changed since they were seen, in
+    _id order. spec restricts the txns followed.
+    """
+
+    def __init__(self, db, spec=None, fields=None, start=None):
+        self.db = db
+        self.spec = spec or {}
+        self.fields = fields
+        if fields is not None and 's' not in fields:
+            self.fields = dict(fields, s=1)
+        self.pending = {}
+        if start is None:
+            self.last_id = None
+            for t in db.txns.find(
+                    self.spec, {'s': 1}, sort=[('_id', -1)],
+                    limit=LOOKBACK):
+                if self.last_id is None:
+                    self.last_id = t['_id']
+                if t['s'] not in TERMINAL_STATES:
+                    self.pending[t['_id']] = t['s']
+        else:
+            self.last_id = start
+
+    def _query(self):
+        clauses = []
+        if self.last_id is None:
+            clauses.append({})
+        else:
+            clauses.append({'_id': {'$gt': self.last_id}})
+        if self.pending:
+            clauses.append({'_id': {'$in': self.pending.keys()}})
+        query = clauses[0] if len(clauses) == 1 else {'$or': clauses}
+        if self.spec:
+            query = {'$and': [self.spec, query]}
+        return query
+
+    def poll(self):
+        """Return the txns that are new or have changed state."""
+        return list(self.iter_poll())
+
+    def iter_poll(self):
+        """Yield the txns that are new or have changed state, as they're
+        read, for a first read of a large log.
+        """
+        for t in self.db.txns.find(
+                self._query(), self.fields, sort=[('_id', 1)]):
+            if self.pending.get(t['_id']) == t['s']:
+                continue
+            if t['s'] in TERMINAL_STATES:
+                self.pending.pop(t['_id'], None)
+            elif t['_id'] in self.pending or len(
+                    self.pending) < MAX_PENDING:
+                self.pending[t['_id']] = t['s']
+            if self.last_id is None or t['_id'] > self.last_id:
+                self.last_id = t['_id']
+            yield t
@@ -0,0 +1,142 @@
+"""
+Transaction log statistics.
+
+Counts by state and by collection are computed server side with the
+aggregation framework, so only the totals cross the wire. Mongo 2.4
+can't extract the generation time from an ObjectId in a pipeline, so
+time buckets are counted as _id ranges instead, each an index only
+count.
+
+Documents with long txn-queues, the tokens of the txns pending on
+them, are found with an existence query on the queue position past
+the threshold, so only the queues of the backed up documents are read.
+"""
+import datetime
+
+from bson.objectid import ObjectId
+
+from juju_dbinspect.query import find_in
+from juju_dbinspect.txnlog import TERMINAL_STATES
+
+
+# Number of time buckets the window is divided into.
+BUCKETS = 24
+
+# Number of the oldest unsettled txns reported.
+OLDEST = 10
+
+
+def aggregate(collection, pipeline):
+    """Run an aggregation pipeline, returning the result documents.
+
+    pymongo 2.x returns mongo 2.4's single reply document, later
+    versions a cursor.
+    """
+    result = collection.aggregate(pipeline)
+    if isinstance(result, dict):
+        return result['result']
+    return list(result)
+
+
+def window(since=None, until=None):
+    """Return the query on txn _id for a window of generation times."""
+    bounds = {}
+    if since is not None:
+        bounds['$gte'] = ObjectId.from_datetime(since)
+    if until is not None:
+        bounds['$lt'] = ObjectId.from_datetime(until)
+    return bounds and {'_id': bounds} or {}
+
+
+def state_counts(db, spec=None):
+    """Return the number of txns in each state."""
+    pipeline = [{'$group': {'_id': '$s', 'count': {'$sum': 1}}}]
+    if spec:
+        pipeline.insert(0, {'$match': spec})
+    return dict((r['_id'], r['count']) for r in aggregate(db.txns, pipeline))
+
+
+def collection_counts(db, spec=None):
+    """Return the number of txn operations on each collection."""
+    pipeline = [
+        {'$project': {'o.c': 1}},
+        {'$unwind': '$o'},
+        {'$group': {'_id': '$o.c', 'count': {'$sum': 1}}}]
+    if spec:
+        pipeline.insert(0, {'$match': spec})
+    return dict((r['_id'], r['count']) for r in aggregate(db.txns, pipeline))
+
+
+def _edge(db, direction):
+    for t in db.txns.find({}, {'_id': 1}, sort=[('_id', direction)],
+                          limit=1):
+        return t['_id'].generation_time.replace(tzinfo=None)
+    return None
+
+
+def time_buckets(db, since=None, until=None, buckets=BUCKETS):
+    """Return (start, count) pairs of txns made in each time bucket.
+
+    The window defaults to the span of the log.
+    """
+    if since is None:
+        since = _edge(db, 1)
+    if until is None:
+        last = _edge(db, -1)
+        # Include the last txn.
+        until = last and last + datetime.timedelta(seconds=1)
+    if since is None or until is None:
+        return []
+    span = max(int((until - since).total_seconds()), 1)
+    width = datetime.timedelta(seconds=max(-(-span // buckets), 1))
+    result = []
+    start = since
+    while start < until:
+        end = min(start + width, until)
+        result.append(
+            (start, db.txns.find(window(start, end), {'_id': 1}).count()))
+        start = end
+    return result
+
+
+def oldest_unsettled(db, spec=None, limit=OLDEST):
+    """Return the oldest txns not yet applied or aborted."""
+    spec = dict(spec or {}, s={'$nin': list(TERMINAL_STATES)})
+    return list(db.txns.find(spec, sort=[('_id', 1)], limit=limit))
+
+
+# Collections without txn-queues.
+UNQUEUED = ('txns', 'txns.log')
+
+
+def queued_collections(db):
+    return [c for c in db.collection_names()
+            if c not in UNQUEUED and not c.startswith('system.')]
+
+
+def token_txn(token):
+    """Return the txn id of a txn-queue token, <txn id>_<nonce>."""
+    return ObjectId(token[:24])
+
+
+def queue_backlog(db, threshold=10, limit=100):
+    """Return the documents with more than threshold queued txns.
+
+    Each is a (collection, document id, queued txn ids) tuple, longest
+    queue first. A limit of 0 returns them all.
+    """
+    found = []
+    for c in queued_collections(db):
+        for doc in db[c].find(
+                {'txn-queue.%d' % threshold: {'$exists': True}},
+                {'txn-queue': 1}):
+            found.append(
+                (c, doc['_id'], [token_txn(t) for t in doc['txn-queue']]))
+    found.sort(key=lambda f: -len(f[2]))
+    return found[:limit] if limit else found
+
+
+def txn_states(db, txn_ids):
+    """Return the state of each of txn_ids that is in the log."""
+    return dict((t['_id'], t['s']) for t in find_in(
+        db.txns, '_id', txn_ids, {'s': 1}))